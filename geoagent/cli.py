@@ -2,12 +2,11 @@ import argparse
 import json
 
 import os
-import pandas as pd
 
-from geoagent.utils.geo_helpers import search_geo_records, get_metadata, download_supp_files
-from geoagent.utils.metadata_helpers import SuppFileHelper
-from geoagent.tools.count_matrix_reader import GeoCountMatrixReader   
+from geoagent.utils.downloader import DEFAULT_MAX_PER_HOST
 
+# subcommand dependencies are imported in their branch, e.g. `search` never loads
+# scanpy or the LLM stack used by `counts`
 
 
 def cli():
@@ -17,51 +16,90 @@ def cli():
 
     parser.add_argument("--llm", type=str, default="qwen1.5-72b-chat")
     parser.add_argument("--parallel", type=int, default=1, help="The number of parallel tasks")
+    parser.add_argument("--max_per_host", type=int, default=DEFAULT_MAX_PER_HOST, help="The maximum number of concurrent downloads per host")
 
     subparsers = parser.add_subparsers(dest="subparser_name")
 
     search_subparser = subparsers.add_parser("search", help="Search GEO records")
-    search_subparser.add_argument("query", type=str, help="The keywords to search")
+    search_subparser.add_argument("query", type=str, nargs="+", help="The keywords to search, several queries are searched concurrently")
     search_subparser.add_argument("--limit", type=int, help="The maximum number of results to return", default=10)
     search_subparser.add_argument("--cache_dir", type=str, help="The directory to download the data", required=False, default=None)
     search_subparser.add_argument("--output", type=str, help="The output file path", required=False, default=None)
+    search_subparser.add_argument("--backend", type=str, choices=["html", "eutils"], help="Parse the GEO web page or use the E-utilities API", default="html")
     
     metadata_subparser = subparsers.add_parser("metadata", help="Extract metadata from searched results")
     metadata_subparser.add_argument("--cache_dir", type=str, help="search result file directory")
+    metadata_subparser.add_argument("--incremental", action="store_true", help="Only re-extract records whose SOFT file changed since the last run")
+    metadata_subparser.add_argument("--plan", action="store_true", help="Query the remote size of every supplementary file and write a download plan")
     
-    download_subparser = subparsers.add_parser("download", help="Download all files of a given GSE")
-    download_subparser.add_argument("gse_id", type=str, help="GSE ID")
+    download_subparser = subparsers.add_parser("download", help="Download the supplementary files of GEO records through the download queue")
+    download_subparser.add_argument("geo_ids", type=str, nargs="*", help="GEO accessions (GSE or GSM)")
+    download_subparser.add_argument("--search_file", type=str, help="A search results csv, all its accessions are downloaded", default=None)
     download_subparser.add_argument("--cache_dir", type=str, help="The directory to download the data", default=None)
+    download_subparser.add_argument("--max_attempts", type=int, help="The maximum number of attempts per file", default=None)
+    download_subparser.add_argument("--status", action="store_true", help="Only print the progress of the download queue")
+    download_subparser.add_argument("--types", type=str, nargs="+", help="Only download these file types, e.g. mtx h5 tsv", default=None)
+    download_subparser.add_argument("--max_file_size", type=str, help="Skip files above this size, e.g. 5G", default=None)
+    download_subparser.add_argument("--budget", type=str, help="The maximum total size to download, e.g. 200G", default=None)
+    download_subparser.add_argument("--exclude_types", type=str, nargs="+", help="Never download these file types, e.g. bam fastq", default=None)
+    download_subparser.add_argument("--include_regex", type=str, help="Only download files whose name matches", default=None)
+    download_subparser.add_argument("--exclude_regex", type=str, help="Never download files whose name matches", default=None)
+    download_subparser.add_argument("--count_matrices", action="store_true", help="Only download count matrices, fetching them alone from _RAW.tar archives")
+    download_subparser.add_argument("--dry_run", action="store_true", help="Only print the download plan")
     
-    counts_subparser = subparsers.add_parser("counts", help="Read the count matrix from a chosen GEO sample")
-    counts_subparser.add_argument("--gsm_id", type=str, help="a valid GEO sample ID", required=True)
-    # count_matrix_subparser.add_argument("--output", type=str, required=True, help="The output h5ad file path")
+    cache_subparser = subparsers.add_parser("cache", help="Manage the shared GEO cache under GEO_CACHE_DIR")
+    cache_subparser.add_argument("action", type=str, choices=["stats", "prune", "verify"], help="The cache operation")
+    cache_subparser.add_argument("--max_bytes", type=str, help="Evict least recently used files above this size, e.g. 500G", default=None)
+    cache_subparser.add_argument("--max_age_days", type=float, help="Evict files not used for this many days", default=None)
+    cache_subparser.add_argument("--remove_invalid", action="store_true", help="Remove missing or corrupted entries when verifying")
+
+    counts_subparser = subparsers.add_parser("counts", help="Read the count matrices of chosen GEO samples")
+    counts_subparser.add_argument("--gsm_id", type=str, nargs="+", help="valid GEO sample IDs", default=[])
+    counts_subparser.add_argument("--gse_id", type=str, nargs="+", help="GEO series IDs, all their downloaded samples are read", default=[])
+    counts_subparser.add_argument("--cache_dir", type=str, help="The directory the records were downloaded to", default=None)
+    counts_subparser.add_argument("--output", type=str, required=True, help="The output h5ad file path, or a directory for one h5ad per sample")
 
 
     args = parser.parse_args()
     if args.subparser_name == "search":
-        results = search_geo_records(args.query, max_records=args.limit)
+        import pandas as pd
+        from geoagent.utils.geo_helpers import iter_geo_records, search_geo_records_batch, download_many_supp_files
+
+        if len(args.query) == 1:
+            results = []
+            # print records as soon as their result page is parsed
+            for record in iter_geo_records(args.query[0], max_records=args.limit, backend=args.backend):
+                results.append(record)
+                if not args.output:
+                    print(json.dumps(record, indent=2))
+        else:
+            batch_results = search_geo_records_batch(args.query, max_records=args.limit, parallel=args.parallel, backend=args.backend)
+            results = [{"query": query, **record} for query, records in batch_results.items() for record in records]
+            if not args.output:
+                print(json.dumps(results, indent=2))
 
         if args.cache_dir:
             if not os.path.exists(args.cache_dir):
                 os.makedirs(args.cache_dir)
             search_df_path = os.path.join(args.cache_dir, f"search_results.csv")
             pd.DataFrame(results).to_csv(search_df_path, encoding="utf-8")
-            geo_ids = [x["accession"] for x in results]
+            geo_ids = list(dict.fromkeys(x["accession"] for x in results))
             print(f"Downloading {geo_ids} to {args.cache_dir}")
-            for geo_id in geo_ids:
-                download_supp_files(geo_id, cache_path=args.cache_dir)
+            download_many_supp_files(geo_ids, cache_path=args.cache_dir, parallel=args.parallel, max_per_host=args.max_per_host)
 
         if args.output:
             pd.DataFrame(results).to_csv(args.output, encoding="utf-8")
-        else:
-            print(json.dumps(results, indent=2))
 
 
     elif args.subparser_name == "metadata":
+        import pandas as pd
+        from geoagent.utils.geo_helpers import refresh_metadata
+        from geoagent.utils.metadata_helpers import SuppFileHelper
+        from geoagent.utils.metadata_store import METADATA_DB_FILE, MetadataStore
+
         root_dir = args.cache_dir
         search_file_path = os.path.join(root_dir, "search_results.csv")
-        meta_path = os.path.join(root_dir, "metadata.csv")
+        meta_path = os.path.join(root_dir, METADATA_DB_FILE)
         supp_stats_path = os.path.join(root_dir, "supp_file_stats.json")
         supp_tree_path = os.path.join(root_dir, "supp_file_tree.json")
 
@@ -69,29 +107,99 @@ def cli():
         geo_ids = pd.read_csv(search_file_path)["accession"].tolist()
         print(f"Extracting metadata for {geo_ids}")
 
-        meta_infos = {}
-        for geo_id in geo_ids:
-            _geo_soft_dir = os.path.join(root_dir, geo_id, "Soft")
-            meta_infos[geo_id] = get_metadata(geo_id, parse_subsamples=True, cache_dir=_geo_soft_dir)
-        
-        pd.DataFrame.from_dict(meta_infos, orient="index") \
-            .to_csv(meta_path, encoding="utf-8")
+        refresh_stats = refresh_metadata(
+            geo_ids,
+            MetadataStore(meta_path),
+            parse_subsamples=True,
+            cache_path=root_dir,
+            parallel=args.parallel,
+            force=not args.incremental,
+        )
+        print(json.dumps({k: len(v) for k, v in refresh_stats.items()}))
         
         sfh = SuppFileHelper(meta_path)
+        if args.plan:
+            # the sizes are recorded in the store, so the stats below include bytes
+            plan = sfh.plan_downloads(root_dir, max_per_host=args.max_per_host)
+            plan.to_frame().to_csv(os.path.join(root_dir, "download_plan.csv"), index=False)
         with open(supp_stats_path, "w") as f:
             json.dump(sfh.analyze_gses(), f, indent=4)
         with open(supp_tree_path, "w") as f:
             json.dump(sfh.list_all_gse_files(), f, indent=4)
 
     elif args.subparser_name == "download":
-        print(f"Downloading {geo_ids} to {args.cache_dir}")
-        download_supp_files(geo_id, cache_path=args.cache_dir)
-
+        from dataclasses import replace
+        from geoagent.utils.download_queue import DEFAULT_MAX_ATTEMPTS, get_download_queue, read_search_accessions
+        from geoagent.utils.downloader import COUNT_MATRIX_FILTER, DownloadFilter
+        from geoagent.utils.geo_helpers import GEO_PATH, plan_supp_files
+
+        root_dir = args.cache_dir or GEO_PATH
+        queue = get_download_queue(root_dir)
+        if args.status:
+            print(json.dumps(queue.progress(), indent=2))
+            return
+
+        geo_ids = list(args.geo_ids)
+        if args.search_file:
+            geo_ids += read_search_accessions(args.search_file)
+        geo_ids = list(dict.fromkeys(geo_ids))
+
+        file_filter = replace(
+            COUNT_MATRIX_FILTER if args.count_matrices else DownloadFilter(),
+            exclude_types=args.exclude_types,
+            include_regex=args.include_regex,
+            exclude_regex=args.exclude_regex,
+        )
+        filters = {"file_types": args.types, "max_file_size": args.max_file_size, "budget": args.budget, "file_filter": file_filter}
+        if args.dry_run or args.types or args.max_file_size or args.budget:
+            # the files are selected on their type and remote size before anything is queued
+            plan = plan_supp_files(geo_ids, cache_path=root_dir, parallel=args.parallel, max_per_host=args.max_per_host, **filters)
+            print(json.dumps({k: v for k, v in plan.summary().items() if k != "bytes_per_sample"}, indent=2))
+            if args.dry_run:
+                return
+            queue.submit(geo_ids, tasks=plan.tasks)
+        else:
+            queue.submit(geo_ids)
+
+        print(f"Downloading {len(geo_ids)} records to {root_dir}")
+        progress = queue.run(
+            parallel=args.parallel,
+            max_per_host=args.max_per_host,
+            max_attempts=args.max_attempts or DEFAULT_MAX_ATTEMPTS,
+            file_filter=file_filter,
+            report_every=30,
+        )
+        print(json.dumps(progress, indent=2))
+
+    elif args.subparser_name == "cache":
+        from geoagent.utils.file_helpers import parse_size
+        from geoagent.utils.geo_cache import get_geo_cache
+
+        cache = get_geo_cache()
+        if args.action == "stats":
+            from geoagent.utils.loader_cache import get_loader_cache
+
+            print(json.dumps({**cache.stats(), "loaders": get_loader_cache().stats()}, indent=2))
+        elif args.action == "prune":
+            removed = cache.prune(max_bytes=parse_size(args.max_bytes), max_age_days=args.max_age_days)
+            print(f"Evicted {len(removed)} entries")
+            print(json.dumps(cache.stats(), indent=2))
+        elif args.action == "verify":
+            print(json.dumps(cache.verify(remove_invalid=args.remove_invalid), indent=2))
     
     elif args.subparser_name == "counts":
-        count_matrix_reader = GeoCountMatrixReader(llm="")
-        adata = count_matrix_reader.process_gsm(args.gsm_id)
-        adata.write_h5ad(args.output)
+        from geoagent.tools.count_matrix_reader import GeoCountMatrixReader, find_sample_dirs
+
+        count_matrix_reader = GeoCountMatrixReader(llm=args.llm)
+        if args.cache_dir:
+            sample_dirs = find_sample_dirs(args.cache_dir, gse_ids=args.gse_id, gsm_ids=args.gsm_id)
+        elif len(args.gsm_id) == 1 and not args.gse_id:
+            # a single sample directory given as the GSM ID
+            sample_dirs = {os.path.basename(os.path.normpath(args.gsm_id[0])): args.gsm_id[0]}
+        else:
+            raise ValueError("--cache_dir is required to read several samples")
+        res = count_matrix_reader.process_many(sample_dirs, args.output, parallel=args.parallel)
+        print(json.dumps(res, indent=2))
 
 
     else:
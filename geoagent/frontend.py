@@ -1,13 +1,13 @@
 import streamlit as st
 import pandas as pd
 
-from geoagent.utils.front_helpers import search_records, parse_metadata, download_data
+from geoagent.utils.front_helpers import search_records, parse_metadata, download_data, download_progress
 
 
 st.title("GeoAgent")
 st.header("A. Download data")
 st.subheader("Step 1: Search a topic")
-keywords = st.text_input("What keywords to search on GEO database?", placeholder="Enter a topic")
+keywords = st.text_input("What keywords to search on GEO database?", placeholder="Enter a topic, separate several topics with ;")
 search_instruct = st.text_area("Specify your search instructions:", placeholder="What rules to filter the search results?", height=80)
 
 col1, col2 = st.columns(2, vertical_alignment="bottom")
@@ -21,8 +21,8 @@ with col2:
 # Search button
 if search_button:
     if keywords.strip():
-        # the actual search
-        search_df = search_records(keywords, max_records)
+        # the actual search, rows are shown while later pages are still loading
+        search_df = search_records(keywords, max_records, placeholder=st.empty())
         # Store search_df in session state
         st.session_state['search_df'] = search_df
         
@@ -46,8 +46,12 @@ with col2:
 if download_btn:
     if 'search_df' in st.session_state:
         download_data(st.session_state['search_df'], download_dir)
+        st.session_state['download_dir'] = download_dir
     else:
         st.warning("Please perform a search first")
+# Download progress, refreshed in the background while the rest of the page stays usable
+if 'download_dir' in st.session_state:
+    download_progress(st.session_state['download_dir'])
 
 
 st.subheader("Step 3: Parse metadata & Select data")
@@ -1,3 +1,9 @@
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import anndata as ad
 from jinja2 import Template
 from modelscope_agent.llm import get_chat_model
 from modelscope_agent.llm.base import BaseChatModel
@@ -5,14 +11,57 @@ from modelscope_agent.tools.base import BaseTool, register_tool
 from scanpy import AnnData
 
 from geoagent.prompts import mtx_reader, table_reader
+from geoagent.tools.fast_readers import detect_fast_layout, fast_read
 from geoagent.types import FileType
 from geoagent.utils import geo_helpers
-from geoagent.utils.code_runner import safe_exec_func
+from geoagent.utils.code_runner import SandboxPool, get_sandbox_pool, safe_exec_func
+from geoagent.utils.layout_helpers import generalize_code, layout_fingerprint, specialize_code
 from geoagent.utils.llm_helpers import get_chat_model
+from geoagent.utils.loader_cache import LoaderCache, get_loader_cache
+from geoagent.utils.logger import geoagent_logger as logger
 from geoagent.utils.output_parser import parse_python_markdown
 
 from geoagent.utils.file_helpers import list_files_with_content
 
+PEEK_TYPES = ["txt", "csv", "tsv", "mtx"]
+
+
+def _check_adata(final_result: dict, reply: str = None) -> AnnData:
+    if "adata" not in final_result or not isinstance(final_result["adata"], AnnData):
+        raise ValueError(f"Error reading count matrix: {reply}")
+    return final_result["adata"]
+
+
+def _fast_reader_code(sample_dir: str, files: list[str]) -> str:
+    # the fast readers run in the sandbox workers like the generated loaders
+    return (
+        "from geoagent.tools.fast_readers import fast_read\n"
+        f"adata = fast_read({sample_dir!r}, {files!r})\n"
+    )
+
+
+def find_sample_dirs(cache_dir: str, gse_ids: list[str] = None, gsm_ids: list[str] = None) -> dict[str, str]:
+    """
+    Locate the downloaded files of samples, laid out by `download_supp_files` as
+    `<cache_dir>/<gse_id>/<gsm_id>` for series and `<cache_dir>/<gsm_id>/Supp` for samples.
+    """
+    sample_dirs = {}
+    for gse_id in gse_ids or []:
+        gse_dir = os.path.join(cache_dir, gse_id)
+        if not os.path.isdir(gse_dir):
+            logger.error(f"{gse_id} is not downloaded in {cache_dir}")
+            continue
+        for gsm_id in sorted(os.listdir(gse_dir)):
+            if gsm_id.startswith("GSM") and os.path.isdir(os.path.join(gse_dir, gsm_id)):
+                sample_dirs[gsm_id] = os.path.join(gse_dir, gsm_id)
+    for gsm_id in gsm_ids or []:
+        gsm_dir = os.path.join(cache_dir, gsm_id, "Supp")
+        if os.path.isdir(gsm_dir):
+            sample_dirs[gsm_id] = gsm_dir
+        else:
+            logger.error(f"{gsm_id} is not downloaded in {cache_dir}")
+    return sample_dirs
+
 
 @register_tool("geo_count_matrix_reader")
 class GeoCountMatrixReader(BaseTool):
@@ -36,9 +85,26 @@ class GeoCountMatrixReader(BaseTool):
         self,
         llm: str | dict | BaseChatModel,
         cfg: dict | None = {},
+        use_loader_cache: bool = True,
+        sandbox: bool = True,
     ):
+        """
+        :param use_loader_cache: reuse loaders generated for the same file layout, see `LoaderCache`
+        :param sandbox: run generated loaders of `process_gsm` in the sandbox workers of
+            `get_sandbox_pool` instead of this process, `process_many` always uses a sandbox
+        """
         super().__init__(cfg)
-        # self.llm = get_chat_model(llm)
+        self._llm = llm
+        self._chat_model = None
+        self.loader_cache: LoaderCache | None = get_loader_cache() if use_loader_cache else None
+        self.sandbox = sandbox
+
+    @property
+    def llm(self) -> BaseChatModel:
+        # created on first use, loaders reused across samples never need it
+        if self._chat_model is None:
+            self._chat_model = get_chat_model(self._llm)
+        return self._chat_model
 
     def _construct_context(self, file_content: dict) -> str:
         final_str = "### SUPP FILES\n"
@@ -47,14 +113,7 @@ class GeoCountMatrixReader(BaseTool):
             final_str += f'\n```\n{content}\n```'
         return final_str
 
-    def process_gsm(self, gsm_id: str) -> AnnData:
-        # step 1: determine whether using supp files or process fastq files
-        # file_content = geo_helpers.get_supp_data(gsm_id)
-        # if len(file_content["files"]) == 0:
-        #     raise ValueError("No supplementary file found")
-        # step 2: Anndata reading
-        
-        file_content = list_files_with_content(gsm_id, peek_types=["txt", "csv", "tsv", "mtx"])
+    def _generate_code(self, file_content: dict) -> tuple[str, str]:
         file_type = geo_helpers.check_file_type(file_content)
 
         if file_type == FileType.UNKNOWN:
@@ -62,6 +121,8 @@ class GeoCountMatrixReader(BaseTool):
 
         context = self._construct_context(file_content)
 
+        if file_type not in self.prompt_templates:
+            raise ValueError(f"No loader template for {file_type.name} files")
         template = self.prompt_templates[file_type]
         prompt = template.render(files=context, folder_path=file_content["file_dir"])
 
@@ -69,15 +130,180 @@ class GeoCountMatrixReader(BaseTool):
         if "Error" in reply:
             raise ValueError(f"Error reading count matrix: {reply}")
 
-        code = parse_python_markdown(reply)
-        final_result = safe_exec_func(code, param_space={})
-        if "adata" not in final_result or not isinstance(
-            final_result["adata"], AnnData
-        ):
-            raise ValueError(f"Error reading count matrix: {reply}")
-        adata = final_result["adata"]
+        return parse_python_markdown(reply), reply
+
+    def _get_loader(self, file_content: dict, fingerprint: str, use_cache: bool = True) -> tuple[str, bool]:
+        """
+        Return the loader of a layout with placeholders for the sample folder and files,
+        and whether it came from the loader cache.
+        """
+        if use_cache and self.loader_cache is not None:
+            template = self.loader_cache.get(fingerprint)
+            if template is not None:
+                return template, True
+        code, _ = self._generate_code(file_content)
+        return generalize_code(code, file_content["file_dir"], file_content["files"]), False
+
+    def _store_loader(self, fingerprint: str, template: str, file_content: dict) -> None:
+        if self.loader_cache is not None:
+            self.loader_cache.put(fingerprint, template, geo_helpers.check_file_type(file_content).name)
+
+    def _execute(self, code: str) -> AnnData:
+        if self.sandbox:
+            return get_sandbox_pool().run(code)
+        return _check_adata(safe_exec_func(code, param_space={}), code)
+
+    def process_gsm(self, gsm_id: str, sample_dir: str = None, use_cache: bool = True, fast_path: bool = True) -> AnnData:
+        """
+        :param sample_dir: the directory of the sample files, defaults to `gsm_id` used as a path
+        :param use_cache: read and store the loader in the loader cache
+        :param fast_path: read standard layouts (10x, h5ad, loom) without the LLM, see `fast_read`
+        """
+        # step 1: determine whether using supp files or process fastq files
+        # file_content = geo_helpers.get_supp_data(gsm_id)
+        # if len(file_content["files"]) == 0:
+        #     raise ValueError("No supplementary file found")
+        # step 2: Anndata reading
+
+        file_content = list_files_with_content(sample_dir or gsm_id, peek_types=PEEK_TYPES)
+        if fast_path:
+            try:
+                adata = fast_read(file_content["file_dir"], file_content["files"])
+                if adata is not None:
+                    return adata
+            except Exception as e:
+                logger.warning(f"Fast path failed for {gsm_id}, prompting the LLM: {e}")
+
+        fingerprint = layout_fingerprint(file_content)
+        template, cached = self._get_loader(file_content, fingerprint, use_cache)
+        if cached:
+            try:
+                code = specialize_code(template, file_content["file_dir"], file_content["files"])
+                return self._execute(code)
+            except Exception as e:
+                logger.warning(f"Cached loader failed for {gsm_id}, prompting the LLM: {e}")
+                self.loader_cache.invalidate(fingerprint)
+                template, _ = self._get_loader(file_content, fingerprint, use_cache=False)
+
+        code = specialize_code(template, file_content["file_dir"], file_content["files"])
+        adata = self._execute(code)
+        if use_cache:
+            self._store_loader(fingerprint, template, file_content)
         return adata
 
+    def group_samples(self, sample_dirs: dict[str, str]) -> dict[str, list[tuple[str, dict]]]:
+        """
+        Group samples by the fingerprint of their file layout, see `layout_fingerprint`.
+        """
+        groups = {}
+        for gsm_id, sample_dir in sample_dirs.items():
+            file_content = list_files_with_content(sample_dir, peek_types=PEEK_TYPES)
+            groups.setdefault(layout_fingerprint(file_content), []).append((gsm_id, file_content))
+        return groups
+
+    def process_many(
+        self,
+        sample_dirs: dict[str, str],
+        output: str,
+        parallel: int = 1,
+        concat: bool = None,
+        fallback: bool = True,
+        fast_path: bool = True,
+    ) -> dict[str, str | None]:
+        """
+        Read the count matrices of many samples, asking the LLM once per group of samples
+        sharing a file layout and running the generated loader for every sample of the group.
+        :param sample_dirs: `{gsm_id: sample directory}`, e.g. from `find_sample_dirs`
+        :param output: a `.h5ad` file to write all samples concatenated, otherwise a directory
+            receiving one `<gsm_id>.h5ad` per sample
+        :param parallel: the number of sandbox worker processes running the loaders
+        :param concat: defaults to whether `output` ends with `.h5ad`
+        :param fallback: prompt the LLM for a sample on its own when the shared loader fails on it
+        :param fast_path: read standard layouts (10x, h5ad, loom) without the LLM, see `fast_read`
+        :return: the h5ad file of every sample, None for the failed ones
+        """
+        concat = output.endswith(".h5ad") if concat is None else concat
+        out_dir = tempfile.mkdtemp(prefix="geo_counts_") if concat else output
+        os.makedirs(out_dir, exist_ok=True)
+
+        groups = self.group_samples(sample_dirs)
+        logger.info(f"Reading {len(sample_dirs)} samples in {len(groups)} layout groups")
+        res = {gsm_id: None for gsm_id in sample_dirs}
+        failed = []
+        # fingerprint -> [loader, from the cache, reference files, number of samples read]
+        loaders = {}
+        with SandboxPool(n_workers=parallel) as pool, ThreadPoolExecutor(max_workers=max(1, parallel)) as executor:
+            futures = {}
+            for fingerprint, samples in groups.items():
+                ref_id, ref_content = samples[0]
+                if fast_path and detect_fast_layout(ref_content["files"]):
+                    for gsm_id, file_content in samples:
+                        out_path = os.path.join(out_dir, f"{gsm_id}.h5ad")
+                        code = _fast_reader_code(file_content["file_dir"], file_content["files"])
+                        futures[executor.submit(pool.run_to_file, code, out_path)] = (gsm_id, out_path, None)
+                    continue
+                try:
+                    template, cached = self._get_loader(ref_content, fingerprint)
+                except ValueError as e:
+                    logger.error(f"Failed to generate a loader for {[x[0] for x in samples]}: {e}")
+                    failed.extend(x[0] for x in samples)
+                    continue
+                loaders[fingerprint] = [template, cached, ref_content, 0]
+                for gsm_id, file_content in samples:
+                    sample_code = specialize_code(template, file_content["file_dir"], file_content["files"])
+                    out_path = os.path.join(out_dir, f"{gsm_id}.h5ad")
+                    futures[executor.submit(pool.run_to_file, sample_code, out_path)] = (gsm_id, out_path, fingerprint)
+
+            for future in as_completed(futures):
+                gsm_id, out_path, fingerprint = futures[future]
+                try:
+                    shape = future.result()
+                    logger.info(f"Read {gsm_id}: {shape[0]} cells x {shape[1]} genes")
+                    res[gsm_id] = out_path
+                    if fingerprint in loaders:
+                        loaders[fingerprint][3] += 1
+                except Exception as e:
+                    logger.error(f"{'Shared loader' if fingerprint else 'Fast path'} failed for {gsm_id}: {e}")
+                    failed.append(gsm_id)
+
+        # keep loaders that read at least one sample, drop cached ones that read none
+        for fingerprint, (template, cached, ref_content, n_read) in loaders.items():
+            if n_read and not cached:
+                self._store_loader(fingerprint, template, ref_content)
+            elif not n_read and cached:
+                self.loader_cache.invalidate(fingerprint)
+
+        if fallback:
+            for gsm_id in failed:
+                try:
+                    adata = self.process_gsm(gsm_id, sample_dirs[gsm_id], use_cache=False, fast_path=False)
+                    out_path = os.path.join(out_dir, f"{gsm_id}.h5ad")
+                    adata.write_h5ad(out_path)
+                    res[gsm_id] = out_path
+                except Exception as e:
+                    logger.error(f"Failed to read {gsm_id}: {e}")
+
+        if self.loader_cache is not None:
+            logger.info(f"Loader cache: {self.loader_cache.stats()}")
+
+        if concat:
+            done = {gsm_id: path for gsm_id, path in res.items() if path}
+            if done:
+                adata = ad.concat(
+                    {gsm_id: ad.read_h5ad(path) for gsm_id, path in done.items()}, label="sample", join="outer", index_unique="-"
+                )
+                adata.write_h5ad(output)
+            shutil.rmtree(out_dir, ignore_errors=True)
+            res = {gsm_id: output if path else None for gsm_id, path in res.items()}
+        return res
+
+    def process_gse(self, gse_id: str, cache_dir: str, output: str, parallel: int = 1, concat: bool = None) -> dict[str, str | None]:
+        """
+        Read the count matrices of all downloaded samples of a GSE, see `process_many`.
+        """
+        sample_dirs = find_sample_dirs(cache_dir, gse_ids=[gse_id])
+        return self.process_many(sample_dirs, output, parallel=parallel, concat=concat)
+
     def call(self, params: str, **kwargs) -> str:
         params = self._verify_args(params)
         gsm_id = params.get("id")
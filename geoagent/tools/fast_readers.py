@@ -0,0 +1,139 @@
+import gzip
+import os
+import shutil
+import tempfile
+
+import anndata as ad
+import pandas as pd
+from scipy import io as sio
+from scipy import sparse
+
+from geoagent.utils.logger import geoagent_logger as logger
+
+_TEXT_EXTENSIONS = (".tsv", ".tsv.gz", ".txt", ".txt.gz", ".csv", ".csv.gz")
+
+
+def _find(files: list[str], suffixes: tuple[str, ...], keywords: tuple[str, ...] = ()) -> list[str]:
+    return [
+        f for f in files
+        if f.lower().endswith(suffixes) and (not keywords or any(k in f.lower() for k in keywords))
+    ]
+
+
+def detect_fast_layout(files: list[str]) -> str | None:
+    """
+    Name the standard layout of the files of a sample, if they unambiguously hold one.
+    :return: `10x_mtx`, `10x_h5`, `h5ad`, `loom` or None
+    """
+    for layout, suffixes in (("h5ad", (".h5ad", ".h5ad.gz")), ("loom", (".loom", ".loom.gz")), ("10x_h5", (".h5", ".h5.gz"))):
+        if len(_find(files, suffixes)) == 1:
+            return layout
+    matrices = _find(files, (".mtx", ".mtx.gz"))
+    barcodes = _find(files, _TEXT_EXTENSIONS, ("barcodes",))
+    features = _find(files, _TEXT_EXTENSIONS, ("features", "genes"))
+    if len(matrices) == len(barcodes) == len(features) == 1:
+        return "10x_mtx"
+    return None
+
+
+def _open(path: str):
+    return gzip.open(path, "rb") if path.endswith(".gz") else open(path, "rb")
+
+
+class _LocalCopy:
+    """
+    Path of a HDF5 based file usable by h5py, gzipped files are inflated to a temporary file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.tmp_path = None
+
+    def __enter__(self) -> str:
+        if not self.path.endswith(".gz"):
+            return self.path
+        suffix = os.path.splitext(self.path.removesuffix(".gz"))[1]
+        fd, self.tmp_path = tempfile.mkstemp(suffix=suffix)
+        with os.fdopen(fd, "wb") as f_out, gzip.open(self.path, "rb") as f_in:
+            shutil.copyfileobj(f_in, f_out)
+        return self.tmp_path
+
+    def __exit__(self, *args):
+        if self.tmp_path:
+            os.remove(self.tmp_path)
+
+
+def read_10x_mtx(matrix_path: str, barcodes_path: str, features_path: str) -> ad.AnnData:
+    """
+    Read a 10x `matrix.mtx` / `barcodes.tsv` / `features.tsv` (or `genes.tsv`) triplet,
+    the file names may carry any prefix, e.g. `GSM123_A_matrix.mtx.gz`.
+    """
+    with _open(matrix_path) as f:
+        X = sparse.csr_matrix(sio.mmread(f))
+    barcodes = pd.read_csv(barcodes_path, sep="\t", header=None, dtype=str)
+    features = pd.read_csv(features_path, sep="\t", header=None, dtype=str)
+    # 10x matrices are genes x cells
+    if X.shape[0] == len(features) and X.shape[1] == len(barcodes):
+        X = X.T.tocsr()
+    elif X.shape != (len(barcodes), len(features)):
+        raise ValueError(f"Matrix shape {X.shape} does not match {len(barcodes)} barcodes and {len(features)} features")
+
+    adata = ad.AnnData(X=X)
+    adata.obs.index = barcodes[0].values
+    gene_col = 1 if features.shape[1] > 1 else 0
+    adata.var.index = features[gene_col].values
+    adata.var["gene_ids"] = features[0].values
+    if features.shape[1] > 2:
+        adata.var["feature_types"] = features[2].values
+    adata.var.index.name = "gene_names"
+    adata.obs.index.name = "cell_id"
+    adata.obs_names_make_unique()
+    adata.var_names_make_unique()
+    return adata
+
+
+def read_10x_h5(path: str) -> ad.AnnData:
+    import scanpy as sc
+
+    with _LocalCopy(path) as local_path:
+        adata = sc.read_10x_h5(local_path)
+    adata.var_names_make_unique()
+    return adata
+
+
+def read_h5ad(path: str) -> ad.AnnData:
+    # backed mode maps X from the file instead of loading it, only for uncompressed files
+    if not path.endswith(".gz"):
+        return ad.read_h5ad(path, backed="r")
+    with _LocalCopy(path) as local_path:
+        return ad.read_h5ad(local_path)
+
+
+def read_loom(path: str) -> ad.AnnData:
+    with _LocalCopy(path) as local_path:
+        adata = ad.read_loom(local_path, sparse=True)
+    adata.var_names_make_unique()
+    return adata
+
+
+def fast_read(sample_dir: str, files: list[str]) -> ad.AnnData | None:
+    """
+    Read a sample laid out in a standard format without the LLM.
+    :return: None when the layout is not a standard one, errors of the readers are raised
+    """
+    layout = detect_fast_layout(files)
+    if layout is None:
+        return None
+    logger.info(f"Reading {sample_dir} as {layout}")
+    path = lambda x: os.path.join(sample_dir, x)  # noqa: E731
+    if layout == "10x_mtx":
+        return read_10x_mtx(
+            path(_find(files, (".mtx", ".mtx.gz"))[0]),
+            path(_find(files, _TEXT_EXTENSIONS, ("barcodes",))[0]),
+            path(_find(files, _TEXT_EXTENSIONS, ("features", "genes"))[0]),
+        )
+    if layout == "10x_h5":
+        return read_10x_h5(path(_find(files, (".h5", ".h5.gz"))[0]))
+    if layout == "h5ad":
+        return read_h5ad(path(_find(files, (".h5ad", ".h5ad.gz"))[0]))
+    return read_loom(path(_find(files, (".loom", ".loom.gz"))[0]))
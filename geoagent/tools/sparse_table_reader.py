@@ -0,0 +1,105 @@
+import gzip
+import itertools
+
+import anndata as ad
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from geoagent.utils.layout_helpers import guess_delimiter
+from geoagent.utils.logger import geoagent_logger as logger
+
+# dense values held in memory at once while reading a table
+DEFAULT_CHUNK_BYTES = 256 * 1024**2
+
+
+def _compact_int_dtype(min_value: int, max_value: int) -> np.dtype:
+    for dtype in (np.uint8, np.uint16, np.uint32) if min_value >= 0 else (np.int8, np.int16, np.int32):
+        info = np.iinfo(dtype)
+        if info.min <= min_value and max_value <= info.max:
+            return np.dtype(dtype)
+    return np.dtype(np.int64)
+
+
+def _sniff_sep(filepath: str) -> str:
+    opener = gzip.open if filepath.endswith(".gz") else open
+    with opener(filepath, "rt") as f:
+        delimiter = guess_delimiter(list(itertools.islice(f, 5)))
+    # runs of spaces are one delimiter in space aligned tables
+    return r"\s+" if delimiter in (" ", None) else delimiter
+
+
+def _chunk_rows(n_cols: int, chunk_bytes: int) -> int:
+    return max(1, chunk_bytes // (max(n_cols, 1) * 8))
+
+
+def read_count_table(
+    filepath: str,
+    cell_by_gene: bool,
+    drop_columns: list[str] = None,
+    drop_non_numeric: bool = True,
+    integer: bool = True,
+    chunk_bytes: int = DEFAULT_CHUNK_BYTES,
+    **read_csv_kwargs,
+) -> ad.AnnData:
+    """
+    Read a dense count table (csv / tsv, optionally gzipped) into a sparse AnnData.
+
+    The table is read in chunks of rows sized by `chunk_bytes`, each chunk is turned
+    into CSR right away, so only one dense chunk is in memory at a time instead of
+    the whole matrix.
+    :param filepath: the table, the row labels are taken from `index_col` (default: the first column)
+    :param cell_by_gene: whether rows are cells and columns genes, otherwise the table is transposed
+    :param drop_columns: columns holding metadata rather than counts
+    :param drop_non_numeric: also drop columns that are not numeric in the first chunk
+    :param integer: cast the counts to integers, as `astype(int)` does
+    :param read_csv_kwargs: passed to `pd.read_csv`, e.g. `sep`, `header`, `skiprows`
+    """
+    read_csv_kwargs.setdefault("index_col", 0)
+    if "sep" not in read_csv_kwargs and "delimiter" not in read_csv_kwargs:
+        read_csv_kwargs["sep"] = _sniff_sep(filepath)
+
+    header = pd.read_csv(filepath, nrows=1, **read_csv_kwargs)
+    chunksize = _chunk_rows(header.shape[1], chunk_bytes)
+    logger.info(f"Reading {filepath} in chunks of {chunksize} rows")
+
+    row_labels, blocks = [], []
+    columns, keep = None, None
+    min_value, max_value = 0, 0
+    for chunk in pd.read_csv(filepath, chunksize=chunksize, **read_csv_kwargs):
+        if keep is None:
+            keep = [c for c in chunk.columns if c not in set(drop_columns or [])]
+            if drop_non_numeric:
+                keep = [c for c in keep if pd.api.types.is_numeric_dtype(chunk[c])]
+            dropped = [c for c in chunk.columns if c not in set(keep)]
+            if dropped:
+                logger.info(f"Dropping {len(dropped)} metadata columns: {dropped[:10]}")
+            columns = pd.Index(keep)
+        values = chunk[keep].to_numpy()
+        if integer:
+            values = values.astype(np.int64)
+        block = sparse.csr_matrix(values)
+        if block.nnz:
+            min_value, max_value = min(min_value, block.data.min()), max(max_value, block.data.max())
+        if integer:
+            block.data = block.data.astype(_compact_int_dtype(block.data.min(initial=0), block.data.max(initial=0)))
+        blocks.append(block)
+        row_labels.append(chunk.index)
+
+    if not blocks:
+        raise ValueError(f"No rows found in {filepath}")
+    X = sparse.vstack(blocks, format="csr")
+    if integer:
+        X.data = X.data.astype(_compact_int_dtype(min_value, max_value))
+    index = row_labels[0].append(row_labels[1:]) if len(row_labels) > 1 else row_labels[0]
+
+    if not cell_by_gene:
+        X, index, columns = X.T.tocsr(), columns, index
+    adata = ad.AnnData(X=X)
+    adata.var.index = columns.map(str)
+    adata.obs.index = index.map(str)
+    adata.var.index.name = "gene_names"
+    adata.obs.index.name = "cell_id"
+    adata.obs_names_make_unique()
+    adata.var_names_make_unique()
+    return adata
@@ -7,4 +7,5 @@ class FileType(Enum):
     TABLE = 3
     H5 = 4
     H5AD = 5
-    UNKNOWN = 6
\ No newline at end of file
+    UNKNOWN = 6
+    LOOM = 7
\ No newline at end of file
@@ -0,0 +1,302 @@
+import bz2
+import gzip
+import io
+import json
+import lzma
+import os
+import shutil
+import tarfile
+from typing import Callable, NamedTuple
+
+from geoagent.utils.http_helpers import REQUEST_TIMEOUT, get_session
+from geoagent.utils.logger import geoagent_logger as logger
+
+# members the count-matrix readers can use, RAW reads, BAMs and R objects stay in the archive
+EXTRACT_EXTENSIONS = (".mtx", ".tsv", ".csv", ".txt", ".h5", ".h5ad", ".loom")
+_INDEX_SUFFIX = ".members.json"
+_MAGIC = ((b"\x1f\x8b", gzip.open), (b"BZh", bz2.open), (b"\xfd7zXZ\x00", lzma.open))
+# the NCBI FTP site is also served over HTTPS, which supports range requests
+_NCBI_FTP = "ftp://ftp.ncbi.nlm.nih.gov/"
+_NCBI_HTTPS = "https://ftp.ncbi.nlm.nih.gov/"
+
+
+class ArchiveMember(NamedTuple):
+    name: str
+    size: int
+    # offset of the member header and of its data, in the uncompressed tar stream
+    offset: int
+    offset_data: int
+
+
+def is_wanted_member(name: str, extensions: tuple[str, ...] = EXTRACT_EXTENSIONS) -> bool:
+    return name.lower().removesuffix(".gz").endswith(extensions)
+
+
+def index_path(archive_path: str) -> str:
+    """
+    Path of the member index of an archive, a hidden file next to it so it is not listed as a sample file.
+    """
+    directory, name = os.path.split(archive_path)
+    return os.path.join(directory, f".{name}{_INDEX_SUFFIX}")
+
+
+def is_index_file(filename: str) -> bool:
+    return filename.startswith(".") and filename.endswith(_INDEX_SUFFIX)
+
+
+def _open_raw(archive_path: str):
+    """
+    Open the uncompressed tar stream of an archive, compressed streams are seekable (by inflating up to the offset).
+    """
+    with open(archive_path, "rb") as f:
+        magic = f.read(6)
+    for prefix, opener in _MAGIC:
+        if magic.startswith(prefix):
+            return opener(archive_path, "rb")
+    return open(archive_path, "rb")
+
+
+def _archive_key(archive_path: str) -> dict:
+    stat = os.stat(archive_path)
+    return {"size": stat.st_size, "mtime": stat.st_mtime}
+
+
+def _write_index(archive_path: str, members: list[ArchiveMember]) -> None:
+    path = index_path(archive_path)
+    tmp_path = f"{path}.part"
+    with open(tmp_path, "w") as f:
+        json.dump({**_archive_key(archive_path), "members": [list(m) for m in members]}, f)
+    os.replace(tmp_path, path)
+
+
+def cached_member_index(archive_path: str) -> list[ArchiveMember] | None:
+    """
+    Return the member index of an archive if one was recorded for its current size and mtime.
+    """
+    try:
+        with open(index_path(archive_path)) as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if {k: index.get(k) for k in ("size", "mtime")} != _archive_key(archive_path):
+        return None
+    return [ArchiveMember(*m) for m in index["members"]]
+
+
+def _scan(archive_path: str, on_member=None) -> list[ArchiveMember]:
+    # stream mode reads the archive once front to back, without building tarfile's member list
+    members = []
+    with tarfile.open(archive_path, "r|*") as tar:
+        for info in tar:
+            if not info.isfile():
+                continue
+            members.append(ArchiveMember(info.name, info.size, info.offset, info.offset_data))
+            if on_member is not None:
+                on_member(tar, info)
+    _write_index(archive_path, members)
+    return members
+
+
+def index_archive(archive_path: str) -> list[ArchiveMember]:
+    """
+    List the file members of a tar archive without extracting them, the index is recorded
+    next to the archive and reused while the archive is unchanged.
+    """
+    members = cached_member_index(archive_path)
+    if members is None:
+        members = _scan(archive_path)
+    return members
+
+
+def _destination(name: str, taken: set[str]) -> str:
+    # members are flattened into the sample folder, clashing basenames keep their folder as prefix
+    filename = os.path.basename(name)
+    if filename in taken:
+        filename = name.strip("/").replace("/", "_")
+    taken.add(filename)
+    return filename
+
+
+def extract_members(
+    archive_path: str,
+    directory: str = None,
+    extensions: tuple[str, ...] = EXTRACT_EXTENSIONS,
+) -> list[str]:
+    """
+    Extract the members of a tar archive with one of `extensions` into `directory`
+    (default: the folder of the archive) in a single streaming pass, and record the
+    member index on the way. Members already extracted with the same size are not rewritten.
+
+    Examples:
+    ```python
+    >>> extract_members("GSE123/GSE123_RAW.tar")
+    ['GSM1_matrix.mtx.gz', 'GSM1_barcodes.tsv.gz', 'GSM1_features.tsv.gz']
+    ```
+    :return: the names of the extracted files, relative to `directory`
+    """
+    directory = directory or os.path.dirname(archive_path)
+    extracted, skipped = [], 0
+    taken = set()
+
+    def on_member(tar: tarfile.TarFile, info: tarfile.TarInfo):
+        nonlocal skipped
+        if not is_wanted_member(info.name, extensions):
+            skipped += 1
+            return
+        filename = _destination(info.name, taken)
+        dest = os.path.join(directory, filename)
+        if not (os.path.isfile(dest) and os.path.getsize(dest) == info.size):
+            tmp_dest = f"{dest}.part"
+            with tar.extractfile(info) as src, open(tmp_dest, "wb") as dst:
+                shutil.copyfileobj(src, dst)
+            os.replace(tmp_dest, dest)
+        extracted.append(filename)
+
+    members = _scan(archive_path, on_member)
+    logger.info(
+        f"Extracted {len(extracted)} of {len(members)} members of {os.path.basename(archive_path)}, skipped {skipped}"
+    )
+    return extracted
+
+
+class _MemberFile(io.RawIOBase):
+    """
+    Read-only, seekable view on the bytes of one member inside the tar stream.
+    """
+
+    def __init__(self, fileobj, offset: int, size: int):
+        self._f = fileobj
+        self._offset = offset
+        self._size = size
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, pos: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._pos, io.SEEK_END: self._size}[whence]
+        self._pos = min(max(base + pos, 0), self._size)
+        return self._pos
+
+    def readinto(self, buffer) -> int:
+        n = min(len(buffer), self._size - self._pos)
+        if n <= 0:
+            return 0
+        self._f.seek(self._offset + self._pos)
+        data = self._f.read(n)
+        buffer[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+    def close(self) -> None:
+        if not self.closed:
+            self._f.close()
+        super().close()
+
+
+def open_member(archive_path: str, name: str) -> io.BufferedReader:
+    """
+    Open a member of a tar archive for reading straight from the archive, using the
+    recorded data offset. The handle is seekable, so h5py can read `.h5` members.
+    A gzipped member is returned as stored, wrap it in `gzip.GzipFile` to read its content.
+    """
+    for member in index_archive(archive_path):
+        if member.name == name:
+            return io.BufferedReader(_MemberFile(_open_raw(archive_path), member.offset_data, member.size))
+    raise KeyError(f"{name} is not a member of {archive_path}")
+
+
+def https_url(url: str) -> str:
+    return _NCBI_HTTPS + url[len(_NCBI_FTP):] if url.startswith(_NCBI_FTP) else url
+
+
+def _read_range(url: str, start: int, length: int) -> bytes:
+    response = get_session().get(
+        url, headers={"Range": f"bytes={start}-{start + length - 1}"}, timeout=REQUEST_TIMEOUT
+    )
+    response.raise_for_status()
+    if response.status_code != 206:
+        raise OSError(f"{url} does not support range requests")
+    return response.content
+
+
+def _pax_path(data: bytes) -> str | None:
+    # pax records are `<length> <key>=<value>\n`
+    for record in data.decode("utf-8", "replace").splitlines():
+        key, _, value = record.partition(" ")[2].partition("=")
+        if key == "path":
+            return value
+    return None
+
+
+def index_remote_tar(url: str) -> list[ArchiveMember]:
+    """
+    List the file members of an uncompressed tar archive on a server, reading only the
+    512 byte member headers with range requests, e.g. a GEO `_RAW.tar` of hundreds of GB.
+    """
+    url = https_url(url)
+    members = []
+    offset, long_name, header_offset = 0, None, None
+    while True:
+        header = _read_range(url, offset, tarfile.BLOCKSIZE)
+        if len(header) < tarfile.BLOCKSIZE or header == tarfile.NUL * tarfile.BLOCKSIZE:
+            break
+        info = tarfile.TarInfo.frombuf(header, tarfile.ENCODING, "surrogateescape")
+        offset_data = offset + tarfile.BLOCKSIZE
+        if info.type in (tarfile.GNUTYPE_LONGNAME, tarfile.XHDTYPE):
+            # the name of the next member is held in this member's data
+            data = _read_range(url, offset_data, info.size)
+            long_name = data.rstrip(tarfile.NUL).decode("utf-8", "surrogateescape") if info.type == tarfile.GNUTYPE_LONGNAME else _pax_path(data)
+            # like tarfile, the member starts at its first extended header
+            header_offset = offset if header_offset is None else header_offset
+        else:
+            if info.isfile():
+                members.append(ArchiveMember(long_name or info.name, info.size, offset if header_offset is None else header_offset, offset_data))
+            long_name, header_offset = None, None
+        offset = offset_data + -(-info.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+    return members
+
+
+def fetch_tar_members(
+    url: str,
+    directory: str,
+    is_wanted: Callable[[ArchiveMember], bool] = None,
+    chunk_size: int = 1024 * 1024,
+) -> list[str]:
+    """
+    Download only the wanted members of a remote tar archive, each with one range
+    request on its bytes, instead of the whole archive.
+    Members are flattened into `directory` as `extract_members` does.
+    :param is_wanted: selects the members to fetch, by default those with `EXTRACT_EXTENSIONS`
+    :return: the names of the fetched files, relative to `directory`
+    """
+    members = index_remote_tar(url)
+    wanted = [m for m in members if (is_wanted(m) if is_wanted is not None else is_wanted_member(m.name))]
+    logger.info(f"Fetching {len(wanted)} of {len(members)} members of {os.path.basename(url)}")
+    os.makedirs(directory, exist_ok=True)
+    fetched, taken = [], set()
+    for member in wanted:
+        filename = _destination(member.name, taken)
+        dest = os.path.join(directory, filename)
+        if not (os.path.isfile(dest) and os.path.getsize(dest) == member.size):
+            tmp_dest = f"{dest}.part"
+            headers = {"Range": f"bytes={member.offset_data}-{member.offset_data + member.size - 1}"}
+            with get_session().get(https_url(url), headers=headers, stream=True, timeout=REQUEST_TIMEOUT) as response:
+                response.raise_for_status()
+                if response.status_code != 206:
+                    raise OSError(f"{url} does not support range requests")
+                with open(tmp_dest, "wb") as f:
+                    for chunk in response.iter_content(chunk_size=chunk_size):
+                        f.write(chunk)
+            if os.path.getsize(tmp_dest) != member.size:
+                os.remove(tmp_dest)
+                raise OSError(f"Incomplete member {member.name} of {url}")
+            os.replace(tmp_dest, dest)
+        fetched.append(filename)
+    return fetched
@@ -1,5 +1,255 @@
+import importlib
+import math
+import multiprocessing
+import os
+import queue
+import resource
+import shutil
+import signal
+import tempfile
+import threading
+import traceback
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING
+
+from geoagent.utils.file_helpers import parse_size
+from geoagent.utils.logger import geoagent_logger as logger
+
+if TYPE_CHECKING:
+    from anndata import AnnData
+
+# modules imported once by every sandbox worker, so loaders do not pay for them
+DEFAULT_PRELOAD = ("numpy", "pandas", "scipy.sparse", "anndata", "scanpy")
+SANDBOX_WORKERS = int(os.getenv("GEO_SANDBOX_WORKERS", 1))
+# results are handed over as h5ad files, on tmpfs when it has room for them
+_SHM_DIR = "/dev/shm"
+_SHM_MIN_FREE = 2 * 1024**3
+# share of the physical memory a worker may map when GEO_SANDBOX_MAX_MEMORY is not set
+DEFAULT_MEMORY_FRACTION = float(os.getenv("GEO_SANDBOX_MEMORY_FRACTION", 0.5))
+
+
 def safe_exec_func(code_string: str, param_space=None):
     param_space = {}
     # TODO: make sure the code is safe to execute
     exec(code_string, param_space)
-    return param_space
\ No newline at end of file
+    return param_space
+
+
+class SandboxError(Exception):
+    pass
+
+
+def _default_max_memory() -> int | str | None:
+    # `0` disables the limit
+    if os.getenv("GEO_SANDBOX_MAX_MEMORY"):
+        return os.getenv("GEO_SANDBOX_MAX_MEMORY")
+    try:
+        physical = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        return None
+    return int(physical * DEFAULT_MEMORY_FRACTION)
+
+
+@dataclass
+class SandboxLimits:
+    """
+    Limits of one loader run, `None` disables a limit.
+    :param cpu_seconds: CPU time of the run (RLIMIT_CPU, the worker is killed by SIGXCPU)
+    :param wall_seconds: wall-clock time of the run, the worker is killed past it
+    :param max_memory: virtual address space of the worker (RLIMIT_AS), e.g. `16G`, by default
+        `DEFAULT_MEMORY_FRACTION` of the physical memory. This bounds mapped memory, not the
+        resident set, so it has to leave headroom for what numpy and BLAS reserve without touching.
+    """
+    cpu_seconds: int | None = field(default_factory=lambda: int(os.getenv("GEO_SANDBOX_CPU_SECONDS", 1800)))
+    wall_seconds: float | None = field(default_factory=lambda: float(os.getenv("GEO_SANDBOX_WALL_SECONDS", 3600)))
+    max_memory: int | str | None = field(default_factory=_default_max_memory)
+
+    def __post_init__(self):
+        self.max_memory = parse_size(self.max_memory)
+
+
+def default_tmp_dir() -> str:
+    tmp_dir = os.getenv("GEO_SANDBOX_TMP")
+    if tmp_dir:
+        return tmp_dir
+    if os.path.isdir(_SHM_DIR) and os.access(_SHM_DIR, os.W_OK) and shutil.disk_usage(_SHM_DIR).free > _SHM_MIN_FREE:
+        return _SHM_DIR
+    return tempfile.gettempdir()
+
+
+def _worker_main(conn, preload: tuple[str, ...], max_memory: int | None) -> None:
+    for module in preload:
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            pass
+    from anndata import AnnData
+
+    if max_memory:
+        resource.setrlimit(resource.RLIMIT_AS, (max_memory, max_memory))
+    conn.send(("ready", None))
+
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            return
+        if task is None:
+            return
+        code, out_path, cpu_seconds = task
+        try:
+            if cpu_seconds:
+                # the limit is on the CPU time of the process, so it is moved past what previous runs used
+                usage = resource.getrusage(resource.RUSAGE_SELF)
+                _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+                resource.setrlimit(resource.RLIMIT_CPU, (math.ceil(usage.ru_utime + usage.ru_stime) + cpu_seconds, hard))
+            adata = safe_exec_func(code, param_space={}).get("adata")
+            if not isinstance(adata, AnnData):
+                raise ValueError("The code did not produce an `adata` AnnData object")
+            adata.write_h5ad(out_path)
+            conn.send(("ok", tuple(adata.shape)))
+        except BaseException:
+            conn.send(("error", traceback.format_exc()))
+
+
+class _Worker:
+    def __init__(self, ctx, preload: tuple[str, ...], max_memory: int | None):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_main, args=(child_conn, preload, max_memory), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.ready = False
+
+    def _recv(self, timeout: float | None):
+        if not self.conn.poll(timeout):
+            raise TimeoutError
+        return self.conn.recv()
+
+    def run(self, code: str, out_path: str, limits: SandboxLimits) -> tuple[str, object]:
+        if not self.ready:
+            # the preloaded imports do not count against the limits of the first run
+            self._recv(None)
+            self.ready = True
+        self.conn.send((code, out_path, limits.cpu_seconds))
+        return self._recv(limits.wall_seconds)
+
+    def describe_exit(self) -> str:
+        self.process.join(timeout=1)
+        code = self.process.exitcode
+        if code == -signal.SIGXCPU:
+            return "exceeded the CPU time limit"
+        if code == -signal.SIGKILL:
+            return "was killed, most likely out of memory"
+        return f"exited with code {code}"
+
+    def close(self, kill: bool = False) -> None:
+        if not kill:
+            try:
+                self.conn.send(None)
+                self.process.join(timeout=5)
+            except OSError:
+                pass
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+
+class SandboxPool:
+    """
+    Pool of warm worker processes running generated loader code under CPU, wall-clock
+    and memory limits. A worker that crashes or times out is replaced, the caller gets
+    a `SandboxError` and the other workers are not affected.
+
+    The `adata` built by the code is written to an h5ad file, on tmpfs by default,
+    instead of being pickled through a pipe.
+
+    Examples:
+    ```python
+    >>> with SandboxPool(n_workers=4, limits=SandboxLimits(max_memory="32G")) as pool:
+    >>>     adata = pool.run(code)
+    >>>     pool.run_to_file(code, "/data/GSM123.h5ad")
+    ```
+    """
+
+    def __init__(
+        self,
+        n_workers: int = SANDBOX_WORKERS,
+        limits: SandboxLimits = None,
+        preload: tuple[str, ...] = DEFAULT_PRELOAD,
+        tmp_dir: str = None,
+    ):
+        self.limits = limits or SandboxLimits()
+        self.preload = preload
+        self.tmp_dir = tmp_dir or default_tmp_dir()
+        # spawned workers do not inherit the threads and sockets of a web server
+        self._ctx = multiprocessing.get_context("spawn")
+        self._workers = queue.Queue()
+        for _ in range(max(1, n_workers)):
+            self._workers.put(self._new_worker())
+
+    def _new_worker(self) -> _Worker:
+        return _Worker(self._ctx, self.preload, self.limits.max_memory)
+
+    def run_to_file(self, code: str, out_path: str) -> tuple[int, int]:
+        """
+        Run loader code and write its `adata` to `out_path`.
+        :return: the shape of the AnnData
+        """
+        worker = self._workers.get()
+        try:
+            status, payload = worker.run(code, out_path, self.limits)
+        except TimeoutError:
+            worker.close(kill=True)
+            worker = self._new_worker()
+            raise SandboxError(f"Loader exceeded the wall-clock limit of {self.limits.wall_seconds}s")
+        except (EOFError, OSError):
+            reason = worker.describe_exit()
+            worker.close(kill=True)
+            worker = self._new_worker()
+            raise SandboxError(f"Loader worker {reason}")
+        finally:
+            self._workers.put(worker)
+        if status == "error":
+            raise SandboxError(payload)
+        return payload
+
+    def run(self, code: str) -> "AnnData":
+        """
+        Run loader code and return its `adata`.
+        """
+        import anndata as ad
+
+        fd, out_path = tempfile.mkstemp(suffix=".h5ad", dir=self.tmp_dir)
+        os.close(fd)
+        try:
+            self.run_to_file(code, out_path)
+            return ad.read_h5ad(out_path)
+        finally:
+            os.remove(out_path)
+
+    def close(self) -> None:
+        while not self._workers.empty():
+            self._workers.get().close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+_sandbox_pool = None
+_sandbox_pool_lock = threading.Lock()
+
+
+def get_sandbox_pool() -> SandboxPool:
+    """
+    Return the process-wide sandbox pool, its workers are started on first use.
+    """
+    global _sandbox_pool
+    with _sandbox_pool_lock:
+        if _sandbox_pool is None:
+            logger.info(f"Starting {SANDBOX_WORKERS} sandbox workers")
+            _sandbox_pool = SandboxPool()
+        return _sandbox_pool
@@ -0,0 +1,248 @@
+import ftplib
+import os
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, replace
+from typing import TYPE_CHECKING
+from urllib.parse import urlparse
+
+from tqdm import tqdm
+
+from geoagent.utils.downloader import DEFAULT_MAX_PER_HOST, DownloadFilter, DownloadTask
+from geoagent.utils.file_helpers import get_remote_file_info, parse_size
+from geoagent.utils.file_inventory import file_type
+from geoagent.utils.http_helpers import REQUEST_TIMEOUT, get_session
+from geoagent.utils.logger import geoagent_logger as logger
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+# size queries are tiny, more of them run at once than transfers do
+PLAN_PARALLEL = int(os.getenv("GEO_PLAN_PARALLEL", 16))
+
+
+class _HostConnections:
+    """
+    At most `max_per_host` concurrent size queries per host. FTP connections are kept
+    open and handed from one query to the next, so a host sees at most `max_per_host`
+    sessions instead of one login per file.
+    """
+
+    def __init__(self, max_per_host: int, timeout: float):
+        self.max_per_host = max(1, max_per_host)
+        self.timeout = timeout
+        self._slots: dict[str, threading.BoundedSemaphore] = {}
+        self._idle: dict[str, list[ftplib.FTP]] = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def _slot(self, host: str) -> threading.BoundedSemaphore:
+        with self._lock:
+            if host not in self._slots:
+                self._slots[host] = threading.BoundedSemaphore(self.max_per_host)
+            return self._slots[host]
+
+    def _take_ftp(self, host: str) -> ftplib.FTP:
+        with self._lock:
+            if self._idle[host]:
+                return self._idle[host].pop()
+        ftp = ftplib.FTP(host, timeout=self.timeout)
+        ftp.login()
+        ftp.voidcmd("TYPE I")
+        return ftp
+
+    def remote_size(self, url: str) -> int | None:
+        parsed = urlparse(url)
+        with self._slot(parsed.netloc):
+            if parsed.scheme != "ftp":
+                response = get_session().head(url, allow_redirects=True, timeout=self.timeout)
+                response.raise_for_status()
+                size = response.headers.get("Content-Length")
+                return int(size) if size is not None else None
+            ftp = self._take_ftp(parsed.hostname)
+            try:
+                size = get_remote_file_info(url, ftp=ftp)["size"]
+            except ftplib.error_perm:
+                # e.g. the file is missing, the connection is still usable
+                with self._lock:
+                    self._idle[parsed.hostname].append(ftp)
+                raise
+            except Exception:
+                ftp.close()
+                raise
+            with self._lock:
+                self._idle[parsed.hostname].append(ftp)
+            return size
+
+    def close(self) -> None:
+        with self._lock:
+            for connections in self._idle.values():
+                for ftp in connections:
+                    try:
+                        ftp.quit()
+                    except (OSError, ftplib.Error):
+                        ftp.close()
+            self._idle.clear()
+
+
+def fetch_remote_sizes(
+    urls: list[str],
+    parallel: int = PLAN_PARALLEL,
+    max_per_host: int = DEFAULT_MAX_PER_HOST,
+    timeout: float = REQUEST_TIMEOUT,
+    show_progress: bool = True,
+) -> dict[str, int | None]:
+    """
+    Query the size of many remote files concurrently, with FTP SIZE or HTTP HEAD.
+    :return: the size of every url, None when the server did not tell it
+    """
+    urls = list(dict.fromkeys(urls))
+    connections = _HostConnections(max_per_host, timeout)
+
+    def _size(url: str) -> int | None:
+        try:
+            return connections.remote_size(url)
+        except Exception as e:
+            logger.error(f"Failed to get the size of {url} due to {e}")
+            return None
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, parallel)) as executor:
+            sizes = list(tqdm(executor.map(_size, urls), total=len(urls), desc="Querying file sizes", disable=not show_progress))
+    finally:
+        connections.close()
+    return dict(zip(urls, sizes))
+
+
+@dataclass
+class DownloadPlan:
+    """
+    The files selected for download and the files left out, with the reason.
+    """
+    tasks: list[DownloadTask] = field(default_factory=list)
+    skipped: list[tuple[DownloadTask, str]] = field(default_factory=list)
+    # archives of which only the wanted members are fetched, their size is not counted
+    split_archives: set[str] = field(default_factory=set)
+
+    def to_frame(self) -> "pd.DataFrame":
+        """
+        One row per file: `url`, `series`, `geo_id`, `level` (`series` for GSE level files, `sample` for
+        GSM level files), `type`, `size`, `data_dir` and `skipped` (the reason, if any).
+        """
+        import pandas as pd
+
+        rows = [(task, None) for task in self.tasks] + self.skipped
+        return pd.DataFrame(
+            [
+                {
+                    "url": task.url,
+                    "series": task.series,
+                    "geo_id": task.geo_id,
+                    "level": "sample" if str(task.geo_id).startswith("GSM") else "series",
+                    "type": file_type(os.path.basename(task.url)),
+                    "size": task.size,
+                    "data_dir": task.data_dir,
+                    "skipped": reason,
+                }
+                for task, reason in rows
+            ],
+            columns=["url", "series", "geo_id", "level", "type", "size", "data_dir", "skipped"],
+        ).astype({"size": "Int64"})
+
+    def summary(self) -> dict:
+        """
+        Bytes to download in total, per file type, per series and per sample.
+        Sample figures only count GSM level files, the GSE level files of a series are reported apart.
+        """
+        frame = self.to_frame()
+        split = frame["url"].isin(self.split_archives)
+        selected = frame[frame["skipped"].isna() & ~split]
+        samples = selected[selected["level"] == "sample"]
+        per_sample = samples.groupby("geo_id")["size"].sum()
+        # samples with a file of unknown size would pull the mean down
+        known = per_sample.drop(samples.loc[samples["size"].isna(), "geo_id"].unique())
+        as_dict = lambda x: {k: int(v) for k, v in x.sort_values(ascending=False).items()}  # noqa: E731
+        return {
+            "files": len(selected),
+            "split_archives": int(split.sum()),
+            "bytes": int(selected["size"].sum()),
+            "files_without_size": int(selected["size"].isna().sum()),
+            "skipped": {k: int(v) for k, v in frame["skipped"].value_counts().items()},
+            "bytes_per_type": as_dict(selected.groupby("type")["size"].sum()),
+            "bytes_per_series": as_dict(selected.groupby("series")["size"].sum()),
+            "bytes_series_level": as_dict(selected[selected["level"] == "series"].groupby("geo_id")["size"].sum()),
+            "bytes_per_sample": as_dict(per_sample),
+            "mean_bytes_per_sample": int(known.mean()) if len(known) else None,
+        }
+
+
+def plan_downloads(
+    tasks: list[DownloadTask],
+    file_types: list[str] = None,
+    max_file_size: int | str = None,
+    budget: int | str = None,
+    file_filter: DownloadFilter = None,
+    fetch_sizes: bool = True,
+    parallel: int = PLAN_PARALLEL,
+    max_per_host: int = DEFAULT_MAX_PER_HOST,
+) -> DownloadPlan:
+    """
+    Select the files to download before transferring anything.
+
+    Examples:
+    ```python
+    >>> # only count matrices, no file above 5G and 200G in total
+    >>> plan = plan_downloads(tasks, file_types=["mtx", "h5", "tsv"], max_file_size="5G", budget="200G")
+    >>> plan.summary()["bytes_per_series"]
+    ```
+    :param file_types: file types to keep, compression aside, e.g. `mtx` keeps `x_matrix.mtx.gz`
+    :param max_file_size: skip files above this size, e.g. `5G`
+    :param budget: stop selecting files once their total size would exceed this, e.g. `200G`
+    :param file_filter: further include / exclude rules, `file_types` and `max_file_size` take precedence
+    :param fetch_sizes: query the size of the tasks without one, with a size limit files of unknown size are skipped
+    """
+    budget = parse_size(budget)
+    file_filter = replace(
+        file_filter or DownloadFilter(),
+        **({"include_types": file_types} if file_types else {}),
+        **({"max_size": max_file_size} if max_file_size is not None else {}),
+    )
+    plan = DownloadPlan()
+
+    candidates = []
+    for task in tasks:
+        reason = file_filter.name_reason(os.path.basename(task.url))
+        if reason is not None:
+            plan.skipped.append((task, reason))
+        else:
+            candidates.append(task)
+
+    if fetch_sizes:
+        sizes = fetch_remote_sizes(
+            [task.url for task in candidates if task.size is None], parallel=parallel, max_per_host=max_per_host
+        )
+        for task in candidates:
+            if task.size is None:
+                task.size = sizes.get(task.url)
+
+    total = 0
+    for task in candidates:
+        if file_filter.splits_archive(task.url):
+            # only the wanted members of the archive are fetched, their size is not known yet
+            plan.tasks.append(task)
+            plan.split_archives.add(task.url)
+            continue
+        reason = file_filter.size_reason(task.size)
+        if reason is None and task.size is None and budget is not None:
+            # could be the one huge RAW tarball, do not let it through a size limit
+            reason = "unknown size"
+        elif reason is None and budget is not None and total + task.size > budget:
+            reason = "budget"
+        if reason is not None:
+            plan.skipped.append((task, reason))
+        else:
+            total += task.size or 0
+            plan.tasks.append(task)
+
+    logger.info(f"Planned {len(plan.tasks)} of {len(tasks)} files, {total} bytes")
+    return plan
@@ -0,0 +1,351 @@
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from geoagent.utils.downloader import DEFAULT_MAX_PER_HOST, DownloadFilter, DownloadResult, DownloadTask, ParallelDownloader
+from geoagent.utils.file_inventory import get_file_inventory
+from geoagent.utils.geo_cache import get_geo_cache
+from geoagent.utils.geo_helpers import get_supp_file_tasks
+from geoagent.utils.logger import geoagent_logger as logger
+
+DOWNLOAD_QUEUE_DB_FILE = ".download_queue.db"
+DEFAULT_MAX_ATTEMPTS = int(os.getenv("GEO_DOWNLOAD_MAX_ATTEMPTS", 3))
+# file states, `queued` files are picked up by the next round of a run
+PENDING, RUNNING, DONE, FAILED, SKIPPED = "queued", "running", "done", "failed", "skipped"
+
+
+class DownloadQueue:
+    """
+    Persistent queue of supplementary file downloads under a download directory.
+
+    Accessions are submitted as jobs, a run lists the files of new jobs and
+    downloads every queued file through one shared `ParallelDownloader`. The
+    status and attempts of every file are kept in SQLite, so failed files are
+    retried by later rounds, and an interrupted run resumes where it stopped.
+    Every round makes a single transfer attempt per file, so `max_attempts` bounds
+    the transfers of a file, and jobs submitted while a run is active are picked
+    up by its next round. A job whose files cannot be listed (e.g. its SOFT file
+    is unavailable) stays new and is listed again, up to `max_attempts` times.
+
+    Examples:
+    ```python
+    >>> queue = DownloadQueue("/data/immunity")
+    >>> queue.submit(["GSE123", "GSE456"])
+    >>> queue.run(parallel=8)
+    >>> queue.progress()
+    ```
+    """
+
+    def __init__(self, root: str, db_path: str = None):
+        self.root = root
+        self.db_path = db_path or os.path.join(root, DOWNLOAD_QUEUE_DB_FILE)
+        os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+        self._run_lock = threading.Lock()
+        with self._connect() as conn:
+            conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    accession TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    n_files INTEGER,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    finished_at REAL
+                );
+                CREATE TABLE IF NOT EXISTS files (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    job_id INTEGER NOT NULL,
+                    url TEXT NOT NULL,
+                    data_dir TEXT NOT NULL,
+                    geo_id TEXT,
+                    series TEXT,
+                    size INTEGER,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    error TEXT,
+                    finished_at REAL,
+                    UNIQUE (url, data_dir)
+                );
+                CREATE TABLE IF NOT EXISTS runs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    started_at REAL NOT NULL,
+                    finished_at REAL,
+                    max_attempts INTEGER
+                );
+                CREATE INDEX IF NOT EXISTS files_status ON files (status);
+                CREATE INDEX IF NOT EXISTS files_job ON files (job_id);
+                """
+            )
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def submit(self, accessions: list[str], tasks: list[DownloadTask] = None) -> list[int]:
+        """
+        Queue the supplementary files of GEO records, accessions already queued or running are not added twice.
+        :param tasks: the files to download, e.g. `plan.tasks` of a download plan,
+            by default all supplementary files of the records are listed by the run
+        :return: the ids of the new jobs
+        """
+        job_ids = []
+        now = time.time()
+        with self._connect() as conn:
+            active = {x for x, in conn.execute("SELECT accession FROM jobs WHERE status IN ('new', 'listed')")}
+            for accession in dict.fromkeys(accessions):
+                if accession in active:
+                    continue
+                job_tasks = None if tasks is None else [t for t in tasks if accession in (t.series, t.geo_id)]
+                cursor = conn.execute(
+                    "INSERT INTO jobs (accession, status, created_at) VALUES (?, ?, ?)",
+                    (accession, "new" if job_tasks is None else "listed", now),
+                )
+                job_ids.append(cursor.lastrowid)
+                if job_tasks is not None:
+                    self._add_files(conn, cursor.lastrowid, job_tasks)
+        logger.info(f"Submitted {len(job_ids)} download jobs")
+        return job_ids
+
+    @staticmethod
+    def _add_files(conn: sqlite3.Connection, job_id: int, tasks: list[DownloadTask]) -> None:
+        # a file already downloaded by an earlier job keeps its status
+        conn.executemany(
+            f"""INSERT INTO files (job_id, url, data_dir, geo_id, series, size, status) VALUES (?, ?, ?, ?, ?, ?, '{PENDING}')
+            ON CONFLICT (url, data_dir) DO UPDATE SET
+                job_id = excluded.job_id,
+                status = CASE WHEN status = '{DONE}' THEN status ELSE '{PENDING}' END,
+                attempts = CASE WHEN status = '{DONE}' THEN attempts ELSE 0 END""",
+            [(job_id, t.url, t.data_dir, t.geo_id, t.series, t.size) for t in tasks],
+        )
+        conn.execute("UPDATE jobs SET status = 'listed', n_files = ?, error = NULL WHERE id = ?", (len(tasks), job_id))
+
+    def _list_job(self, accession: str) -> list[DownloadTask] | Exception:
+        try:
+            return get_supp_file_tasks(accession, self.root, raise_errors=True)
+        except Exception as e:
+            return e
+
+    def _list_new_jobs(self, parallel: int, max_attempts: int) -> bool:
+        """
+        List the files of the new jobs, a job that fails to be listed is failed after `max_attempts` tries.
+        :return: whether jobs are left to list
+        """
+        with self._connect() as conn:
+            jobs = conn.execute("SELECT id, accession FROM jobs WHERE status = 'new'").fetchall()
+        if not jobs:
+            return False
+        with ThreadPoolExecutor(max_workers=max(1, parallel)) as executor:
+            task_lists = list(executor.map(lambda x: self._list_job(x[1]), jobs))
+        with self._connect() as conn:
+            for (job_id, accession), tasks in zip(jobs, task_lists):
+                if not isinstance(tasks, Exception):
+                    self._add_files(conn, job_id, tasks)
+                    continue
+                logger.error(f"Failed to list the files of {accession} due to {tasks}")
+                conn.execute(
+                    """UPDATE jobs SET attempts = attempts + 1, error = ?,
+                    status = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'new' END,
+                    finished_at = CASE WHEN attempts + 1 >= ? THEN ? END
+                    WHERE id = ?""",
+                    (str(tasks), max_attempts, max_attempts, time.time(), job_id),
+                )
+            return conn.execute("SELECT 1 FROM jobs WHERE status = 'new'").fetchone() is not None
+
+    def _pending_tasks(self, max_attempts: int) -> list[DownloadTask]:
+        with self._connect() as conn:
+            conn.execute(
+                f"UPDATE files SET status = '{PENDING}' WHERE status = '{FAILED}' AND attempts < ?", (max_attempts,)
+            )
+            rows = conn.execute(
+                f"SELECT url, data_dir, geo_id, series, size FROM files WHERE status = '{PENDING}' ORDER BY id"
+            ).fetchall()
+            conn.execute(f"UPDATE files SET status = '{RUNNING}' WHERE status = '{PENDING}'")
+        return [DownloadTask(url, data_dir, geo_id, series=series, size=size) for url, data_dir, geo_id, series, size in rows]
+
+    def _record(self, result: DownloadResult) -> None:
+        task = result.task
+        if result.skipped is not None:
+            status, error = SKIPPED, result.skipped
+        else:
+            status, error = (DONE, None) if result.success else (FAILED, result.error)
+        path = os.path.join(task.data_dir, os.path.basename(task.url))
+        if result.success:
+            # archives fetched member by member leave no file of their own, their size is unknown
+            size = os.path.getsize(path) if os.path.isfile(path) else None
+        else:
+            size = task.size
+        with self._connect() as conn:
+            conn.execute(
+                """UPDATE files SET status = ?, error = ?, size = ?, finished_at = ?,
+                attempts = attempts + ? WHERE url = ? AND data_dir = ?""",
+                (status, error, size, time.time(), int(status != SKIPPED), task.url, task.data_dir),
+            )
+
+    def _update_jobs(self, max_attempts: int) -> None:
+        with self._connect() as conn:
+            conn.execute(
+                f"""UPDATE jobs SET status = CASE
+                    WHEN EXISTS (SELECT 1 FROM files f WHERE f.job_id = jobs.id AND f.status = '{FAILED}') THEN 'failed'
+                    ELSE 'done' END,
+                finished_at = ?
+                WHERE status = 'listed' AND NOT EXISTS (
+                    SELECT 1 FROM files f WHERE f.job_id = jobs.id
+                    AND (f.status IN ('{PENDING}', '{RUNNING}') OR (f.status = '{FAILED}' AND f.attempts < ?))
+                )""",
+                (time.time(), max_attempts),
+            )
+
+    def run(
+        self,
+        parallel: int = 1,
+        max_per_host: int = DEFAULT_MAX_PER_HOST,
+        max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+        file_filter: DownloadFilter = None,
+        report_every: float = None,
+        show_progress: bool = True,
+    ) -> dict:
+        """
+        Download every queued file, retrying failed files in further rounds up to `max_attempts` times.
+        :param report_every: log `progress()` every this many seconds
+        :return: the final `progress()`
+        """
+        with self._run_lock:
+            with self._connect() as conn:
+                # files left running by an interrupted run are queued again
+                conn.execute(f"UPDATE files SET status = '{PENDING}' WHERE status = '{RUNNING}'")
+                run_id = conn.execute(
+                    "INSERT INTO runs (started_at, max_attempts) VALUES (?, ?)", (time.time(), max_attempts)
+                ).lastrowid
+
+            stop = threading.Event()
+            if report_every:
+                threading.Thread(target=self._report, args=(stop, report_every), daemon=True).start()
+
+            inventory = get_file_inventory(self.root)
+
+            def on_complete(result: DownloadResult):
+                self._record(result)
+                if result.success:
+                    inventory.add_file(os.path.join(result.task.data_dir, os.path.basename(result.task.url)))
+
+            downloader = ParallelDownloader(
+                max_workers=parallel,
+                max_per_host=max_per_host,
+                log_dir=self.root,
+                show_progress=show_progress,
+                cache=get_geo_cache(),
+                on_complete=on_complete,
+                file_filter=file_filter,
+                # the rounds of the run are the retries
+                max_retries=1,
+            )
+            try:
+                while True:
+                    # jobs submitted since the previous round join this one
+                    unlisted = self._list_new_jobs(parallel, max_attempts)
+                    tasks = self._pending_tasks(max_attempts)
+                    if not tasks and not unlisted:
+                        break
+                    downloader.download(tasks)
+                    self._update_jobs(max_attempts)
+                self._update_jobs(max_attempts)
+            finally:
+                stop.set()
+                with self._connect() as conn:
+                    conn.execute("UPDATE runs SET finished_at = ? WHERE id = ?", (time.time(), run_id))
+        progress = self.progress()
+        logger.info(f"Download run finished: {progress}")
+        return progress
+
+    def run_in_background(self, **kwargs) -> threading.Thread:
+        """
+        Run the queue in a daemon thread, e.g. from the web frontend, see `run` for the arguments.
+        """
+        thread = threading.Thread(target=self.run, kwargs={"show_progress": False, **kwargs}, daemon=True)
+        thread.start()
+        return thread
+
+    def _report(self, stop: threading.Event, interval: float) -> None:
+        while not stop.wait(interval):
+            logger.info(f"Download progress: {self.progress()}")
+
+    def progress(self) -> dict:
+        """
+        Files and bytes per status, with the throughput and ETA of the latest run.
+        While a run is active, failed files it will retry count as remaining.
+        Remaining bytes only count files of known size, the ETA falls back to the file rate without them.
+        """
+        with self._connect() as conn:
+            files = {
+                status: {"files": n, "bytes": int(size or 0)}
+                for status, n, size in conn.execute("SELECT status, COUNT(*), SUM(size) FROM files GROUP BY status")
+            }
+            jobs = dict(conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+            run = conn.execute("SELECT started_at, finished_at, max_attempts FROM runs ORDER BY id DESC LIMIT 1").fetchone()
+            done_files, done_bytes, retried = 0, 0, (0, 0)
+            if run is not None and run[1] is None:
+                retried = conn.execute(
+                    f"SELECT COUNT(*), COALESCE(SUM(size), 0) FROM files WHERE status = '{FAILED}' AND attempts < ?",
+                    (run[2] or DEFAULT_MAX_ATTEMPTS,),
+                ).fetchone()
+            if run is not None:
+                done_files, done_bytes = conn.execute(
+                    f"SELECT COUNT(*), COALESCE(SUM(size), 0) FROM files WHERE status = '{DONE}' AND finished_at >= ?",
+                    (run[0],),
+                ).fetchone()
+
+        total = sum(x["files"] for x in files.values())
+        remaining = {k: sum(files.get(s, {}).get(k, 0) for s in (PENDING, RUNNING)) for k in ("files", "bytes")}
+        remaining = {"files": remaining["files"] + retried[0], "bytes": remaining["bytes"] + retried[1]}
+        res = {
+            "jobs": jobs,
+            "files": files,
+            "total_files": total,
+            "remaining_files": remaining["files"],
+            "fraction_done": round(1 - remaining["files"] / total, 3) if total else 1.0,
+            "bytes_per_second": None,
+            "eta_seconds": None,
+        }
+        if run is not None:
+            elapsed = (run[1] or time.time()) - run[0]
+            if elapsed > 0 and done_files:
+                res["bytes_per_second"] = round(done_bytes / elapsed)
+                if remaining["bytes"] and done_bytes:
+                    res["eta_seconds"] = round(remaining["bytes"] / (done_bytes / elapsed))
+                else:
+                    res["eta_seconds"] = round(remaining["files"] / (done_files / elapsed))
+        return res
+
+
+_queues: dict[str, DownloadQueue] = {}
+_queues_lock = threading.Lock()
+
+
+def get_download_queue(root: str) -> DownloadQueue:
+    root = os.path.abspath(root)
+    with _queues_lock:
+        if root not in _queues:
+            _queues[root] = DownloadQueue(root)
+        return _queues[root]
+
+
+def read_search_accessions(search_file: str) -> list[str]:
+    """
+    Read the accessions of a search results file, as written by the `search` command or the frontend.
+    """
+    import pandas as pd
+
+    search_df = pd.read_csv(search_file)
+    if "accession" not in search_df.columns:
+        raise ValueError(f"No accession column in {search_file}")
+    return list(dict.fromkeys(search_df["accession"].dropna().astype(str)))
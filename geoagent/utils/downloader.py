@@ -0,0 +1,240 @@
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Callable
+from urllib.parse import urlparse
+
+from tqdm import tqdm
+
+from geoagent.utils.archive_helpers import EXTRACT_EXTENSIONS, ArchiveMember, fetch_tar_members
+from geoagent.utils.file_helpers import parse_size, wget_ftp_url
+from geoagent.utils.file_inventory import file_type
+from geoagent.utils.logger import geoagent_logger as logger
+
+if TYPE_CHECKING:
+    from geoagent.utils.geo_cache import GeoCache
+
+# NCBI throttles clients that open too many simultaneous FTP sessions
+DEFAULT_MAX_PER_HOST = int(os.getenv("GEO_MAX_CONN_PER_HOST", 4))
+
+
+@dataclass
+class DownloadTask:
+    url: str
+    data_dir: str
+    # accession the file belongs to, only used for reporting
+    geo_id: str = None
+    # series of the accession and remote size of the file, filled in by download planning
+    series: str = None
+    size: int = None
+
+
+@dataclass
+class DownloadResult:
+    task: DownloadTask
+    success: bool
+    error: str = None
+    # why the file was left out by the download filter
+    skipped: str = None
+
+
+@dataclass
+class DownloadFilter:
+    """
+    Rules deciding which supplementary files are downloaded, `None` disables a rule.
+    :param include_types: only download these file types, compression aside, e.g. `mtx` matches `x.mtx.gz`
+    :param exclude_types: never download these file types, e.g. `bam`
+    :param include_regex: only download files whose name matches
+    :param exclude_regex: never download files whose name matches
+    :param max_size: skip files above this size, e.g. `5G`, files of unknown size are skipped
+    :param tar_members: for tar archives, fetch only the members passing the rules,
+        by byte range through the archive index, instead of the whole archive
+    """
+    include_types: tuple[str, ...] = None
+    exclude_types: tuple[str, ...] = None
+    include_regex: str = None
+    exclude_regex: str = None
+    max_size: int | str = None
+    tar_members: bool = False
+
+    def __post_init__(self):
+        self.max_size = parse_size(self.max_size)
+        self.include_types = {x.lower().lstrip(".") for x in self.include_types} if self.include_types else None
+        self.exclude_types = {x.lower().lstrip(".") for x in self.exclude_types} if self.exclude_types else None
+
+    def name_reason(self, file_name: str) -> str | None:
+        """
+        Why a file is left out given its name, None if it is kept.
+        """
+        ext = file_type(file_name)
+        if self.exclude_types and ext in self.exclude_types:
+            return "file type"
+        if self.exclude_regex and re.search(self.exclude_regex, file_name):
+            return "exclude pattern"
+        if self.include_regex and not re.search(self.include_regex, file_name):
+            return "include pattern"
+        # an archive is kept when its members are filtered instead
+        if self.include_types and ext not in self.include_types and not self.splits_archive(file_name):
+            return "file type"
+        return None
+
+    def size_reason(self, size: int | None) -> str | None:
+        if self.max_size is None:
+            return None
+        if size is None:
+            return "unknown size"
+        return "file size" if size > self.max_size else None
+
+    def splits_archive(self, file_name: str) -> bool:
+        return self.tar_members and file_type(file_name) == "tar"
+
+    def is_wanted_member(self, member: ArchiveMember) -> bool:
+        name = os.path.basename(member.name)
+        return file_type(name) != "tar" and self.name_reason(name) is None and self.size_reason(member.size) is None
+
+
+# what `GeoCountMatrixReader` can read, matrices inside `_RAW.tar` archives are fetched alone
+COUNT_MATRIX_FILTER = DownloadFilter(include_types=tuple(x.lstrip(".") for x in EXTRACT_EXTENSIONS), tar_members=True)
+
+
+class ParallelDownloader:
+    """
+    Download many files concurrently with a bounded worker pool.
+
+    `max_workers` caps the number of transfers running at the same time,
+    `max_per_host` caps the transfers running against a single host, so a
+    large pull from `ftp.ncbi.nlm.nih.gov` does not get throttled while
+    files from other hosts can still use the free workers. When a `cache` is
+    given, files are fetched into the shared GEO cache and linked into the
+    task directory. `on_complete` is called with every result as it completes,
+    from the thread calling `download`. Files rejected by `file_filter` are
+    reported as skipped without being transferred. `max_retries` is the number of
+    transfer attempts of a file within one `download` call.
+
+    Examples:
+    ```python
+    >>> downloader = ParallelDownloader(max_workers=8, log_dir="/data/geo")
+    >>> downloader.download([DownloadTask(url, "/data/geo/GSE1/Supp")])
+    ```
+    """
+
+    def __init__(
+        self,
+        max_workers: int = 1,
+        max_per_host: int = DEFAULT_MAX_PER_HOST,
+        log_dir: str = None,
+        fetch_func: Callable[..., bool] = wget_ftp_url,
+        show_progress: bool = True,
+        cache: "GeoCache" = None,
+        on_complete: Callable[[DownloadResult], None] = None,
+        file_filter: DownloadFilter = None,
+        max_retries: int = 3,
+    ):
+        self.max_workers = max(1, max_workers)
+        self.max_per_host = max(1, max_per_host)
+        self.log_dir = log_dir
+        self.fetch_func = fetch_func
+        self.show_progress = show_progress
+        self.cache = cache
+        self.on_complete = on_complete
+        self.file_filter = file_filter
+        self.max_retries = max_retries
+        self._host_slots: dict[str, threading.BoundedSemaphore] = {}
+        self._lock = threading.Lock()
+
+    def _get_host_slot(self, url: str) -> threading.BoundedSemaphore:
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = threading.BoundedSemaphore(self.max_per_host)
+            return self._host_slots[host]
+
+    def _fetch_tar_members(self, task: DownloadTask) -> bool:
+        try:
+            fetch_tar_members(task.url, task.data_dir, self.file_filter.is_wanted_member)
+            return True
+        except Exception as e:
+            logger.info(f"Fetching the members of {task.url} failed due to {e}, downloading the whole archive")
+            return False
+
+    def _run_task(self, task: DownloadTask) -> DownloadResult:
+        log_dir = self.log_dir or task.data_dir
+        with self._get_host_slot(task.url):
+            if self.file_filter is not None and self.file_filter.splits_archive(task.url):
+                if self._fetch_tar_members(task):
+                    return DownloadResult(task, True)
+            try:
+                if self.cache is not None:
+                    # fetch once into the shared cache, then link into the project directory
+                    success = self.cache.download(
+                        task.url, task.data_dir, log_dir, accession=task.geo_id, max_retries=self.max_retries
+                    )
+                else:
+                    success = self.fetch_func(
+                        ftp_url=task.url, data_dir=task.data_dir, log_dir=log_dir, max_retries=self.max_retries
+                    )
+            except Exception as e:
+                logger.error(f"Failed to download {task.url} due to {e}")
+                return DownloadResult(task, False, str(e))
+        return DownloadResult(task, success is not False)
+
+    def _filter_tasks(self, tasks: list[DownloadTask]) -> tuple[list[DownloadTask], list[DownloadResult]]:
+        n_tasks, kept, skipped = len(tasks), [], []
+        for task in tasks:
+            reason = self.file_filter.name_reason(os.path.basename(task.url))
+            if reason is None:
+                kept.append(task)
+            else:
+                skipped.append(DownloadResult(task, False, skipped=reason))
+
+        if self.file_filter.max_size is not None:
+            from geoagent.utils.download_planner import fetch_remote_sizes
+
+            sizes = fetch_remote_sizes(
+                [task.url for task in kept if task.size is None], max_per_host=self.max_per_host, show_progress=self.show_progress
+            )
+            tasks, kept = kept, []
+            for task in tasks:
+                if task.size is None:
+                    task.size = sizes.get(task.url)
+                # archives fetched member by member are not limited by their own size
+                reason = None if self.file_filter.splits_archive(task.url) else self.file_filter.size_reason(task.size)
+                if reason is None:
+                    kept.append(task)
+                else:
+                    skipped.append(DownloadResult(task, False, skipped=reason))
+
+        if skipped:
+            logger.info(f"Skipping {len(skipped)}/{n_tasks} files by the download filter")
+        return kept, skipped
+
+    def download(self, tasks: list[DownloadTask]) -> list[DownloadResult]:
+        """
+        Download all tasks and return their results in completion order.
+        """
+        results = []
+        if self.file_filter is not None:
+            tasks, results = self._filter_tasks(tasks)
+            if self.on_complete is not None:
+                for result in results:
+                    self.on_complete(result)
+        if not tasks:
+            return results
+
+        progress = tqdm(total=len(tasks), desc="Downloading files", disable=not self.show_progress)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(self._run_task, task) for task in tasks]
+            for future in as_completed(futures):
+                result = future.result()
+                results.append(result)
+                if self.on_complete is not None:
+                    self.on_complete(result)
+                progress.update(1)
+        progress.close()
+
+        failed = [r for r in results if not r.success and r.skipped is None]
+        if failed:
+            logger.error(f"{len(failed)}/{len(results)} files failed to download")
+        return results
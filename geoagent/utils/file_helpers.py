@@ -1,12 +1,17 @@
-import pandas as pd
 import os
+import ftplib
 import gzip
+import hashlib
 import itertools
-import subprocess
+import json
+import re
 import time
+from urllib.parse import urlparse
 from urllib.request import urlretrieve
 from datetime import datetime
 
+from geoagent.utils.http_helpers import http_request
+
 
 def download_from_ftp_url(ftp_url, local_dir):
     try:
@@ -51,9 +56,140 @@ def list_files(directory_path: str, exclude_suffixes: list[str] = None) -> list[
     return file_list
 
 
+_SIZE_UNITS = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+_SIZE_PATTERN = re.compile(r"^\s*([0-9.]+)\s*([KMGT]?)B?\s*$", re.IGNORECASE)
+
+
+def parse_size(size: str | int | None) -> int | None:
+    """
+    Parse a human readable size such as `500M`, `5GB` or `1.5T` into bytes.
+    """
+    if size is None or isinstance(size, int):
+        return size
+    match = _SIZE_PATTERN.match(size)
+    if match is None:
+        raise ValueError(f"Invalid size: {size}")
+    return int(float(match.group(1)) * _SIZE_UNITS[match.group(2).upper()])
+
+
+PART_SUFFIX = ".part"
+PART_META_SUFFIX = ".part.json"
+DOWNLOAD_LOG_FILE = "download.logs"
+DOWNLOAD_FAILURES_LOG_FILE = "download_failures.log"
+CHUNK_SIZE = 1024 * 1024
+
+
+def get_remote_file_info(url: str, timeout: int = 10, ftp: ftplib.FTP = None) -> dict:
+    """
+    Query the size and version validators of a remote file without downloading it.
+
+    Args:
+        url (str): FTP or HTTP(S) URL of the file
+        timeout (int): Timeout in seconds for the request
+        ftp (ftplib.FTP, optional): Logged in connection to the FTP host to reuse, in binary mode
+
+    Returns:
+        dict: `size` (int or None), `etag` and `mtime` (str or None)
+    """
+    parsed = urlparse(url)
+    info = {"size": None, "etag": None, "mtime": None}
+    if parsed.scheme == "ftp":
+        if ftp is None:
+            with ftplib.FTP(parsed.hostname, timeout=timeout) as ftp:
+                ftp.login()
+                ftp.voidcmd("TYPE I")
+                return get_remote_file_info(url, timeout=timeout, ftp=ftp)
+        info["size"] = ftp.size(parsed.path)
+        try:
+            info["mtime"] = ftp.voidcmd(f"MDTM {parsed.path}").split()[-1]
+        except ftplib.error_perm:
+            pass
+    else:
+        response = http_request("HEAD", url, timeout=timeout, rate_limited=_is_ncbi(url), allow_redirects=True)
+        if "Content-Length" in response.headers:
+            info["size"] = int(response.headers["Content-Length"])
+        info["etag"] = response.headers.get("ETag")
+        info["mtime"] = response.headers.get("Last-Modified")
+    return info
+
+
+def _is_ncbi(url: str) -> bool:
+    # only requests to NCBI count against its rate limit
+    return (urlparse(url).hostname or "").endswith("ncbi.nlm.nih.gov")
+
+
+def _fetch_from_offset(url: str, part_path: str, offset: int, timeout: int) -> None:
+    """
+    Append the remote bytes starting at `offset` to `part_path`.
+    """
+    parsed = urlparse(url)
+    if parsed.scheme == "ftp":
+        with ftplib.FTP(parsed.hostname, timeout=timeout) as ftp, open(part_path, "ab") as f:
+            ftp.login()
+            ftp.voidcmd("TYPE I")
+            ftp.retrbinary(f"RETR {parsed.path}", f.write, blocksize=CHUNK_SIZE, rest=offset or None)
+        return
+
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+    with http_request("GET", url, timeout=timeout, rate_limited=_is_ncbi(url), headers=headers, stream=True) as response:
+        # server ignored the range request, start over
+        mode = "ab" if offset and response.status_code == 206 else "wb"
+        with open(part_path, mode) as f:
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                f.write(chunk)
+
+
+def verify_downloaded_file(file_path: str, expected_size: int = None) -> bool:
+    """
+    Check that a downloaded file is complete.
+
+    The size is compared against the remote size when known, and gzip members
+    are fully decompressed so that their CRC32 and length trailers are checked.
+    """
+    if expected_size is not None and os.path.getsize(file_path) != expected_size:
+        return False
+    if file_path.endswith(".gz"):
+        try:
+            with gzip.open(file_path, "rb") as f:
+                while f.read(CHUNK_SIZE):
+                    pass
+        except (OSError, EOFError):
+            return False
+    return True
+
+
+def file_sha256(file_path: str) -> str:
+    sha = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _read_part_meta(meta_path: str) -> dict:
+    if not os.path.exists(meta_path):
+        return {}
+    try:
+        with open(meta_path) as f:
+            return json.load(f)
+    except json.JSONDecodeError:
+        return {}
+
+
+def _write_part_meta(meta_path: str, meta: dict) -> None:
+    with open(meta_path, "w") as f:
+        json.dump(meta, f)
+
+
 def wget_ftp_url(ftp_url: str, data_dir: str, log_dir: str, read_timeout: int = 10, max_retries: int = 3):
     """
-    Download file from FTP URL using wget with timeout and retry mechanism.
+    Download file from FTP URL with resume support and integrity check.
+
+    Data is written to `<file>.part` next to a `<file>.part.json` sidecar that
+    records the expected size and the remote ETag / modification time. An
+    interrupted download resumes from the end of the `.part` file as long as the
+    remote file is unchanged, and the file only gets its final name once its
+    size (and gzip CRC for `.gz` files) has been validated.
     
     Args:
         ftp_url (str): FTP URL to download from
@@ -61,6 +197,9 @@ def wget_ftp_url(ftp_url: str, data_dir: str, log_dir: str, read_timeout: int =
         log_dir (str): Directory to store log files
         read_timeout (int): Timeout in seconds for read operations
         max_retries (int): Maximum number of retry attempts
+
+    Returns:
+        bool: True if the file is available locally after the call
     """
     # Create local directory if it doesn't exist
     os.makedirs(data_dir, exist_ok=True)
@@ -69,49 +208,105 @@ def wget_ftp_url(ftp_url: str, data_dir: str, log_dir: str, read_timeout: int =
     # Get the filename from the URL
     filename = os.path.basename(ftp_url)
     local_file_path = os.path.join(data_dir, filename)
-    log_file_path = os.path.join(log_dir, 'download.logs')
-    
-    # Skip if file already exists
-    # todo: handle incomplete files form previous download
-    if os.path.exists(local_file_path):
+    part_path = local_file_path + PART_SUFFIX
+    meta_path = local_file_path + PART_META_SUFFIX
+    log_file_path = os.path.join(log_dir, DOWNLOAD_LOG_FILE)
+
+    def log(message: str):
         with open(log_file_path, 'a') as f:
-            f.write(f"[{datetime.now()}] File {filename} already exists, skipping download\n")
-        return
-    
-    # Prepare wget command with timeout
-    wget_cmd = [
-        'wget',
-        '--read-timeout', str(read_timeout),
-        '--tries', '1',  # Set to 1 as we'll handle retries manually
-        '-P', data_dir,
-        ftp_url
-    ]
+            f.write(f"[{datetime.now()}] {message}\n")
+
+    try:
+        remote = get_remote_file_info(ftp_url, timeout=read_timeout)
+    except Exception as e:
+        log(f"Failed to query {filename}: {e}")
+        remote = {"size": None, "etag": None, "mtime": None}
+
+    if os.path.exists(local_file_path):
+        local_size = os.path.getsize(local_file_path)
+        if remote["size"] is None or local_size == remote["size"]:
+            log(f"File {filename} already exists, skipping download")
+            return True
+        if local_size > remote["size"]:
+            log(f"File {filename} is larger than the remote file, downloading again")
+            os.remove(local_file_path)
+        else:
+            # left by a previous download that did not use `.part` files
+            log(f"File {filename} is incomplete ({local_size}/{remote['size']} bytes), resuming")
+            os.replace(local_file_path, part_path)
+            _write_part_meta(meta_path, {"url": ftp_url, **remote})
+
+    # discard partial data if the remote file changed since it was written
+    meta = _read_part_meta(meta_path)
+    if os.path.exists(part_path) and any(
+        meta.get(k) != remote[k] for k in ("size", "etag", "mtime") if remote[k] is not None
+    ):
+        log(f"Remote file {filename} changed, discarding partial download")
+        os.remove(part_path)
+    _write_part_meta(meta_path, {"url": ftp_url, **remote})
     
     # Try downloading with retries
     for attempt in range(max_retries):
         try:
-            result = subprocess.run(wget_cmd, capture_output=True, text=True)
-            
-            if result.returncode == 0:
-                with open(log_file_path, 'a') as f:
-                    f.write(f"[{datetime.now()}] Downloaded {filename} successfully\n")
-                return
-            else:
-                raise Exception(f"wget failed with error: {result.stderr}")
+            offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            if remote["size"] is None or offset < remote["size"]:
+                if offset:
+                    log(f"Resuming {filename} from byte {offset}")
+                _fetch_from_offset(ftp_url, part_path, offset, read_timeout)
+
+            if not verify_downloaded_file(part_path, remote["size"]):
+                # a corrupted partial file cannot be resumed
+                os.remove(part_path)
+                raise Exception("integrity check failed")
+
+            os.replace(part_path, local_file_path)
+            os.remove(meta_path)
+            log(f"Downloaded {filename} successfully")
+            return True
                 
         except Exception as e:
             error_msg = f"[{datetime.now()}] Attempt {attempt + 1}/{max_retries} failed: {str(e)}\n"
             
             # On last attempt, log the failure
             if attempt == max_retries - 1:
-                with open(os.path.join(data_dir, 'download_failures.log'), 'a') as f:
+                with open(os.path.join(data_dir, DOWNLOAD_FAILURES_LOG_FILE), 'a') as f:
                     f.write(f"Failed to download {ftp_url}: {error_msg}")
-                with open(log_file_path, 'a') as f:
-                    f.write(f"[{datetime.now()}] Max retries reached for {filename}. Error logged.\n")
+                log(f"Max retries reached for {filename}. Error logged.")
             else:
-                with open(log_file_path, 'a') as f:
-                    f.write(f"[{datetime.now()}] Attempt {attempt + 1} failed, retrying...\n")
+                log(f"Attempt {attempt + 1} failed, retrying...")
                 time.sleep(2)  # Wait before retry
+    return False
+
+
+def gzip_uncompressed_size(file_path: str) -> int:
+    """
+    Uncompressed size of a gzip file from its ISIZE trailer, without decompressing it.
+    ISIZE is the size modulo 2^32 and only covers the last member of multi-member
+    files, so this is an estimate for files inflating past 4 GiB.
+    """
+    compressed_size = os.path.getsize(file_path)
+    with open(file_path, "rb") as f:
+        f.seek(-4, os.SEEK_END)
+        size = int.from_bytes(f.read(4), "little")
+    # tiny files are larger compressed, only wrap sizes that must exceed 4 GiB
+    while compressed_size >= 2**32 and size < compressed_size:
+        size += 2**32
+    return size
+
+
+def count_lines(file_path: str, chunk_size: int = CHUNK_SIZE) -> int:
+    """
+    Exact number of lines of a (gzipped) file, counted over fixed size chunks.
+    """
+    opener = gzip.open if file_path.endswith(".gz") else open
+    counts, last = 0, b"\n"
+    with opener(file_path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            counts += chunk.count(b"\n")
+            last = chunk[-1:]
+    # a last line without a trailing newline
+    return counts + (last != b"\n")
+
 
 def head_file(file_path: str, n: int) -> str:
     """Get the first n rows of a file efficiently.
@@ -125,6 +320,8 @@ def head_file(file_path: str, n: int) -> str:
     """
     # Handle Excel files
     if file_path.endswith(('.xls', '.xlsx')):
+        import pandas as pd
+
         df = pd.read_excel(file_path, nrows=n)
         return df.to_string()
         
@@ -134,13 +331,26 @@ def head_file(file_path: str, n: int) -> str:
     with opener(file_path, 'rt') as f:
         # Use itertools.islice for memory efficient reading of first n lines
         return ''.join(itertools.islice(f, n))
-    
+
+
+def is_download_artifact(file_name: str) -> bool:
+    """
+    Whether a file is download bookkeeping rather than sample data: partial downloads and
+    their sidecars, hidden files (e.g. tar member indexes) and the download logs.
+    """
+    return (
+        file_name.startswith(".")
+        or file_name.endswith((PART_SUFFIX, PART_META_SUFFIX))
+        or file_name in (DOWNLOAD_LOG_FILE, DOWNLOAD_FAILURES_LOG_FILE)
+    )
+
 
 def list_files_with_content(file_dir: str, peek_types: list[str], peek_limits: int = 10) -> dict:
+    # download artifacts are left out, the listing must not depend on the download state
     res = {"file_dir": file_dir, "files": [], "content": []}
     for file_name in os.listdir(file_dir):
         file_path = os.path.join(file_dir, file_name)
-        if os.path.isfile(file_path):
+        if os.path.isfile(file_path) and not is_download_artifact(file_name):
             res["files"].append(file_name)
             if any(ext in file_name.lower() for ext in peek_types):
                 res["content"].append(head_file(file_path, peek_limits))
@@ -0,0 +1,230 @@
+import os
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from geoagent.utils.file_helpers import is_download_artifact
+from geoagent.utils.logger import geoagent_logger as logger
+
+FILE_INVENTORY_DB_FILE = ".file_inventory.db"
+_GSM_PATTERN = re.compile(r"^GSM\d+$")
+
+
+def file_type(file_name: str) -> str:
+    """
+    Type of a file from its extension, compression aside, e.g. `x_matrix.mtx.gz` -> `mtx`
+    """
+    return os.path.splitext(file_name.lower().removesuffix(".gz"))[1].lstrip(".")
+
+
+def _is_ignored(file_name: str) -> bool:
+    # partial downloads, their sidecars, download logs and hidden bookkeeping files (indexes, this database)
+    return is_download_artifact(file_name)
+
+
+class FileInventory:
+    """
+    Persistent inventory of the files under a download directory laid out as
+    `<root>/<geo_id>/{<gsm_id>,Supp,Soft}/...`, with the size, mtime and type of every file.
+
+    `refresh` only lists the directories whose mtime changed since the last scan.
+    In the others only the recorded files are stat-ed, which catches files rewritten
+    in place, so listing a large cache tree does not list every directory again.
+    Files fetched by the downloader are added with `add_file` as they complete.
+
+    Examples:
+    ```python
+    >>> inventory = FileInventory("/data/immunity")
+    >>> inventory.refresh()
+    >>> inventory.list_files("GSE123", exclude_suffixes=[".soft.gz"])
+    ['GSM1/GSM1_matrix.mtx.gz', 'Supp/GSE123_RAW.tar']
+    ```
+    """
+
+    def __init__(self, root: str, db_path: str = None):
+        self.root = os.path.abspath(root)
+        self.db_path = db_path or os.path.join(self.root, FILE_INVENTORY_DB_FILE)
+        os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS files (
+                    path TEXT PRIMARY KEY,
+                    dir TEXT NOT NULL,
+                    geo_id TEXT,
+                    sample TEXT,
+                    folder TEXT,
+                    file_type TEXT,
+                    size INTEGER NOT NULL,
+                    mtime REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS dirs (
+                    path TEXT PRIMARY KEY,
+                    parent TEXT,
+                    mtime REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS files_dir ON files (dir);
+                CREATE INDEX IF NOT EXISTS files_geo_id ON files (geo_id);
+                CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent);
+                """
+            )
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _relpath(self, path: str) -> str:
+        rel_path = os.path.relpath(os.path.abspath(path), self.root)
+        return "" if rel_path == "." else rel_path.replace(os.sep, "/")
+
+    @staticmethod
+    def _file_row(rel_path: str, size: int, mtime: float) -> tuple:
+        parts = rel_path.split("/")
+        geo_id = parts[0] if len(parts) > 1 else None
+        folder = parts[1] if len(parts) > 2 else None
+        sample = folder if folder and _GSM_PATTERN.match(folder) else (geo_id if geo_id and geo_id.startswith("GSM") else None)
+        return (
+            rel_path, "/".join(parts[:-1]), geo_id, sample, folder, file_type(parts[-1]), size, mtime,
+        )
+
+    def _delete_dir(self, conn: sqlite3.Connection, rel_dir: str) -> None:
+        # a removed directory takes its files and sub directories with it, the paths below
+        # `rel_dir/` sort between it and `rel_dir0` ("0" follows "/"), no LIKE wildcard to escape
+        low, high = f"{rel_dir}/", f"{rel_dir}0"
+        conn.execute("DELETE FROM files WHERE dir = ? OR (dir >= ? AND dir < ?)", (rel_dir, low, high))
+        conn.execute("DELETE FROM dirs WHERE path = ? OR (path >= ? AND path < ?)", (rel_dir, low, high))
+
+    def _restat_files(self, conn: sqlite3.Connection, files: list[tuple[str, int, float]]) -> None:
+        # files rewritten in place leave the mtime of their directory unchanged
+        for rel_path, size, mtime in files:
+            try:
+                stat = os.stat(os.path.join(self.root, rel_path))
+            except FileNotFoundError:
+                conn.execute("DELETE FROM files WHERE path = ?", (rel_path,))
+                continue
+            if stat.st_size != size or stat.st_mtime != mtime:
+                conn.execute(
+                    "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    self._file_row(rel_path, stat.st_size, stat.st_mtime),
+                )
+
+    def _scan_dir(self, conn: sqlite3.Connection, rel_dir: str, parent: str | None, mtime: float) -> list[str]:
+        abs_dir = os.path.join(self.root, rel_dir)
+        rows, sub_dirs = [], []
+        with os.scandir(abs_dir) as entries:
+            for entry in entries:
+                if _is_ignored(entry.name):
+                    continue
+                rel_path = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+                if entry.is_dir():
+                    sub_dirs.append(rel_path)
+                elif entry.is_file():
+                    stat = entry.stat()
+                    rows.append(self._file_row(rel_path, stat.st_size, stat.st_mtime))
+        conn.execute("DELETE FROM files WHERE dir = ?", (rel_dir,))
+        conn.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        known = {x for x, in conn.execute("SELECT path FROM dirs WHERE parent = ?", (rel_dir,))}
+        for removed in known - set(sub_dirs):
+            self._delete_dir(conn, removed)
+        conn.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)", (rel_dir, parent, mtime))
+        return sub_dirs
+
+    def refresh(self) -> int:
+        """
+        Bring the inventory up to date with the directory tree.
+        A directory mtime changes when entries are added, removed or renamed in it,
+        downloads land under a temporary name and are renamed, so they are picked up.
+        Files of unchanged directories are checked against their recorded size and mtime.
+        :return: the number of directories listed
+        """
+        if not os.path.isdir(self.root):
+            return 0
+        start, n_scanned = time.time(), 0
+        with self._connect() as conn:
+            mtimes, children, files = {}, {}, {}
+            for path, parent, mtime in conn.execute("SELECT path, parent, mtime FROM dirs"):
+                mtimes[path] = mtime
+                children.setdefault(parent, []).append(path)
+            for path, rel_dir, size, mtime in conn.execute("SELECT path, dir, size, mtime FROM files"):
+                files.setdefault(rel_dir, []).append((path, size, mtime))
+            stack = [("", None)]
+            while stack:
+                rel_dir, parent = stack.pop()
+                try:
+                    mtime = os.stat(os.path.join(self.root, rel_dir)).st_mtime
+                except FileNotFoundError:
+                    self._delete_dir(conn, rel_dir)
+                    continue
+                if mtimes.get(rel_dir) == mtime:
+                    sub_dirs = children.get(rel_dir, [])
+                    self._restat_files(conn, files.get(rel_dir, []))
+                else:
+                    sub_dirs = self._scan_dir(conn, rel_dir, parent, mtime)
+                    n_scanned += 1
+                stack.extend((x, rel_dir) for x in sub_dirs)
+        logger.info(f"Refreshed the file inventory of {self.root}, listed {n_scanned} directories in {time.time() - start:.2f}s")
+        return n_scanned
+
+    def add_file(self, path: str) -> None:
+        """
+        Record a file that was just written under the root, e.g. on download completion.
+        """
+        if _is_ignored(os.path.basename(path)) or not os.path.isfile(path):
+            return
+        stat = os.stat(path)
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                self._file_row(self._relpath(path), stat.st_size, stat.st_mtime),
+            )
+
+    def query(self, geo_id: str = None, exclude_suffixes: list[str] = None) -> list[dict]:
+        """
+        Return the recorded files, optionally of one GEO record, as dicts of the `files` columns.
+        """
+        sql, params = "SELECT * FROM files", ()
+        if geo_id is not None:
+            sql, params = f"{sql} WHERE geo_id = ?", (geo_id,)
+        with self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            rows = [dict(row) for row in conn.execute(f"{sql} ORDER BY path", params)]
+        if exclude_suffixes:
+            suffixes = tuple(x.lower() for x in exclude_suffixes)
+            rows = [row for row in rows if not row["path"].lower().endswith(suffixes)]
+        return rows
+
+    def list_files(self, geo_id: str, exclude_suffixes: list[str] = None) -> list[str]:
+        """
+        List the files of a GEO record, relative to its directory, e.g. `GSM1/GSM1_matrix.mtx.gz`
+        """
+        return [row["path"].split("/", 1)[1] for row in self.query(geo_id, exclude_suffixes)]
+
+    def list_records(self, exclude_suffixes: list[str] = None) -> dict[str, list[str]]:
+        """
+        List the files of every GEO record folder under the root, relative to the record folder.
+        """
+        with self._connect() as conn:
+            records = {x: [] for x, in conn.execute("SELECT path FROM dirs WHERE parent = '' ORDER BY path")}
+        for row in self.query(exclude_suffixes=exclude_suffixes):
+            if row["geo_id"] is not None:
+                records.setdefault(row["geo_id"], []).append(row["path"].split("/", 1)[1])
+        return records
+
+
+_inventories: dict[str, FileInventory] = {}
+_inventories_lock = threading.Lock()
+
+
+def get_file_inventory(root: str) -> FileInventory:
+    root = os.path.abspath(root)
+    with _inventories_lock:
+        if root not in _inventories:
+            _inventories[root] = FileInventory(root)
+        return _inventories[root]
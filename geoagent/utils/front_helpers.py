@@ -1,40 +1,90 @@
 import os
+import threading
 import pandas as pd
 import streamlit as st
 
-from geoagent.utils.geo_helpers import search_geo_records, get_metadata, download_supp_files, list_downloaded_files
+from geoagent.utils.download_queue import FAILED, get_download_queue
+from geoagent.utils.geo_helpers import iter_geo_records, search_geo_records_batch, get_metadata_batch, list_downloaded_files
+from geoagent.utils.metadata_store import METADATA_DB_FILE, MetadataStore
 
-def search_records(keywords: str, max_records: int) -> pd.DataFrame:
+METADATA_PARALLEL = int(os.getenv("GEO_METADATA_PARALLEL", 8))
+DOWNLOAD_PARALLEL = int(os.getenv("GEO_DOWNLOAD_PARALLEL", 4))
+
+# one background download run per output directory, shared by reruns of the page
+_download_threads: dict[str, threading.Thread] = {}
+
+
+def search_records(keywords: str, max_records: int, placeholder=None) -> pd.DataFrame:
+    """
+    Search GEO records, rendering the rows into `placeholder` as result pages arrive.
+    """
     print(f"Searching for {keywords} with max {max_records} records")
-    return pd.DataFrame(search_geo_records(keywords, max_records)).set_index("accession")
+    # several topics separated by `;` are searched concurrently
+    queries = [x.strip() for x in keywords.split(";") if x.strip()]
+    if len(queries) > 1:
+        batch_results = search_geo_records_batch(queries, max_records)
+        results = [{"query": query, **record} for query, records in batch_results.items() for record in records]
+        if not results:
+            return pd.DataFrame(columns=["accession", "query"]).set_index("accession")
+        return pd.DataFrame(results).drop_duplicates("accession").set_index("accession")
+
+    results = []
+    for record in iter_geo_records(keywords, max_records):
+        results.append(record)
+        if placeholder is not None and len(results) % 20 == 0:
+            placeholder.dataframe(pd.DataFrame(results).set_index("accession"), use_container_width=False)
+    if not results:
+        return pd.DataFrame(columns=["accession"]).set_index("accession")
+    return pd.DataFrame(results).set_index("accession")
+
 
 def download_data(search_df: pd.DataFrame, out_dir: str) -> None:
+    """
+    Queue the supplementary files of the searched records and start downloading them
+    in a background thread, the progress is rendered by `download_progress`.
+    """
     geo_ids = search_df.index.to_list()
     st.write(f"Save search results...")
     search_df.to_csv(os.path.join(out_dir, "search_df.csv"), encoding="utf-8")
     st.write(f"Total records to download: {len(geo_ids)}") 
-    progress_bar = st.progress(0)
-    for i, geo_id in enumerate(geo_ids):
-        st.write(f"Downloading {geo_id}...")
-        download_supp_files(geo_id, out_dir)
-        progress_bar.progress((i+1) / len(geo_ids))
-    st.write("Download completed!")
+    queue = get_download_queue(out_dir)
+    queue.submit(geo_ids)
+    thread = _download_threads.get(queue.root)
+    if thread is None or not thread.is_alive():
+        _download_threads[queue.root] = queue.run_in_background(parallel=DOWNLOAD_PARALLEL)
+
+
+@st.fragment(run_every=2)
+def download_progress(out_dir: str) -> None:
+    """
+    Render the progress of the download queue of `out_dir`, the fragment reruns on its own
+    every 2 seconds without blocking the rest of the page.
+    """
+    queue = get_download_queue(out_dir)
+    progress = queue.progress()
+    st.progress(progress["fraction_done"] if progress["total_files"] else 0.0)
+    thread = _download_threads.get(queue.root)
+    if thread is not None and thread.is_alive():
+        speed = f"{progress['bytes_per_second'] / 1e6:.1f} MB/s" if progress["bytes_per_second"] else "-"
+        eta = f"{progress['eta_seconds'] // 60} min" if progress["eta_seconds"] is not None else "-"
+        st.write(
+            f"{progress['total_files'] - progress['remaining_files']} / {progress['total_files']} files, {speed}, ETA {eta}"
+        )
+    else:
+        failed = progress["files"].get(FAILED, {}).get("files", 0)
+        st.write(f"Download completed!" + (f" {failed} files failed." if failed else ""))
 
 
 def parse_metadata(search_df: pd.DataFrame, out_dir: str, is_parse_subsample: bool) -> pd.DataFrame:
     geo_ids = search_df.index.tolist()
     print(f"Extracting metadata for {geo_ids}")
-    metadata_file = os.path.join(out_dir, "metadata.csv")
-
-    meta_infos = {}
-    progress_bar = st.progress(0)
-    for i, geo_id in enumerate(geo_ids):
-        _geo_soft_dir = os.path.join(out_dir, geo_id, "Soft")
-        meta_infos[geo_id] = get_metadata(geo_id, parse_subsamples=is_parse_subsample, cache_dir=_geo_soft_dir)
-        progress_bar.progress((i+1) / len(geo_ids))
+    metadata_file = os.path.join(out_dir, METADATA_DB_FILE)
+
+    with st.spinner(f"Extracting metadata of {len(geo_ids)} records..."):
+        meta_infos = get_metadata_batch(geo_ids, parse_subsamples=is_parse_subsample, cache_path=out_dir, parallel=METADATA_PARALLEL)
     
+    MetadataStore(metadata_file).write_records(meta_infos)
     metadata_df = pd.DataFrame.from_dict(meta_infos, orient="index")
-    metadata_df.to_csv(metadata_file, encoding="utf-8")
 
     downloaded_files = list_downloaded_files(out_dir)
 
@@ -0,0 +1,309 @@
+import hashlib
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from geoagent.utils.file_helpers import parse_size, verify_downloaded_file, wget_ftp_url
+from geoagent.utils.logger import geoagent_logger as logger
+
+# per-user by default, a shared world-writable location would let other users plant files
+GEOAGENT_HOME = os.path.join(os.path.expanduser("~"), ".cache", "geoagent")
+# the cache has its own subtree, project downloads go to `GEO_PATH` of geo_helpers
+GEO_CACHE_DIR = os.getenv("GEO_CACHE_DIR") or os.path.join(GEOAGENT_HOME, "cache")
+# byte budget of the shared cache, e.g. `500G`, unlimited if not set
+GEO_CACHE_MAX_BYTES = os.getenv("GEO_CACHE_MAX_BYTES")
+
+_CACHE_INDEX_FILE = "cache_index.db"
+_OBJECTS_DIR = "objects"
+
+
+def _cache_key(url: str) -> str:
+    return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+
+def link_file(src_path: str, dest_dir: str) -> str:
+    """
+    Expose a file in `dest_dir` without copying it: hard-link when possible,
+    fall back to a symlink (e.g. across file systems) and finally to a copy.
+    """
+    os.makedirs(dest_dir, exist_ok=True)
+    dest_path = os.path.join(dest_dir, os.path.basename(src_path))
+    if os.path.lexists(dest_path):
+        if os.path.exists(dest_path) and os.path.samefile(src_path, dest_path):
+            return dest_path
+        # stale link, e.g. a symlink to an evicted cache entry
+        os.remove(dest_path)
+    try:
+        os.link(src_path, dest_path)
+    except OSError:
+        try:
+            os.symlink(os.path.abspath(src_path), dest_path)
+        except OSError:
+            shutil.copy2(src_path, dest_path)
+    return dest_path
+
+
+class GeoCache:
+    """
+    Content-addressed cache of GEO files shared by all projects on a node.
+
+    Every file is stored once under `<root>/objects/<key>/`, where the key is
+    derived from its URL, and indexed in a SQLite file together with its
+    accession, size and last access time. Projects get hard-links (or symlinks)
+    into the cache instead of their own copies, and entries are evicted in
+    least-recently-used order once the cache exceeds `max_bytes`.
+
+    Only entries no project links to are evicted and counted against `max_bytes`:
+    removing a hard-linked object frees no disk space, and removing a symlinked
+    one would leave dangling project files. Symlinks are recorded when they are
+    made, hard-links are detected from the link count of the object.
+
+    Examples:
+    ```python
+    >>> cache = GeoCache()
+    >>> path = cache.fetch(url, accession="GSE1")
+    >>> cache.link_into(path, "/project/GSE1/Supp")
+    ```
+    """
+
+    def __init__(self, root: str = None, max_bytes: int | str = None):
+        self.root = root or GEO_CACHE_DIR
+        max_bytes = max_bytes if max_bytes is not None else GEO_CACHE_MAX_BYTES
+        self.max_bytes = parse_size(max_bytes) if isinstance(max_bytes, str) else max_bytes
+        self.db_path = os.path.join(self.root, _CACHE_INDEX_FILE)
+        self._key_locks: dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.root)), mode=0o700, exist_ok=True)
+        os.makedirs(self.root, mode=0o700, exist_ok=True)
+        os.makedirs(os.path.join(self.root, _OBJECTS_DIR), mode=0o700, exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY,
+                    accession TEXT,
+                    url TEXT NOT NULL,
+                    path TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_access REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS symlinks (
+                    key TEXT NOT NULL,
+                    path TEXT NOT NULL,
+                    PRIMARY KEY (key, path)
+                );
+                """
+            )
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _key_lock(self, key: str) -> threading.Lock:
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def _object_dir(self, key: str) -> str:
+        return os.path.join(self.root, _OBJECTS_DIR, key[:2], key)
+
+    def get(self, url: str) -> str | None:
+        """
+        Return the cached path of `url` and mark it as recently used.
+        """
+        key = _cache_key(url)
+        with self._connect() as conn:
+            row = conn.execute("SELECT path FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if not os.path.exists(row[0]):
+                conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                return None
+            conn.execute("UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key))
+        return row[0]
+
+    def _register(self, key: str, url: str, accession: str, path: str) -> None:
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, accession, url, path, os.path.getsize(path), now, now),
+            )
+
+    def fetch(self, url: str, accession: str = None, log_dir: str = None, max_retries: int = 3) -> str | None:
+        """
+        Return the cached path of `url`, downloading it into the cache first if needed.
+        """
+        key = _cache_key(url)
+        with self._key_lock(key):
+            path = self.get(url)
+            if path:
+                return path
+            object_dir = self._object_dir(key)
+            if not wget_ftp_url(ftp_url=url, data_dir=object_dir, log_dir=log_dir or self.root, max_retries=max_retries):
+                return None
+            path = os.path.join(object_dir, os.path.basename(url))
+            self._register(key, url, accession, path)
+        self.prune(keep={key})
+        return path
+
+    def fetch_soft(self, geo_id: str, refresh: bool = False) -> str:
+        """
+        Return the cached SOFT file of a GEO record (the family file for a GSE).
+        :param refresh: download the SOFT file again even if it is cached
+        """
+        url = f"soft://{geo_id}"
+        key = _cache_key(url)
+        with self._key_lock(key):
+            path = self.get(url)
+            if path and not refresh:
+                return path
+            if path:
+                with self._connect() as conn:
+                    self._remove_entry(conn, key, path)
+            import GEOparse
+
+            path, _ = GEOparse.get_GEO_file(geo=geo_id, destdir=self._object_dir(key), silent=True)
+            self._register(key, url, geo_id, path)
+        self.prune(keep={key})
+        return path
+
+    def get_soft(self, geo_id: str) -> str | None:
+        return self.get(f"soft://{geo_id}")
+
+    def link_into(self, cached_path: str, dest_dir: str) -> str:
+        dest_path = link_file(cached_path, dest_dir)
+        if os.path.islink(dest_path):
+            # a symlink does not show in the link count of the object, keep track of it
+            key = os.path.basename(os.path.dirname(cached_path))
+            with self._connect() as conn:
+                conn.execute("INSERT OR IGNORE INTO symlinks VALUES (?, ?)", (key, os.path.abspath(dest_path)))
+        return dest_path
+
+    def _is_linked(self, conn: sqlite3.Connection, key: str, path: str) -> bool:
+        """
+        Whether a project still links to the entry, through a hard-link or a recorded symlink.
+        """
+        try:
+            if os.stat(path).st_nlink > 1:
+                return True
+        except FileNotFoundError:
+            return False
+        real_path = os.path.realpath(path)
+        linked = False
+        for link, in conn.execute("SELECT path FROM symlinks WHERE key = ?", (key,)).fetchall():
+            if os.path.islink(link) and os.path.realpath(link) == real_path:
+                linked = True
+            else:
+                conn.execute("DELETE FROM symlinks WHERE key = ? AND path = ?", (key, link))
+        return linked
+
+    def download(self, ftp_url: str, data_dir: str, log_dir: str, accession: str = None, max_retries: int = 3) -> bool:
+        """
+        Drop-in replacement of `wget_ftp_url` that goes through the cache.
+        """
+        path = self.fetch(ftp_url, accession=accession, log_dir=log_dir, max_retries=max_retries)
+        if path is None:
+            return False
+        self.link_into(path, data_dir)
+        return True
+
+    def _remove_entry(self, conn: sqlite3.Connection, key: str, path: str) -> None:
+        shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+        conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+        conn.execute("DELETE FROM symlinks WHERE key = ?", (key,))
+
+    def prune(self, max_bytes: int = None, max_age_days: float = None, keep: set[str] = None) -> list[str]:
+        """
+        Evict entries not accessed for `max_age_days`, then least recently used
+        entries until the cache fits in `max_bytes` (defaults to the cache budget).
+        Entries linked into a project are neither evicted nor counted in the budget.
+        :param keep: keys that must not be evicted, e.g. the entry just fetched
+        :return: the urls of the evicted entries
+        """
+        max_bytes = max_bytes if max_bytes is not None else self.max_bytes
+        removed = []
+        with self._connect() as conn:
+            rows = [
+                row
+                for row in conn.execute("SELECT key, url, path, size, last_access FROM entries ORDER BY last_access").fetchall()
+                if not self._is_linked(conn, row[0], row[2])
+            ]
+            total = sum(row[3] for row in rows)
+            oldest_access = time.time() - max_age_days * 86400 if max_age_days is not None else None
+            for key, url, path, size, last_access in rows:
+                if keep and key in keep:
+                    continue
+                too_old = oldest_access is not None and last_access < oldest_access
+                too_big = max_bytes is not None and total > max_bytes
+                if not (too_old or too_big):
+                    continue
+                self._remove_entry(conn, key, path)
+                total -= size
+                removed.append(url)
+        if removed:
+            logger.info(f"Evicted {len(removed)} entries from the GEO cache")
+        return removed
+
+    def stats(self) -> dict:
+        with self._connect() as conn:
+            entries, total = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+            evictable = sum(
+                size
+                for key, path, size in conn.execute("SELECT key, path, size FROM entries").fetchall()
+                if not self._is_linked(conn, key, path)
+            )
+            accessions = conn.execute("SELECT COUNT(DISTINCT accession) FROM entries").fetchone()[0]
+            oldest = conn.execute("SELECT MIN(last_access) FROM entries").fetchone()[0]
+        return {
+            "root": self.root,
+            "entries": entries,
+            "accessions": accessions,
+            "total_bytes": total,
+            # bytes held only by the cache, what `prune` can free
+            "evictable_bytes": evictable,
+            "max_bytes": self.max_bytes,
+            "oldest_access": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(oldest)) if oldest else None,
+        }
+
+    def verify(self, remove_invalid: bool = False) -> dict[str, list[str]]:
+        """
+        Check that every entry exists, has its recorded size and, for gzip files, a valid CRC.
+        """
+        res = {"missing": [], "corrupted": []}
+        with self._connect() as conn:
+            rows = conn.execute("SELECT key, url, path, size FROM entries").fetchall()
+            for key, url, path, size in rows:
+                if not os.path.exists(path):
+                    res["missing"].append(url)
+                elif not verify_downloaded_file(path, size):
+                    res["corrupted"].append(url)
+                else:
+                    continue
+                if remove_invalid:
+                    self._remove_entry(conn, key, path)
+        return res
+
+
+_geo_cache = None
+_geo_cache_lock = threading.Lock()
+
+
+def get_geo_cache() -> GeoCache:
+    """
+    Return the process-wide cache rooted at `GEO_CACHE_DIR`.
+    """
+    global _geo_cache
+    with _geo_cache_lock:
+        if _geo_cache is None:
+            _geo_cache = GeoCache()
+        return _geo_cache
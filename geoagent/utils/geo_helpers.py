@@ -1,28 +1,57 @@
+import asyncio
 import gzip
+import io
+import itertools
+import json
 import os
 import shutil
 import tarfile
 import tempfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import TYPE_CHECKING
 from urllib.parse import quote
 
-import pandas as pd
-import GEOparse
-import h5py
 import requests
-import scipy
-from bs4 import BeautifulSoup
-from GEOparse.GEOTypes import GSE, GSM
-from scispacy.candidate_generation import CandidateGenerator
 
 from geoagent.types import FileType
 from geoagent.utils.logger import geoagent_logger as logger
-from geoagent.utils.file_helpers import download_from_ftp_url, list_files
-
-GEO_PATH = os.getenv("GEO_CACHE_DIR") or os.path.join(tempfile.gettempdir(), "geo")
-if not os.path.exists(GEO_PATH):
-    os.mkdir(GEO_PATH)
-
-GEO_BASE_URL = "https://www.ncbi.nlm.nih.gov"
+from geoagent.utils.archive_helpers import cached_member_index, extract_members, index_archive, open_member
+from geoagent.utils.download_planner import DownloadPlan, plan_downloads
+from geoagent.utils.downloader import (
+    COUNT_MATRIX_FILTER, DEFAULT_MAX_PER_HOST, DownloadFilter, DownloadResult, DownloadTask, ParallelDownloader,
+)
+from geoagent.utils.file_helpers import (
+    count_lines, file_sha256, get_remote_file_info, gzip_uncompressed_size, is_download_artifact,
+)
+from geoagent.utils.file_inventory import get_file_inventory
+from geoagent.utils.geo_cache import GEOAGENT_HOME, get_geo_cache
+from geoagent.utils.http_helpers import NCBI_API_KEY, http_request
+from geoagent.utils.metadata_store import METADATA_DB_FILE, MetadataStore
+from geoagent.utils.search_parser import GEO_BASE_URL, parse_search_page
+from geoagent.utils.soft_parser import SoftEntity, SoftSeries, read_soft_metadata
+
+if TYPE_CHECKING:
+    from GEOparse.GEOTypes import GSE, GSM
+
+# GEOparse, h5py, scipy and scispacy are imported by the functions using them,
+# so that searching or downloading does not pay for loading them
+
+# default download root of the GEO records, kept apart from the content-addressed cache
+GEO_PATH = os.getenv("GEO_DATA_DIR") or os.path.join(GEOAGENT_HOME, "records")
+# the number of lines shown when peeking into a file
+PEEK_LINES = 10
+# compressed h5 / mat files are inflated in memory below this size, otherwise to a temporary file
+MAX_IN_MEMORY_INFLATE = 512 * 1024**2
+_PEEK_TEXT_EXTENSIONS = (".txt", ".csv", ".tsv", ".mtx", ".tab", ".json")
+
+EUTILS_BASE_URL = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils"
+GEO_FTP_URL = "ftp://ftp.ncbi.nlm.nih.gov"
+# the largest page size offered by the GEO DataSets web page
+GEO_PAGE_SIZE = 100
+_PAGE_SIZE_FIELD = "EntrezSystem2.PEntrez.Gds.Gds_ResultsPanel.Gds_DisplayBar.PageSize"
+_CURR_PAGE_FIELD = "EntrezSystem2.PEntrez.Gds.Gds_ResultsPanel.Entrez_Pager.CurrPage"
 BASE_HEADER = {
     "authority": "www.ncbi.nlm.nih.gov",
     "accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7",
@@ -44,131 +73,183 @@ BASE_HEADER = {
 }
 
 
-def _request_url(url, data, headers) -> BeautifulSoup:
-    response = requests.post(url=url, headers=headers, data=data, timeout=20)
-    response.encoding = "utf-8"
-    html = response.text
-    bs = BeautifulSoup(html, "lxml")
-    return bs
+def _request_url(url, data, headers) -> bytes:
+    response = http_request("POST", url=url, headers=headers, data=data)
+    return response.content
 
 
-def _format_key(string):
-    return string.lower().replace(" ", "_")
+def _iter_html_records(keyword: str, max_records: int, page_size: int):
+    page_size = min(page_size, max_records)
+    seen = set()
+    page = 1
+    while len(seen) < max_records:
+        payload = (
+            f"term={quote(keyword)}"
+            f"&{_PAGE_SIZE_FIELD}={page_size}"
+            f"&{_CURR_PAGE_FIELD}={page}"
+            f"&EntrezSystem2.PEntrez.DbConnector.Cmd=PageChanged"
+        )
+        html = _request_url(url=GEO_BASE_URL + "/gds", data=payload, headers=BASE_HEADER)
+
+        records = parse_search_page(html)
+        if not records:
+            if page == 1:
+                logger.info("Failed to find records")
+            return
+
+        new_records = 0
+        for article_info in records:
+            # stop if the server served a page we have already seen
+            if article_info["accession"] in seen:
+                continue
+            seen.add(article_info["accession"])
+            new_records += 1
+            yield article_info
+            if len(seen) >= max_records:
+                return
+
+        if new_records == 0 or len(records) < page_size:
+            return
+        page += 1
+
+
+def _eutils_params(**kwargs) -> dict:
+    params = {"db": "gds", "retmode": "json", **kwargs}
+    if NCBI_API_KEY:
+        params["api_key"] = NCBI_API_KEY
+    return params
+
+
+def _format_esummary(summary: dict) -> dict:
+    article_info = {
+        "title": summary.get("title", ""),
+        "summary": summary.get("summary", ""),
+        "organism": summary.get("taxon", ""),
+        "type": summary.get("gdstype", ""),
+        "platform": "; ".join(f"GPL{x}" for x in summary.get("gpl", "").split(";") if x),
+        "samples": summary.get("n_samples"),
+        "published": summary.get("pdat", ""),
+        "accession": summary.get("accession", ""),
+        "id": summary.get("uid", ""),
+        "ftp_link": summary.get("ftplink", ""),
+    }
+    article_info["url"] = f"{GEO_BASE_URL}/geo/query/acc.cgi?acc={article_info['accession']}"
+    return article_info
+
+
+def _iter_eutils_records(keyword: str, max_records: int, page_size: int):
+    response = http_request(
+        "GET",
+        EUTILS_BASE_URL + "/esearch.fcgi",
+        params=_eutils_params(term=keyword, usehistory="y", retmax=0),
+    )
+    search_result = response.json()["esearchresult"]
+    total = min(int(search_result.get("count", 0)), max_records)
+    if total == 0:
+        logger.info("Failed to find records")
+        return
+
+    for retstart in range(0, total, page_size):
+        response = http_request(
+            "GET",
+            EUTILS_BASE_URL + "/esummary.fcgi",
+            params=_eutils_params(
+                query_key=search_result["querykey"],
+                WebEnv=search_result["webenv"],
+                retstart=retstart,
+                retmax=min(page_size, total - retstart),
+            ),
+        )
+        summaries = response.json()["result"]
+        for uid in summaries.get("uids", []):
+            yield _format_esummary(summaries[uid])
 
 
-def search_geo_records(keyword: str, max_records: int = 10) -> list[dict]:
+def iter_geo_records(keyword: str, max_records: int = 10, page_size: int = GEO_PAGE_SIZE, backend: str = "html"):
     """
-    Search for GEO records based on the given keyword
+    Lazily search for GEO records based on the given keyword, page by page
     :param keyword: the keyword to search for
     :param max_records: the maximum number of records to return
-    :return: a list of dictionaries containing the search results
+    :param page_size: the number of records requested per page
+    :param backend: `html` to parse the GEO DataSets web page, `eutils` to use the E-utilities JSON API
+    :return: a generator of dictionaries containing the search results
     """
-    result = []
+    if backend == "html":
+        records = _iter_html_records(keyword, max_records, page_size)
+    elif backend == "eutils":
+        records = _iter_eutils_records(keyword, max_records, page_size)
+    else:
+        raise ValueError(f"Unsupported search backend: {backend}. Available backends: html, eutils")
 
     try:
-        payload = f"term={quote(keyword)}&EntrezSystem2.PEntrez.Gds.Gds_ResultsPanel.Gds_DisplayBar.PageSize={max_records}"
-        bs = _request_url(url=GEO_BASE_URL + "/gds", data=payload, headers=BASE_HEADER)
+        yield from records
     except requests.exceptions.RequestException as e:
         logger.error(f"Failed to request: {e}")
-        return result
 
-    rprts = bs.find_all("div", attrs={"class": "rprt"})
-    if not rprts:
-        logger.info("Failed to find records")
-        return result
-
-    for rprt in rprts:
-        title = rprt.find("p", attrs={"class": "title"}).text.strip()
-        article_info = {"title": title}
-
-        supp = rprt.find("div", attrs={"class": "supp"})
-        if supp:
-            try:
-                summary = (
-                    supp.text.replace("more...", "")
-                    .replace("(Submitter supplied) ", "")
-                    .split("Organism")[0]
-                    .strip()
-                )
-                article_info["summary"] = summary
-            except Exception as summary_e:
-                logger.error(f"Failed to get summary: {summary_e}")
-
-            details = supp.find_all("dl", attrs={"class": "details"})
-            if details:
-                for detail in details:
-                    try:
-                        dt = detail.find("dt").text.replace(":", "").strip()
-                        dd = detail.find("dd").text.strip()
-                        article_info[_format_key(dt)] = dd
-                    except Exception as detail_e:
-                        logger.error(f"Failed to get detail: {detail_e}")
-                        continue
-
-        aux = rprt.find("div", attrs={"class": "aux"})
-        if aux:
-            rprtids = aux.find_all("dl", attrs={"class": "rprtid"})
-            if rprtids:
-                for rprtid in rprtids:
-                    try:
-                        dt = rprtid.find("dt").text.replace(":", "").strip()
-                        dd = rprtid.find("dd").text.strip()
-                        article_info[_format_key(dt)] = dd
-                    except Exception as rprtid_e:
-                        logger.error(f"Failed to get rprtid: {rprtid_e}")
-                        continue
-            try:
-                links = aux.find("p", attrs={"class": "links"})
-                a_tags = links.find_all("a")
-                if a_tags:
-                    for a_tag in a_tags:
-                        article_info[_format_key(a_tag.text)] = (
-                            GEO_BASE_URL + a_tag.attrs.get("href")
-                        )
-            except Exception as links_e:
-                logger.error(f"Failed to get links: {links_e}")
-        article_info["url"] = (
-            f"{GEO_BASE_URL}/geo/query/acc.cgi?acc={article_info['accession']}"
-        )
 
-        result.append(article_info)
+def search_geo_records(keyword: str, max_records: int = 10, backend: str = "html") -> list[dict]:
+    """
+    Search for GEO records based on the given keyword
+    :param keyword: the keyword to search for
+    :param max_records: the maximum number of records to return
+    :param backend: `html` or `eutils`, see `iter_geo_records`
+    :return: a list of dictionaries containing the search results
+    """
+    return list(iter_geo_records(keyword, max_records=max_records, backend=backend))
 
-    return result
 
+async def search_geo_records_async(
+    keywords: list[str], max_records: int = 10, parallel: int = 8, backend: str = "html"
+) -> dict[str, list[dict]]:
+    """
+    Search GEO records for many keywords concurrently
+    :param keywords: the keywords to search for
+    :param max_records: the maximum number of records to return per keyword
+    :param parallel: the maximum number of searches in flight
+    :param backend: `html` or `eutils`, see `iter_geo_records`
+    :return: a dictionary mapping each keyword to its search results
+    """
+    semaphore = asyncio.Semaphore(max(1, parallel))
 
-class UMLSMapper:
-    def __init__(self, threshold):
-        self.candidate_generator = CandidateGenerator(name="umls")
-        self.kb = self.candidate_generator.kb
-        self.threshold = threshold
+    async def _search(keyword: str) -> list[dict]:
+        async with semaphore:
+            # requests are issued through the shared rate limited session
+            return await asyncio.to_thread(search_geo_records, keyword, max_records, backend)
 
-    def __call__(self, disease):
-        if disease is None:
-            return None
-        predicted = []
-        batch_candidates = self.candidate_generator([disease], 30)
-        for cand in batch_candidates[0]:
-            score = max(cand.similarities)
-            if (
-                score < self.threshold
-                or self.kb.cui_to_entity[cand.concept_id].definition is None
-            ):
-                continue
-            if score > self.threshold:
-                predicted.append((cand.concept_id, score))
-
-        if len(predicted) > 0:
-            sorted_predicted = sorted(predicted, reverse=True, key=lambda x: x[1])[0]
-            entity = self.kb.cui_to_entity[sorted_predicted[0]]
-            name = f"{entity.canonical_name} [{entity.concept_id}]"
-            return name
-        else:
-            return disease
+    results = await asyncio.gather(*[_search(keyword) for keyword in keywords])
+    return dict(zip(keywords, results))
 
 
-def get_geo(geo_id, return_gse=False) -> GSM | tuple[GSM, GSE]:
+def search_geo_records_batch(
+    keywords: list[str], max_records: int = 10, parallel: int = 8, backend: str = "html"
+) -> dict[str, list[dict]]:
+    """
+    Blocking wrapper of `search_geo_records_async`
+    """
+    return asyncio.run(search_geo_records_async(keywords, max_records=max_records, parallel=parallel, backend=backend))
+
+
+def load_geo(geo_id: str, destdir: str = None, silent: bool = True, metadata_only: bool = False) -> "GSM | GSE | SoftEntity":
+    """
+    Load a GEO record from the shared cache, fetching its SOFT file on first use.
+    :param destdir: if given, the SOFT file is also linked into this directory
+    :param metadata_only: stream the metadata of the record and its samples instead
+        of building GEOparse objects with their data tables
+    """
+    cache = get_geo_cache()
+    soft_path = cache.fetch_soft(geo_id)
+    if destdir:
+        soft_path = cache.link_into(soft_path, destdir)
+    if metadata_only:
+        return read_soft_metadata(soft_path)
+    import GEOparse
+
+    return GEOparse.get_GEO(filepath=soft_path, silent=silent)
+
+
+def get_geo(geo_id, return_gse=False, metadata_only=False) -> "GSM | tuple[GSM, GSE]":
     if return_gse:
-        gsm = GEOparse.get_GEO(geo=geo_id, destdir=GEO_PATH, silent=True)
+        gsm = load_geo(geo_id, metadata_only=metadata_only)
 
         gse = gsm.get_metadata_attribute("series_id")
         if isinstance(gse, list):
@@ -176,16 +257,34 @@ def get_geo(geo_id, return_gse=False) -> GSM | tuple[GSM, GSE]:
                 f"Multiple GSE IDs found for {geo_id}: {gse}, using the first one"
             )
             gse = gse[0]
-        gse = GEOparse.get_GEO(geo=gse, destdir=GEO_PATH, silent=True)
+        gse = load_geo(gse, metadata_only=metadata_only)
         return gsm, gse
-    return GEOparse.get_GEO(geo=geo_id, destdir=GEO_PATH, silent=True)
+    return load_geo(geo_id, metadata_only=metadata_only)
+
 
 def _get_gsm_supp_files(gsm_meta: dict) -> list:
     supp_files = [v for k, v in gsm_meta.items() if k.startswith("supplementary_file")]
     return [f for sublist in supp_files for f in sublist]
 
 
-def get_metadata(geo_id: str, parse_subsamples: bool = False, cache_dir: str=None) -> dict:
+def _get_sub_metadata(gse: SoftSeries, dest_dir: str, parallel: int = 1) -> dict[str, dict]:
+    """
+    Read GSM metadata from the family SOFT file of the GSE, which already contains
+    every sample, and only fetch the samples missing from it.
+    """
+    sub_samples = gse.metadata["sample_id"]
+    sub_metadata = {k: gse.gsms[k].metadata for k in sub_samples if k in gse.gsms}
+    missing = [k for k in sub_samples if k not in sub_metadata]
+    if missing:
+        logger.info(f"Fetching {len(missing)} samples missing from the family file of {gse.name}")
+        with ThreadPoolExecutor(max_workers=max(1, parallel)) as executor:
+            fetched = executor.map(lambda k: load_geo(k, destdir=dest_dir, metadata_only=True).metadata, missing)
+            sub_metadata.update(zip(missing, fetched))
+    # keep the sample order of the series
+    return {k: sub_metadata[k] for k in sub_samples}
+
+
+def get_metadata(geo_id: str, parse_subsamples: bool = False, cache_dir: str=None, parallel: int = 1) -> dict:
     _metadata = {
         "metadata": "",
         "supp_files":  [],
@@ -195,22 +294,22 @@ def get_metadata(geo_id: str, parse_subsamples: bool = False, cache_dir: str=Non
     }
     dest_dir = cache_dir if cache_dir else GEO_PATH
     try:
-        _geo = GEOparse.get_GEO(geo=geo_id, destdir=dest_dir)
+        _geo = load_geo(geo_id, destdir=dest_dir, metadata_only=True)
     except Exception as e:
         logger.error(f"Failed to get metadata for {geo_id} due to {e}")
         return _metadata
     
     _metadata["metadata"] = _geo.metadata
-    if isinstance(_geo, GSM):
+    if _geo.geotype == "GSM":
         _metadata["supp_files"] += _get_gsm_supp_files(_geo.metadata)
 
-    elif isinstance(_geo, GSE):
+    elif _geo.geotype == "GSE":
         _metadata["supp_files"] = _geo.metadata["supplementary_file"]
         sub_samples = _geo.metadata["sample_id"]
         if sub_samples:
             _metadata["sub_samples"] = len(sub_samples)
             if parse_subsamples:
-                _metadata["sub_metadata"] = {k: GEOparse.get_GEO(geo=k, destdir=dest_dir).metadata for k in sub_samples}
+                _metadata["sub_metadata"] = _get_sub_metadata(_geo, dest_dir, parallel=parallel)
                 _metadata["sub_supp_files"] = [_get_gsm_supp_files(_metadata["sub_metadata"].get(x)) for x in _metadata["sub_metadata"]]
 
     else:
@@ -220,68 +319,283 @@ def get_metadata(geo_id: str, parse_subsamples: bool = False, cache_dir: str=Non
 
     return _metadata
 
-def download_supp_files(geo_id: str, cache_path: str = None):
 
+def get_metadata_batch(
+    geo_ids: list[str], parse_subsamples: bool = False, cache_path: str = None, parallel: int = 1
+) -> dict[str, dict]:
+    """
+    Extract the metadata of many GEO records concurrently
+    :param geo_ids: the GEO accessions
+    :param parse_subsamples: whether to extract the metadata of the GSMs of each GSE
+    :param cache_path: if given, SOFT files are linked into `<cache_path>/<geo_id>/Soft`
+    :param parallel: the number of records processed at the same time
+    :return: a dictionary mapping each accession to the output of `get_metadata`
+    """
+
+    def _get(geo_id: str) -> dict:
+        soft_dir = os.path.join(cache_path, geo_id, "Soft") if cache_path else None
+        return get_metadata(geo_id, parse_subsamples=parse_subsamples, cache_dir=soft_dir, parallel=parallel)
+
+    with ThreadPoolExecutor(max_workers=max(1, parallel)) as executor:
+        return dict(zip(geo_ids, executor.map(_get, geo_ids)))
+
+
+def get_soft_url(geo_id: str) -> str | None:
+    """
+    FTP URL of the family SOFT file of a GSE, e.g. `.../geo/series/GSE123nnn/GSE123456/soft/GSE123456_family.soft.gz`
+    """
+    if not geo_id.startswith("GSE"):
+        return None
+    stub = f"GSE{geo_id[3:-3]}nnn"
+    return f"{GEO_FTP_URL}/geo/series/{stub}/{geo_id}/soft/{geo_id}_family.soft.gz"
+
+
+def _refresh_record(
+    geo_id: str, store: MetadataStore, parse_subsamples: bool, cache_path: str, parallel: int, force: bool
+) -> tuple[str, dict | None, dict]:
+    """
+    Re-extract the metadata of a record only if its SOFT file changed since the last refresh.
+    :return: the status (`new`, `updated` or `unchanged`), the metadata if extracted and the manifest fields
+    """
+    entry = store.get_manifest(geo_id)
+    remote = {"size": None, "mtime": None}
+    soft_url = get_soft_url(geo_id)
+    if soft_url:
+        try:
+            remote = get_remote_file_info(soft_url)
+        except Exception as e:
+            logger.error(f"Failed to check the SOFT file of {geo_id} due to {e}")
+    manifest = {"remote_size": remote["size"], "remote_mtime": remote["mtime"]}
+
+    # cheap check first: the remote SOFT file did not change
+    if (
+        not force
+        and entry is not None
+        and remote["size"] is not None
+        and (entry["remote_size"], entry["remote_mtime"]) == (remote["size"], remote["mtime"])
+    ):
+        return "unchanged", None, manifest
+
+    cache = get_geo_cache()
+    cached_path = cache.get_soft(geo_id)
+    stale = cached_path is not None and (
+        entry is not None or (remote["size"] is not None and os.path.getsize(cached_path) != remote["size"])
+    )
+    soft_path = cache.fetch_soft(geo_id, refresh=stale)
+    manifest["soft_sha256"] = file_sha256(soft_path)
+    if not force and entry is not None and entry["soft_sha256"] == manifest["soft_sha256"]:
+        return "unchanged", None, manifest
+
+    soft_dir = os.path.join(cache_path, geo_id, "Soft") if cache_path else None
+    info = get_metadata(geo_id, parse_subsamples=parse_subsamples, cache_dir=soft_dir, parallel=parallel)
+    if info["metadata"]:
+        manifest["last_update_date"] = info["metadata"].get("last_update_date", [None])[0]
+    return ("new" if entry is None else "updated"), info, manifest
+
+
+def refresh_metadata(
+    geo_ids: list[str],
+    store: MetadataStore,
+    parse_subsamples: bool = False,
+    cache_path: str = None,
+    parallel: int = 1,
+    force: bool = False,
+) -> dict[str, list[str]]:
+    """
+    Incrementally refresh the metadata store. Records whose remote SOFT file (size and
+    modification time) or SOFT file hash match the manifest are skipped, the others are
+    re-extracted and merged into the store.
+    :param force: re-extract every record, the manifest is still updated
+    :return: the accessions grouped by status (`new`, `updated`, `unchanged`)
+    """
+
+    def _refresh(geo_id: str):
+        return _refresh_record(geo_id, store, parse_subsamples, cache_path, parallel, force)
+
+    res = {"new": [], "updated": [], "unchanged": []}
+    with ThreadPoolExecutor(max_workers=max(1, parallel)) as executor:
+        for geo_id, (status, info, manifest) in zip(geo_ids, executor.map(_refresh, geo_ids)):
+            if info is not None:
+                if not info["metadata"]:
+                    # extraction failed, retry on the next refresh
+                    continue
+                store.write_records({geo_id: info})
+            store.update_manifest(geo_id, **manifest)
+            res[status].append(geo_id)
+    logger.info(f"Metadata refresh: { {k: len(v) for k, v in res.items()} }")
+    return res
+
+
+def get_supp_file_tasks(geo_id: str, cache_path: str = None, raise_errors: bool = False) -> list[DownloadTask]:
+    """
+    Fetch the SOFT file of a GEO record and list the supplementary files to download.
+    GSE level files go to `<geo_id>/Supp`, GSM level files go to `<geo_id>/<gsm_id>`.
+    :param raise_errors: raise when the SOFT file cannot be fetched, instead of returning no files
+    """
     cache_root_dir = os.path.join(cache_path if cache_path else GEO_PATH, geo_id)
     soft_dir = os.path.join(cache_root_dir, "Soft")
     supp_dir = os.path.join(cache_root_dir, "Supp")
 
     try:
-         _geo = GEOparse.get_GEO(geo_id, destdir=soft_dir)
-    except OSError as e:
+        _geo = load_geo(geo_id, destdir=soft_dir, metadata_only=True)
+    except (OSError, ValueError) as e:
         logger.error(f"Failed to download {geo_id} due to {e}")
-        return
+        if raise_errors:
+            raise
+        return []
+
+    tasks = []
+    # supp files of sub samples
+    if _geo.geotype == "GSE":
+        for gsm_id, gsm in _geo.gsms.items():
+            gsm_dir = os.path.join(cache_root_dir, gsm_id)
+            for file in _get_gsm_supp_files(gsm.metadata):
+                if file != "NONE":
+                    tasks.append(DownloadTask(file, gsm_dir, gsm_id, series=geo_id))
+
+    # supp files of current geo if any
+    if _geo.geotype == "GSM":
+        current_geo_supp_files = _get_gsm_supp_files(_geo.metadata)
+    else:
+        current_geo_supp_files = _geo.metadata.get("supplementary_file", [])
+    for file in current_geo_supp_files:
+        if file != "NONE":
+            tasks.append(DownloadTask(file, supp_dir, geo_id, series=geo_id if _geo.geotype == "GSE" else None))
+    return tasks
+
+
+def _collect_supp_file_tasks(geo_ids: list[str], cache_path: str = None, parallel: int = 1) -> list[DownloadTask]:
+    with ThreadPoolExecutor(max_workers=max(1, parallel)) as executor:
+        task_lists = list(executor.map(lambda x: get_supp_file_tasks(x, cache_path), geo_ids))
+    tasks = [task for task_list in task_lists for task in task_list]
+    logger.info(f"Found {len(tasks)} supplementary files for {len(geo_ids)} records")
+    return tasks
+
+
+def plan_supp_files(
+    geo_ids: list[str],
+    cache_path: str = None,
+    parallel: int = 1,
+    max_per_host: int = DEFAULT_MAX_PER_HOST,
+    file_types: list[str] = None,
+    max_file_size: int | str = None,
+    budget: int | str = None,
+    file_filter: DownloadFilter = None,
+) -> DownloadPlan:
+    """
+    List the supplementary files of many GEO records with their remote size, and select
+    the ones to download, see `plan_downloads`. The sizes are recorded in the metadata
+    store of `cache_path` when there is one.
+    """
+    tasks = _collect_supp_file_tasks(geo_ids, cache_path, parallel)
+    plan = plan_downloads(
+        tasks,
+        file_types=file_types,
+        max_file_size=max_file_size,
+        budget=budget,
+        file_filter=file_filter,
+        max_per_host=max_per_host,
+    )
+    metadata_path = os.path.join(cache_path if cache_path else GEO_PATH, METADATA_DB_FILE)
+    if os.path.exists(metadata_path):
+        MetadataStore(metadata_path).set_file_sizes({task.url: task.size for task in tasks})
+    return plan
+
+
+def download_many_supp_files(
+    geo_ids: list[str],
+    cache_path: str = None,
+    parallel: int = 1,
+    max_per_host: int = DEFAULT_MAX_PER_HOST,
+    file_types: list[str] = None,
+    max_file_size: int | str = None,
+    budget: int | str = None,
+    file_filter: DownloadFilter = None,
+) -> list[DownloadResult]:
+    """
+    Download the supplementary files of many GEO records through one shared worker pool.
+    :param geo_ids: the GEO accessions to download
+    :param cache_path: the root directory, each record is stored in `<cache_path>/<geo_id>`
+    :param parallel: the maximum number of concurrent transfers
+    :param max_per_host: the maximum number of concurrent transfers against one host
+    :param file_types: only download these file types, e.g. `["mtx", "h5", "tsv"]`
+    :param max_file_size: skip files above this size, e.g. `5G`
+    :param budget: the maximum total size to download, e.g. `200G`
+    :param file_filter: include / exclude rules, applied by the downloader to GSE and GSM level files,
+        e.g. `COUNT_MATRIX_FILTER`
+    :return: the result of every file transfer
+    """
+    if file_types or max_file_size is not None or budget is not None:
+        # the files are selected on their type and remote size before anything is transferred
+        plan = plan_supp_files(
+            geo_ids, cache_path, parallel, max_per_host, file_types, max_file_size, budget, file_filter=file_filter
+        )
+        logger.info(f"Download plan: {json.dumps({k: v for k, v in plan.summary().items() if k in ('files', 'bytes', 'skipped')})}")
+        tasks = plan.tasks
+    else:
+        tasks = _collect_supp_file_tasks(geo_ids, cache_path, parallel)
+
+    inventory = get_file_inventory(cache_path if cache_path else GEO_PATH)
 
-    # download supp files of sub samples
-    _geo.download_supplementary_files(directory=cache_root_dir, download_sra=False)
+    def on_complete(result: DownloadResult):
+        if result.success:
+            inventory.add_file(os.path.join(result.task.data_dir, os.path.basename(result.task.url)))
 
-    # download supp files of current geo if any
-    current_geo_supp_files = _geo.metadata.get("supplementary_file", [])
-    if current_geo_supp_files:
-        for file in current_geo_supp_files:
-            download_from_ftp_url(file, supp_dir)
+    downloader = ParallelDownloader(
+        max_workers=parallel,
+        max_per_host=max_per_host,
+        log_dir=cache_path if cache_path else GEO_PATH,
+        cache=get_geo_cache(),
+        on_complete=on_complete,
+        file_filter=file_filter,
+    )
+    return downloader.download(tasks)
+
+
+def download_supp_files(geo_id: str, cache_path: str = None, parallel: int = 1) -> list[DownloadResult]:
+    return download_many_supp_files([geo_id], cache_path=cache_path, parallel=parallel)
 
 
 def list_downloaded_files(cache_path: str, exclude_suffixes: list[str] = None) -> dict[str, list[str]]:
     """
     List downloaded files for each GEO record in cache path.
+    The file inventory of the cache path is refreshed, only directories changed since the last call are listed.
     
     Args:
         cache_path (str): Path to the cache directory containing GEO record folders
+        exclude_suffixes (list[str], optional): File suffixes to leave out (e.g., ['.soft.gz'])
         
     Returns:
-        dict[str, list[str]]: Dictionary mapping GEO IDs to their downloaded files
-    """
-    downloaded_files = {}
-    sub_dirs = [d for d in os.listdir(cache_path) if os.path.isdir(os.path.join(cache_path, d))]
-
-    for geo_id in sub_dirs:
-        geo_dir = os.path.join(cache_path, geo_id)
-        if os.path.isdir(geo_dir):
-            
-            downloaded_files[geo_id] = list_files(geo_dir, exclude_suffixes)
-            
-    return downloaded_files
-    
+        dict[str, list[str]]: Dictionary mapping GEO IDs to their downloaded files,
+            relative to the record folder (e.g., 'GSM1/GSM1_matrix.mtx.gz', 'Supp/GSE1_RAW.tar')
+    """
+    inventory = get_file_inventory(cache_path)
+    inventory.refresh()
+    return inventory.list_records(exclude_suffixes)
+
 
-def process_lines(file_handle):
+def process_lines(file_handle, max_lines: int = PEEK_LINES, total_lines: int = None, uncompressed_size: int = None):
     """
-    Process the file lines, truncating if necessary.
+    Process the first lines of the file, truncating if necessary.
+    Only `max_lines` lines are read, the line count is `total_lines` if given, otherwise
+    it is estimated from `uncompressed_size` and the length of the lines read.
     """
     lines = []
-    counts = 0
-    while True:
-        line = file_handle.readline()
-        if not line:
-            break  # End of file reached
-        counts += 1
-        if counts > 10:
-            continue
+    n_bytes = 0
+    for line in itertools.islice(file_handle, max_lines):
+        n_bytes += len(line.encode("utf-8", errors="replace"))
         if len(line) > 100:
             line = line[:100] + f"... [{len(line) - 100} characters truncated]"
         lines.append(line)
+    n_peeked = len(lines)
     lines.append("...")
-    lines.append(f"[Total {counts} lines]")
+    if total_lines is None and n_peeked < max_lines:
+        # the whole file was read
+        total_lines = n_peeked
+    if total_lines is not None:
+        lines.append(f"[Total {total_lines} lines]")
+    elif uncompressed_size is not None and n_bytes:
+        lines.append(f"[About {max(n_peeked, round(uncompressed_size * n_peeked / n_bytes))} lines]")
     return "\n".join(lines)
 
 
@@ -289,6 +603,8 @@ def process_h5_file(file_handle):
     """
     Generate a summary of the HDF5 file's structure and dataset details.
     """
+    import h5py
+
     summary = []
 
     def summarize(name, obj):
@@ -319,93 +635,190 @@ def extract_mat_summary(mat_contents):
 
 
 def process_soft_files(
-    soft_file_path: str, max_gsms_per_gse: int = None
-) -> list[tuple[GSM, GSE]]:
+    soft_file_path: str, max_gsms_per_gse: int = None, metadata_only: bool = True
+) -> "list[tuple[GSM, GSE]] | list[tuple[SoftEntity, SoftSeries]]":
     try:
-        geo = GEOparse.get_GEO(filepath=soft_file_path, silent=True)
-    except EOFError as e:
+        if metadata_only:
+            geo = read_soft_metadata(soft_file_path)
+        else:
+            import GEOparse
+
+            geo = GEOparse.get_GEO(filepath=soft_file_path, silent=True)
+    except (EOFError, ValueError) as e:
         logger.error(f"Error parsing {soft_file_path}: {e}")
         return []
 
-    if isinstance(geo, GSE):
+    if geo.geotype == "GSE":
         gsms = list(geo.gsms.values())
         if max_gsms_per_gse:
             gsms = gsms[:max_gsms_per_gse]
         return [(gsm, geo) for gsm in gsms]
-    elif isinstance(geo, GSM):
-        return [get_geo(geo.get_accession(), return_gse=True)]
+    elif geo.geotype == "GSM":
+        return [get_geo(geo.get_accession(), return_gse=True, metadata_only=metadata_only)]
 
 
-def _peek_file_content(filename: str, directory: str):
+@contextmanager
+def _seekable_gzip(filepath: str):
+    """
+    Seekable handle on the content of a gzip file for readers that cannot stream (h5py, loadmat),
+    inflated in memory when small enough, otherwise into an anonymous temporary file.
+    """
+    with gzip.open(filepath, "rb") as f:
+        if gzip_uncompressed_size(filepath) <= MAX_IN_MEMORY_INFLATE:
+            handle = io.BytesIO(f.read())
+        else:
+            handle = tempfile.TemporaryFile()
+            shutil.copyfileobj(f, handle)
+            handle.seek(0)
+    try:
+        yield handle
+    finally:
+        handle.close()
+
+
+def _peek_archive(members: list[str], peek: str | None) -> str:
+    summary = [f"Archive members (first {len(members)}):"] + [f"  {x}" for x in members]
+    if peek is not None:
+        summary += [f"Peek of {peek}"]
+    return "\n".join(summary)
+
+
+def _peek_member(handle, name: str) -> str | None:
+    # lines are read in binary, members of a streamed tar are not seekable and TextIOWrapper needs them to be
+    try:
+        if name.lower().endswith(".gz"):
+            handle = gzip.GzipFile(fileobj=handle)
+        return process_lines(line.decode("utf-8", errors="replace") for line in iter(handle.readline, b""))
+    except Exception as e:
+        logger.error(f"Failed to peek into archive member {name}: {e}")
+        return None
+
+
+def _peek_tar(filepath: str, max_members: int = 20) -> str:
+    index = cached_member_index(filepath)
+    if index is not None:
+        # an indexed archive is read at the offset of the peeked member only
+        text = [x.name for x in index if x.name.lower().removesuffix(".gz").endswith(_PEEK_TEXT_EXTENSIONS)]
+        peek = None
+        if text:
+            with open_member(filepath, text[0]) as f:
+                content = _peek_member(f, text[0])
+            peek = f"{text[0]}:\n{content}" if content is not None else None
+        return _peek_archive([x.name for x in index[:max_members]], peek)
+
+    # stream mode reads the archive sequentially and stops after the members listed
+    members, peeks = [], []
+    with tarfile.open(filepath, "r|*") as tar:
+        for member in tar:
+            if len(members) >= max_members:
+                break
+            members.append(member.name)
+            if not peeks and member.isfile() and member.name.lower().removesuffix(".gz").endswith(_PEEK_TEXT_EXTENSIONS):
+                content = _peek_member(tar.extractfile(member), member.name)
+                if content is not None:
+                    peeks.append(f"{member.name}:\n{content}")
+    return _peek_archive(members, peeks[0] if peeks else None)
+
+
+def _peek_zip(filepath: str, max_members: int = 20) -> str:
+    # the member list comes from the central directory, only the peeked member is inflated
+    with zipfile.ZipFile(filepath) as zf:
+        infos = [x for x in zf.infolist() if not x.is_dir()]
+        text = [x for x in infos if x.filename.lower().removesuffix(".gz").endswith(_PEEK_TEXT_EXTENSIONS)]
+        peek = None
+        if text:
+            with zf.open(text[0]) as f:
+                content = _peek_member(f, text[0].filename)
+            peek = f"{text[0].filename}:\n{content}" if content is not None else None
+        return _peek_archive([x.filename for x in infos[:max_members]], peek)
+
+
+def _peek_file_content(filename: str, directory: str, line_count: str = "estimate"):
     """
     This function returns the first 10 lines of the file.
     Lines will be truncated if too long (> 100 characters, total character number info will be added).
-    The file might be a compressed file (e.g., .zip, .gz).
+    The file might be a compressed file (e.g., .zip, .gz, .tar), only the needed prefix is decompressed.
+    :param line_count: `estimate` the number of lines from the file size, count them `exact`ly
+        (reads the whole file), or `none`
     """
     # Construct the full file path
     filepath = os.path.join(directory, filename)
-    logger.info("reading file: {}", filepath)
-
-    chosen_open_func = open
-    if filename.endswith(".gz"):
-        with gzip.open(filepath, "rb") as f:
-            new_filepath = "/tmp/" + filename.removesuffix(".gz")
-            with open(new_filepath, "wb") as f_out:
-                shutil.copyfileobj(f, f_out)
-            filepath = new_filepath
-    filename = filename.removesuffix(".gz")
-
-    if filename.lower().endswith(".h5"):
-        with h5py.File(filepath, "r") as f:
+    logger.info(f"reading file: {filepath}")
+
+    lower_name = filename.lower()
+    if lower_name.endswith((".tar", ".tar.gz", ".tgz")):
+        return _peek_tar(filepath)
+    if lower_name.endswith(".zip"):
+        return _peek_zip(filepath)
+
+    compressed = lower_name.endswith(".gz")
+    lower_name = lower_name.removesuffix(".gz")
+
+    if lower_name.endswith(".h5"):
+        import h5py
+
+        if not compressed:
+            with h5py.File(filepath, "r") as f:
+                return process_h5_file(f)
+        with _seekable_gzip(filepath) as handle, h5py.File(handle, "r") as f:
             return process_h5_file(f)
     # elif any([filename.lower().endswith(ext) for ext in not_avaliable_extensions]):
     #     return NOT_AVAILABLE
-    elif filename.lower().endswith(".mat"):
-        mat_contents = scipy.io.loadmat(filepath)
-        return extract_mat_summary(mat_contents)
+    elif lower_name.endswith(".mat"):
+        import scipy.io
+
+        if not compressed:
+            return extract_mat_summary(scipy.io.loadmat(filepath))
+        with _seekable_gzip(filepath) as handle:
+            return extract_mat_summary(scipy.io.loadmat(handle))
     elif (
-        filename.lower().endswith(".rds")
-        or filename.lower().endswith(".rdata")
-        or filename.lower().endswith(".rdat")
+        lower_name.endswith(".rds")
+        or lower_name.endswith(".rdata")
+        or lower_name.endswith(".rdat")
     ):
         raise NotImplementedError()
     else:
-        with chosen_open_func(filepath, "rt") as f:
-            return process_lines(f)
+        count_kwargs = {}
+        if line_count == "exact":
+            count_kwargs["total_lines"] = count_lines(filepath)
+        elif line_count == "estimate":
+            count_kwargs["uncompressed_size"] = gzip_uncompressed_size(filepath) if compressed else os.path.getsize(filepath)
+        opener = gzip.open if compressed else open
+        with opener(filepath, "rt", encoding="utf-8", errors="replace") as f:
+            return process_lines(f, **count_kwargs)
 
 
-def get_supp_data(gsm_id: str) -> dict:
+def get_supp_data(gsm_id: str, file_filter: DownloadFilter = COUNT_MATRIX_FILTER) -> dict:
+    """
+    Download the supplementary files of a sample and peek into them.
+    :param file_filter: the files to download, by default only what the count-matrix
+        readers use, with the matrices inside `_RAW.tar` archives fetched alone
+    """
     res = {"files": [], "dir": None, "content": []}
-    gsm = get_geo(gsm_id)
-    logger.info("{} will download", gsm_id)
-    gsm.download_supplementary_files(directory=GEO_PATH, download_sra=False)
+    gsm = get_geo(gsm_id, metadata_only=True)
+    logger.info(f"{gsm_id} will download")
+    os.makedirs(GEO_PATH, exist_ok=True)
+    supp_dir = os.path.join(GEO_PATH, f"Supp_{gsm_id}")
+    tasks = [DownloadTask(url, supp_dir, gsm_id) for url in _get_gsm_supp_files(gsm.metadata) if url != "NONE"]
+    ParallelDownloader(log_dir=GEO_PATH, cache=get_geo_cache(), show_progress=False, file_filter=file_filter).download(tasks)
 
     for f in os.listdir(GEO_PATH):
         if os.path.isdir(os.path.join(GEO_PATH, f)) and (gsm_id in f):
-            res["files"] = os.listdir(os.path.join(GEO_PATH, f))
             res["dir"] = os.path.join(GEO_PATH, f)
+            res["archives"] = {}
             new_files = []
-            for gsm_file in res["files"]:
+            for gsm_file in os.listdir(res["dir"]):
+                if is_download_artifact(gsm_file):
+                    continue
                 if ".tar" in gsm_file:
-                    file = tarfile.open(os.path.join(res["dir"], gsm_file))
-                    file.extractall(res["dir"])
-                    file.close()
-
-                    for cur_dir, _, cur_files in os.walk(res["dir"]):
-                        if len(cur_files) > 0:
-                            for cur_file in cur_files:
-                                if cur_file == gsm_file:
-                                    continue
-                                shutil.move(
-                                    os.path.join(cur_dir, cur_file),
-                                    os.path.join(res["dir"], cur_file),
-                                )
-                                new_files.append(cur_file)
-                    new_files = list(set(new_files))  # remove duplicates
+                    # only the members the readers use are extracted, the rest is read from the archive if needed
+                    archive_path = os.path.join(res["dir"], gsm_file)
+                    new_files.extend(extract_members(archive_path, res["dir"]))
+                    res["archives"][gsm_file] = [x.name for x in index_archive(archive_path)]
                 elif os.path.isfile(os.path.join(res["dir"], gsm_file)):
                     new_files.append(gsm_file)
 
-            res["files"] = new_files
+            res["files"] = list(dict.fromkeys(new_files))  # remove duplicates
             for gsm_file in res["files"]:
                 res["content"].append(_peek_file_content(gsm_file, res["dir"]))
             break
@@ -413,20 +826,31 @@ def get_supp_data(gsm_id: str) -> dict:
 
 
 def check_file_type(file_content: dict) -> FileType:
-    file_type = FileType.UNKNOWN
-    for f in file_content["files"]:
-        f = f.lower()
-        if "mtx" in f:
-            file_type = FileType.MTX
-        if "csv" in f or "txt" in f or "tsv" in f:
-            file_type = FileType.TABLE
-        if "rdata" in f:
-            file_type = FileType.RDATA
-        if ".h5." in f:
-            file_type = FileType.H5
-        if ".h5ad." in f:
-            file_type = FileType.H5AD
-    return file_type
+    """
+    Classify the files of a sample by the most specific format present, e.g. a 10x
+    layout is MTX even though its barcodes and features are tsv files.
+    """
+    names = [f.lower().removesuffix(".gz") for f in file_content["files"]]
+    for file_type, matches in (
+        (FileType.H5AD, lambda f: f.endswith(".h5ad")),
+        (FileType.LOOM, lambda f: f.endswith(".loom")),
+        (FileType.H5, lambda f: f.endswith(".h5")),
+        (FileType.MTX, lambda f: "mtx" in f),
+        (FileType.RDATA, lambda f: "rdata" in f),
+        (FileType.TABLE, lambda f: "csv" in f or "txt" in f or "tsv" in f),
+    ):
+        if any(matches(f) for f in names):
+            return file_type
+    return FileType.UNKNOWN
+
+
+def __getattr__(name):
+    # `UMLSMapper` used to live here, import it lazily so scispacy is only loaded on use
+    if name == "UMLSMapper":
+        from geoagent.utils.umls_helpers import UMLSMapper
+
+        return UMLSMapper
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 if __name__ == "__main__":
@@ -441,22 +865,8 @@ if __name__ == "__main__":
             new_files = []
             for gsm_file in res["files"]:
                 if ".tar" in gsm_file:
-                    file = tarfile.open(os.path.join(res["dir"], gsm_file))
-                    file.extractall(res["dir"])
-                    file.close()
-
-                    for cur_dir, _, cur_files in os.walk(res["dir"]):
-                        if len(cur_files) > 0:
-                            for cur_file in cur_files:
-                                if cur_file == gsm_file:
-                                    continue
-                                shutil.move(
-                                    os.path.join(cur_dir, cur_file),
-                                    os.path.join(res["dir"], cur_file),
-                                )
-                                new_files.append(cur_file)
-                    new_files = list(set(new_files))  # remove duplicates
-                elif os.path.isfile(os.path.join(res["dir"], gsm_file)):
+                    new_files.extend(extract_members(os.path.join(res["dir"], gsm_file), res["dir"]))
+                elif os.path.isfile(os.path.join(res["dir"], gsm_file)) and not is_download_artifact(gsm_file):
                     new_files.append(gsm_file)
 
             res["files"] = [x for x in new_files if not x.startswith(".") and not x.endswith("RData.gz")]
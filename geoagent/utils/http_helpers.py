@@ -0,0 +1,76 @@
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+NCBI_API_KEY = os.getenv("NCBI_API_KEY")
+# NCBI allows 3 requests per second without an API key and 10 with one
+NCBI_RATE_LIMIT = float(os.getenv("NCBI_RATE_LIMIT", 10 if NCBI_API_KEY else 3))
+REQUEST_TIMEOUT = float(os.getenv("GEO_REQUEST_TIMEOUT", 20))
+POOL_SIZE = int(os.getenv("GEO_HTTP_POOL_SIZE", 16))
+
+
+class RateLimiter:
+    """
+    Thread-safe limiter that spaces out request starts to at most `rate` per second.
+    """
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next_time = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            wait_time = self._next_time - now
+            self._next_time = max(now, self._next_time) + self.interval
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+
+def _build_session() -> requests.Session:
+    retry = Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        # the GEO search is a POST form, retry it as well
+        allowed_methods=None,
+        respect_retry_after_header=True,
+    )
+    adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+_session = None
+_session_lock = threading.Lock()
+ncbi_rate_limiter = RateLimiter(NCBI_RATE_LIMIT)
+
+
+def get_session() -> requests.Session:
+    """
+    Return the process-wide keep-alive session with retries on 429/5xx.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = _build_session()
+        return _session
+
+
+def http_request(method: str, url: str, timeout: float = REQUEST_TIMEOUT, rate_limited: bool = True, **kwargs) -> requests.Response:
+    """
+    Send a request through the pooled session.
+    :param rate_limited: whether the request counts against the NCBI rate limit
+    """
+    if rate_limited:
+        ncbi_rate_limiter.wait()
+    response = get_session().request(method, url, timeout=timeout, **kwargs)
+    response.raise_for_status()
+    return response
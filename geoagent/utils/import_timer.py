@@ -0,0 +1,88 @@
+import os
+import re
+import subprocess
+import sys
+
+# import time budgets (seconds) and modules that must stay out of each entry point
+IMPORT_BUDGETS = {
+    "geoagent.cli": 0.5,
+    "geoagent.utils.geo_helpers": 1.0,
+}
+FORBIDDEN_IMPORTS = {
+    "geoagent.cli": ["scanpy", "modelscope_agent", "jinja2", "scispacy", "GEOparse", "h5py", "scipy", "pandas"],
+    "geoagent.utils.geo_helpers": ["scanpy", "modelscope_agent", "scispacy", "GEOparse", "h5py", "scipy"],
+}
+
+# e.g. `import time:       143 |       1286 |   geoagent.utils.logger`
+_IMPORTTIME_LINE = re.compile(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s+)(\S+)")
+
+
+def _run_importtime(module: str) -> list[tuple[str, int, int]]:
+    out = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+        env={**os.environ, "PYTHONDONTWRITEBYTECODE": "1"},
+    )
+    rows = []
+    for line in out.stderr.splitlines():
+        match = _IMPORTTIME_LINE.match(line)
+        if match:
+            self_us, cumulative_us, _, name = match.groups()
+            rows.append((name, int(self_us), int(cumulative_us)))
+    return rows
+
+
+def measure_import_time(module: str, repeat: int = 3, top: int = 10) -> dict:
+    """
+    Import `module` in fresh interpreters with `python -X importtime`.
+    :return: the best cumulative time in seconds, the modules it loaded and the slowest of them
+    """
+    best = None
+    for _ in range(repeat):
+        rows = _run_importtime(module)
+        total = next(cumulative for name, _, cumulative in reversed(rows) if name == module)
+        if best is None or total < best[0]:
+            best = (total, rows)
+    total, rows = best
+    slowest = sorted(rows, key=lambda x: x[1], reverse=True)[:top]
+    return {
+        "module": module,
+        "seconds": total / 1e6,
+        "modules": sorted({name for name, _, _ in rows}),
+        "slowest": [{"module": name, "self_seconds": self_us / 1e6} for name, self_us, _ in slowest],
+    }
+
+
+def check_import_budgets(budgets: dict[str, float] = None, forbidden: dict[str, list[str]] = None) -> list[str]:
+    """
+    Measure every entry point and return the budget violations, an empty list means all passed.
+    """
+    budgets = IMPORT_BUDGETS if budgets is None else budgets
+    forbidden = FORBIDDEN_IMPORTS if forbidden is None else forbidden
+    violations = []
+    for module in sorted(set(budgets) | set(forbidden)):
+        result = measure_import_time(module)
+        if module in budgets and result["seconds"] > budgets[module]:
+            violations.append(f"{module} took {result['seconds']:.2f}s to import, budget is {budgets[module]:.2f}s")
+        loaded = {name.split(".")[0] for name in result["modules"]}
+        for name in forbidden.get(module, []):
+            if name in loaded:
+                violations.append(f"{module} imports {name}")
+    return violations
+
+
+if __name__ == "__main__":
+    # python -m geoagent.utils.import_timer [module ...], exits with 1 when a budget is exceeded
+    if len(sys.argv) > 1:
+        for module in sys.argv[1:]:
+            result = measure_import_time(module)
+            print(f"{module}: {result['seconds']:.3f}s")
+            for row in result["slowest"]:
+                print(f"  {row['self_seconds']:.3f}s  {row['module']}")
+    else:
+        violations = check_import_budgets()
+        for violation in violations:
+            print(violation)
+        sys.exit(1 if violations else 0)
@@ -0,0 +1,147 @@
+import hashlib
+import json
+import re
+from collections import Counter
+
+# extensions peeled from the right of a file name, e.g. `x_matrix.mtx.gz` -> `.mtx.gz`
+_KNOWN_EXTENSIONS = {
+    "mtx", "tsv", "csv", "txt", "gz", "bz2", "zip", "tar", "h5", "h5ad", "loom", "xls", "xlsx", "rds", "rdata",
+}
+# the part of a file name identifying what it holds in multi-file layouts
+_FILE_ROLES = {"matrix", "barcodes", "features", "genes", "counts", "umi", "expression", "metadata", "raw", "filtered"}
+_DELIMITERS = ["\t", ",", ";", " "]
+_NUMBER = re.compile(r"^-?\d+(\.\d+)?([eE][-+]?\d+)?$")
+# 10x style cell barcodes, e.g. `AAACCTGAGAAACCAT-1`, and Ensembl gene IDs
+_BARCODE = re.compile(r"^([A-Za-z0-9]+[_:])?[ACGT]{8,}([-_]\w+)?$")
+_GENE_ID = re.compile(r"^ENS[A-Z]*G\d+(\.\d+)?$")
+
+FOLDER_PLACEHOLDER = "<<FOLDER_PATH>>"
+
+
+def _split_extension(file_name: str) -> tuple[str, str]:
+    parts = file_name.lower().split(".")
+    i = len(parts)
+    while i > 1 and parts[i - 1] in _KNOWN_EXTENSIONS:
+        i -= 1
+    return ".".join(parts[:i]), "".join(f".{x}" for x in parts[i:])
+
+
+def file_pattern(file_name: str) -> str:
+    """
+    Sample independent pattern of a supplementary file name,
+    e.g. `GSM123_PBMC_1_barcodes.tsv.gz` -> `*barcodes.tsv.gz`
+    """
+    stem, extension = _split_extension(file_name)
+    role = re.split(r"[_\-.]", stem)[-1]
+    return f"*{role}{extension}" if role in _FILE_ROLES else f"*{extension}"
+
+
+def guess_delimiter(lines: list[str]) -> str | None:
+    counts = Counter()
+    for line in lines:
+        for delimiter in _DELIMITERS:
+            counts[delimiter] += line.count(delimiter)
+    delimiter, n = counts.most_common(1)[0] if counts else (None, 0)
+    return delimiter if n else None
+
+
+def _looks_like(pattern: re.Pattern, labels: list[str]) -> bool:
+    labels = [x.strip('"') for x in labels if x.strip('"')]
+    return bool(labels) and sum(bool(pattern.match(x)) for x in labels) / len(labels) > 0.5
+
+
+def guess_orientation(row_labels: list[str], column_labels: list[str]) -> str | None:
+    """
+    Whether a table holds cells as rows or genes as rows, from its row and column labels.
+    :return: `cells_by_genes`, `genes_by_cells` or None when the labels are not conclusive
+    """
+    if _looks_like(_BARCODE, row_labels) or _looks_like(_GENE_ID, column_labels):
+        return "cells_by_genes"
+    if _looks_like(_BARCODE, column_labels) or _looks_like(_GENE_ID, row_labels):
+        return "genes_by_cells"
+    return None
+
+
+def header_shape(content: str | None) -> dict | None:
+    """
+    Structure of the head of a text file that does not depend on the sample, i.e. the
+    delimiter, the number of leading label columns and whether the header row has
+    one field less than the data rows (R `write.table` style), and the orientation of the table.
+    """
+    if not content:
+        return None
+    lines = [x.rstrip("\r\n") for x in content.splitlines() if x.strip()]
+    if lines and lines[0].startswith("%%MatrixMarket"):
+        return {"format": "mtx", "banner": lines[0]}
+    delimiter = guess_delimiter(lines[:10])
+    rows = [x.split(delimiter) if delimiter else [x] for x in lines[:10]]
+    if not rows:
+        return None
+    data_row = rows[1] if len(rows) > 1 else rows[0]
+    n_label_cols = next((i for i, x in enumerate(data_row) if _NUMBER.match(x.strip('"'))), len(data_row))
+    row_labels = [row[n_label_cols - 1] for row in rows[1:] if 0 < n_label_cols <= len(row)]
+    return {
+        "delimiter": delimiter,
+        "header_is_label": not all(_NUMBER.match(x.strip('"')) for x in rows[0][n_label_cols:] or [""]),
+        "n_label_cols": n_label_cols,
+        "header_offset": len(data_row) - len(rows[0]),
+        # wide rows differ with the number of cells or genes, only narrow files keep their width
+        "n_cols": len(data_row) if len(data_row) <= 4 else None,
+        "orientation": guess_orientation(row_labels, rows[0][1:]) if len(rows) > 1 else None,
+    }
+
+
+def layout_signature(file_content: dict) -> list[dict]:
+    """
+    Sample independent description of the files returned by `list_files_with_content`.
+    """
+    return sorted(
+        (
+            {"pattern": file_pattern(file), "header": header_shape(content)}
+            for file, content in zip(file_content["files"], file_content["content"])
+        ),
+        key=lambda x: json.dumps(x, sort_keys=True),
+    )
+
+
+def layout_fingerprint(file_content: dict) -> str:
+    """
+    Hash of `layout_signature`, samples sharing it can be read by the same loader code.
+    """
+    signature = json.dumps(layout_signature(file_content), sort_keys=True)
+    return hashlib.sha1(signature.encode("utf-8")).hexdigest()
+
+
+def file_placeholders(files: list[str]) -> dict[str, str]:
+    """
+    Map each file of a sample to a placeholder built from its pattern, files sharing a
+    pattern are numbered by name so the same slot points to the same kind of file across samples.
+    """
+    by_pattern: dict[str, list[str]] = {}
+    for file in sorted(files):
+        by_pattern.setdefault(file_pattern(file), []).append(file)
+    return {
+        f"<<FILE:{pattern}:{i}>>": file
+        for pattern, pattern_files in by_pattern.items()
+        for i, file in enumerate(pattern_files)
+    }
+
+
+def generalize_code(code: str, folder_path: str, files: list[str]) -> str:
+    """
+    Replace the folder and file names of the sample the code was generated for with placeholders.
+    """
+    placeholders = file_placeholders(files)
+    # longest names first, so a name contained in another one is not replaced inside it
+    for placeholder, file in sorted(placeholders.items(), key=lambda x: len(x[1]), reverse=True):
+        code = code.replace(file, placeholder)
+    return code.replace(folder_path.rstrip("/"), FOLDER_PLACEHOLDER)
+
+
+def specialize_code(code: str, folder_path: str, files: list[str]) -> str:
+    """
+    Fill the placeholders of `generalize_code` with the folder and files of another sample.
+    """
+    for placeholder, file in file_placeholders(files).items():
+        code = code.replace(placeholder, file)
+    return code.replace(FOLDER_PLACEHOLDER, folder_path.rstrip("/"))
@@ -0,0 +1,152 @@
+import os
+import sqlite3
+import stat
+import threading
+import time
+from contextlib import contextmanager
+
+from geoagent.utils.geo_cache import GEO_CACHE_DIR, GEOAGENT_HOME
+from geoagent.utils.logger import geoagent_logger as logger
+
+# the cached code is executed, so it lives in a private per-user directory outside the GEO cache,
+# which may be shared by the projects of a node (GEO_CACHE_DIR)
+LOADER_CACHE_PATH = os.getenv("GEO_LOADER_CACHE") or os.path.join(GEOAGENT_HOME, "loaders", "loader_cache.db")
+
+
+def _is_private(path: str) -> bool:
+    """
+    Whether `path` is owned by the current user and not writable by anyone else.
+    """
+    st = os.stat(path)
+    if hasattr(os, "getuid") and st.st_uid != os.getuid():
+        return False
+    return not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+
+class LoaderCache:
+    """
+    Persistent cache of LLM generated count-matrix loaders, keyed on the layout
+    fingerprint of the sample files (see `layout_fingerprint`).
+
+    Only code that produced an `AnnData` is stored, with the folder and file names
+    of the sample replaced by placeholders, so a repeated layout skips the LLM.
+    The database is created with mode 0o600, and cached code is only returned while
+    the database and its directory are owned by the current user and writable by no one else.
+
+    Examples:
+    ```python
+    >>> cache = LoaderCache()
+    >>> code = cache.get(fingerprint)
+    >>> cache.put(fingerprint, generalize_code(code, folder, files), "MTX")
+    >>> cache.stats()
+    ```
+    """
+
+    def __init__(self, db_path: str = LOADER_CACHE_PATH):
+        cache_dir = os.path.realpath(GEO_CACHE_DIR)
+        if os.path.commonpath([os.path.realpath(db_path), cache_dir]) == cache_dir:
+            raise ValueError(f"The loader cache {db_path} must not be inside the GEO cache {GEO_CACHE_DIR}")
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), mode=0o700, exist_ok=True)
+        if not os.path.exists(db_path):
+            os.close(os.open(db_path, os.O_CREAT | os.O_WRONLY, 0o600))
+        with self._connect() as conn:
+            conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS loaders (
+                    fingerprint TEXT PRIMARY KEY,
+                    file_type TEXT,
+                    code TEXT NOT NULL,
+                    hits INTEGER NOT NULL DEFAULT 0,
+                    created_at REAL NOT NULL,
+                    last_used REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS counters (
+                    name TEXT PRIMARY KEY,
+                    value INTEGER NOT NULL
+                );
+                """
+            )
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _count(conn: sqlite3.Connection, name: str) -> None:
+        conn.execute(
+            "INSERT INTO counters VALUES (?, 1) ON CONFLICT (name) DO UPDATE SET value = value + 1", (name,)
+        )
+
+    def _is_trusted(self) -> bool:
+        paths = [self.db_path, os.path.dirname(os.path.abspath(self.db_path))]
+        if all(_is_private(x) for x in paths):
+            return True
+        logger.error(f"Ignoring the loader cache {self.db_path}, it is not private to the current user")
+        return False
+
+    def get(self, fingerprint: str) -> str | None:
+        """
+        Return the generalized loader code of a layout, counting a hit or a miss.
+        Nothing is returned from a database other users could have written to.
+        """
+        if not self._is_trusted():
+            return None
+        with self._connect() as conn:
+            row = conn.execute("SELECT code FROM loaders WHERE fingerprint = ?", (fingerprint,)).fetchone()
+            if row is None:
+                self._count(conn, "misses")
+                return None
+            conn.execute(
+                "UPDATE loaders SET hits = hits + 1, last_used = ? WHERE fingerprint = ?", (time.time(), fingerprint)
+            )
+            self._count(conn, "hits")
+        return row[0]
+
+    def put(self, fingerprint: str, code: str, file_type: str = None) -> None:
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO loaders VALUES (?, ?, ?, 0, ?, ?)", (fingerprint, file_type, code, now, now)
+            )
+            self._count(conn, "stores")
+
+    def invalidate(self, fingerprint: str) -> None:
+        """
+        Drop a loader that failed on a sample of its layout.
+        """
+        with self._connect() as conn:
+            conn.execute("DELETE FROM loaders WHERE fingerprint = ?", (fingerprint,))
+            self._count(conn, "invalidations")
+        logger.info(f"Dropped the cached loader of layout {fingerprint}")
+
+    def stats(self) -> dict:
+        with self._connect() as conn:
+            res = dict(conn.execute("SELECT name, value FROM counters").fetchall())
+            entries, = conn.execute("SELECT COUNT(*) FROM loaders").fetchone()
+        hits, misses = res.get("hits", 0), res.get("misses", 0)
+        return {
+            "entries": entries,
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": round(hits / (hits + misses), 3) if hits + misses else None,
+            "stores": res.get("stores", 0),
+            "invalidations": res.get("invalidations", 0),
+        }
+
+
+_loader_cache = None
+_loader_cache_lock = threading.Lock()
+
+
+def get_loader_cache() -> LoaderCache:
+    global _loader_cache
+    with _loader_cache_lock:
+        if _loader_cache is None:
+            _loader_cache = LoaderCache()
+        return _loader_cache
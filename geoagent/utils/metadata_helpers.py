@@ -1,10 +1,16 @@
+import ast
 import os
+from functools import cached_property
+
+import numpy as np
 import pandas as pd
 
 from dataclasses import dataclass
-from tqdm import tqdm
 
-from geoagent.utils.file_helpers import wget_ftp_url
+from geoagent.utils.download_planner import DownloadPlan, plan_downloads
+from geoagent.utils.downloader import DEFAULT_MAX_PER_HOST, DownloadFilter, DownloadResult, DownloadTask, ParallelDownloader
+from geoagent.utils.geo_cache import get_geo_cache
+from geoagent.utils.metadata_store import MetadataStore
 
 
 @dataclass
@@ -19,12 +25,23 @@ class GSESuppFile:
     samples: list[GSMSuppFile]
 
 
+_FILE_COLUMNS = ["url", "gse", "gsm", "level", "size"]
+
+
 class SuppFileHelper:
     def __init__(self, metadata_path: str):
+        """
+        :param metadata_path: a `metadata.db` written by `MetadataStore`, or a legacy `metadata.csv`
+        """
         self.gsm_files: list[GSMSuppFile] = []
         self.gse_files: list[GSESuppFile] = []
-        self.meta_df = pd.read_csv(metadata_path, index_col=0)
-        self._build_from_dataframe()
+        self.store = None
+        if metadata_path.endswith(".csv"):
+            self.meta_df = pd.read_csv(metadata_path, index_col=0)
+            self._build_from_dataframe()
+        else:
+            self.store = MetadataStore(metadata_path)
+            self._build_from_store()
 
     def extract_supp_files_from_gsm_meta(self, meta: dict) -> GSMSuppFile:
         supp_files = [v for k, v in meta.items() if k.startswith("supplementary_file_")]
@@ -35,47 +52,34 @@ class SuppFileHelper:
         gsm_supp_files = [self.extract_supp_files_from_gsm_meta(gsm_meta) for gsm_meta in sub_metas.values()]
         return GSESuppFile(meta["geo_accession"][0], meta["supplementary_file"], gsm_supp_files)
 
+    def _build_from_store(self) -> None:
+        # only the files table is read, metadata dicts stay encoded in the store
+        series_samples = self.store.series_samples()
+        gse_files = {gse_id: [] for gse_id in series_samples}
+        gsm_files = {gsm_id: GSMSuppFile(gsm_id, []) for gsm_ids in series_samples.values() for gsm_id in gsm_ids}
+        standalone_gsm_files = {}
+        for url, series, sample, level, _ in self.store.iter_files():
+            if level == "gse":
+                gse_files[series].append(url)
+            elif series is not None:
+                gsm_files[sample].files.append(url)
+            else:
+                standalone_gsm_files.setdefault(sample, GSMSuppFile(sample, [])).files.append(url)
+
+        for gse_id, gsm_ids in series_samples.items():
+            self.gse_files.append(GSESuppFile(gse_id, gse_files[gse_id], [gsm_files[x] for x in gsm_ids]))
+        self.gsm_files = list(standalone_gsm_files.values())
+
     def _build_from_dataframe(self) -> None:
+        # legacy `metadata.csv`, nested dicts are stored as python literals
         for idx, row in self.meta_df.iterrows():
             if idx.startswith("GSE"):
-                self.gse_files.append(self.extract_supp_files_from_gse_meta(eval(row["metadata"]), eval(row["sub_metadata"])))
+                self.gse_files.append(self.extract_supp_files_from_gse_meta(ast.literal_eval(row["metadata"]), ast.literal_eval(row["sub_metadata"])))
             elif idx.startswith("GSM"):
-                self.gsm_files.append(self.extract_supp_files_from_gsm_meta(eval(row["metadata"])))
+                self.gsm_files.append(self.extract_supp_files_from_gsm_meta(ast.literal_eval(row["metadata"])))
             else:
                 raise ValueError(f"Invalid ID: {idx}")
             
-    def _count_gse_files(self) -> int:
-        gse_level_count = 0
-        gsm_level_count = 0
-
-        for gse in self.gse_files:
-            gse_level_count += len(gse.files)
-            for gsm in gse.samples:
-                gsm_level_count += len(gsm.files)
-        return gse_level_count, gsm_level_count
-
-    def _analyze_gse_file_locations(self) -> dict:
-        n = len(self.gse_files)
-        gse_only, gsm_only, both, neither = 0, 0, 0, 0
-        for gse in self.gse_files:
-            has_file_in_gse = True if gse.files else False
-            has_file_in_gsm = any([True if gsm.files else False for gsm in gse.samples])
-            if has_file_in_gse and has_file_in_gsm:
-                both += 1
-            elif has_file_in_gse:
-                gse_only += 1
-            elif has_file_in_gsm:
-                gsm_only += 1
-            else:
-                neither += 1
-
-        return {
-            "gse_only": round(gse_only/n, 2),
-            "gsm_only": round(gsm_only/n, 2),
-            "both": round(both/n, 2),
-            "neither": round(neither/n, 2),
-        }
-
     @staticmethod
     def _get_file_types(file: str) -> str:
         base_name = os.path.basename(file)
@@ -85,72 +89,219 @@ class SuppFileHelper:
         else:
             ext = parts[-1]
         return ext
-    
+
+    @staticmethod
+    def _file_types(urls: pd.Series) -> pd.Categorical:
+        """
+        Vectorized `_get_file_types`, computed once per distinct file name.
+        """
+        codes, names = pd.factorize(urls.str.rsplit("/", n=1).str[-1])
+        names = pd.Series(names)
+        ext = names.str.extract(r"\.([^.]*\.[^.]*)$")[0]
+        ext = ext.fillna(names.str.extract(r"\.([^.]*)$")[0]).fillna(names)
+        ext_codes, categories = pd.factorize(ext)
+        return pd.Categorical.from_codes(ext_codes[codes], categories=categories)
+
+    @cached_property
+    def files(self) -> pd.DataFrame:
+        """
+        One row per supplementary file: `url`, `gse`, `gsm`, `level` (`gse` / `gsm`),
+        `size` (bytes, missing until known) and `ext`, the extension as a categorical.
+        Files of standalone samples have no `gse`.
+        """
+        if self.store is not None:
+            # straight from the files table of the store, with the sizes recorded there
+            rows = self.store.iter_files()
+        else:
+            rows = [(url, gse.geo_id, None, "gse", None) for gse in self.gse_files for url in gse.files]
+            rows += [
+                (url, gse.geo_id, gsm.geo_id, "gsm", None) for gse in self.gse_files for gsm in gse.samples for url in gsm.files
+            ]
+            rows += [(url, None, gsm.geo_id, "gsm", None) for gsm in self.gsm_files for url in gsm.files]
+        files = pd.DataFrame.from_records(list(rows), columns=_FILE_COLUMNS)
+        files["level"] = files["level"].astype("category")
+        files["size"] = files["size"].astype("Int64")
+        files["ext"] = self._file_types(files["url"].astype(str))
+        return files
+
+    @cached_property
+    def gsm_counts(self) -> pd.Series:
+        """
+        Number of samples of every series.
+        """
+        return pd.Series({gse.geo_id: len(gse.samples) for gse in self.gse_files}, dtype=int)
+
+    def _gse_level_files(self) -> pd.DataFrame:
+        # files of series and of their samples, standalone samples left out
+        return self.files[self.files["gse"].notna()]
+
+    def _count_gse_files(self) -> tuple[int, int]:
+        counts = self._gse_level_files()["level"].value_counts()
+        return int(counts.get("gse", 0)), int(counts.get("gsm", 0))
+
+    def _analyze_gse_file_locations(self) -> dict:
+        gse_ids = self.gsm_counts.index.to_numpy()
+        n = len(gse_ids)
+        files = self._gse_level_files()
+        has_file_in_gse = np.isin(gse_ids, files.loc[files["level"] == "gse", "gse"].unique())
+        has_file_in_gsm = np.isin(gse_ids, files.loc[files["level"] == "gsm", "gse"].unique())
+        return {
+            "gse_only": round(int(np.sum(has_file_in_gse & ~has_file_in_gsm)) / n, 2),
+            "gsm_only": round(int(np.sum(~has_file_in_gse & has_file_in_gsm)) / n, 2),
+            "both": round(int(np.sum(has_file_in_gse & has_file_in_gsm)) / n, 2),
+            "neither": round(int(np.sum(~has_file_in_gse & ~has_file_in_gsm)) / n, 2),
+        }
+
     def _analyze_gse_file_types(self) -> dict:
-        gse_level = {}
-        gsm_level = {}
-        
-        for gse in self.gse_files:
-            # Check files in GSE level
-            for file in gse.files:
-                ext = self._get_file_types(file)
-                gse_level[ext] = gse_level.get(ext, 0) + 1
-            
-            # Check files in GSM level
-            for gsm in gse.samples:
-                for file in gsm.files:
-                    ext = self._get_file_types(file)
-                    gsm_level[ext] = gsm_level.get(ext, 0) + 1
-        
+        counts = self._gse_level_files().groupby(["level", "ext"], observed=True).size()
+        return {
+            f"{level}_level": {ext: int(n) for ext, n in counts[level].sort_values(ascending=False).items()}
+            if level in counts.index.get_level_values(0) else {}
+            for level in ("gse", "gsm")
+        }
+
+    def bytes_per_type(self) -> dict:
+        """
+        Total size of the files of every type, only files with a known size are summed.
+        """
+        stats = self.files.groupby("ext", observed=True)["size"].agg(["sum", "count", "size"])
+        stats = stats.sort_values("sum", ascending=False)
         return {
-            "gse_level": gse_level,
-            "gsm_level": gsm_level
+            ext: {"bytes": int(row["sum"]), "files": int(row["size"]), "files_with_size": int(row["count"])}
+            for ext, row in stats.iterrows()
+        }
+
+    def gse_download_sizes(self) -> pd.DataFrame:
+        """
+        Estimated download size of every series, its files and the files of its samples.
+        Files of unknown size count as the median size of their type.
+        :return: a frame indexed by series with `n_files`, `known_bytes`, `n_unknown` and `estimated_bytes`
+        """
+        files = self._gse_level_files()
+        median_sizes = files.groupby("ext", observed=True)["size"].median()
+        estimated = files["size"].astype("Float64").fillna(files["ext"].map(median_sizes).astype("Float64")).fillna(0)
+        sizes = pd.DataFrame({
+            "gse": files["gse"],
+            "size": files["size"],
+            "unknown": files["size"].isna(),
+            "estimated": estimated,
+        }).groupby("gse").agg(
+            n_files=("size", "size"),
+            known_bytes=("size", "sum"),
+            n_unknown=("unknown", "sum"),
+            estimated_bytes=("estimated", "sum"),
+        )
+        sizes = sizes.reindex(self.gsm_counts.index, fill_value=0)
+        return sizes.astype("int64").sort_values("estimated_bytes", ascending=False)
+
+    def _analyze_download_sizes(self) -> dict:
+        sizes = self.gse_download_sizes()
+        return {
+            "known_bytes": int(sizes["known_bytes"].sum()),
+            "estimated_bytes": int(sizes["estimated_bytes"].sum()),
+            "files_without_size": int(sizes["n_unknown"].sum()),
+            "max_gse_bytes": int(sizes["estimated_bytes"].max()) if len(sizes) else 0,
+            "median_gse_bytes": int(sizes["estimated_bytes"].median()) if len(sizes) else 0,
         }
 
     def analyze_gses(self):
         n = len(self.gse_files)
-        gsm_counts = [len(gse.samples) for gse in self.gse_files]
+        gsm_counts = self.gsm_counts
         gse_level_file_count, gsm_level_file_count = self._count_gse_files()
         res = {
             "gses": n,
-            "avg_gsms_per_gse": round(sum(gsm_counts) / n, 2),
-            "min_gsms_per_gse": min(gsm_counts),
-            "max_gsms_per_gse": max(gsm_counts),
+            "avg_gsms_per_gse": round(float(gsm_counts.mean()), 2),
+            "min_gsms_per_gse": int(gsm_counts.min()),
+            "max_gsms_per_gse": int(gsm_counts.max()),
             "file_counts": {
                 "gse_level": gse_level_file_count,
                 "gsm_level": gsm_level_file_count
             },
             "file_locations": self._analyze_gse_file_locations(),
             "file_types": self._analyze_gse_file_types(),
-
+            "bytes_per_type": self.bytes_per_type(),
+            "download_sizes": self._analyze_download_sizes(),
         }
         return res
     
     def list_all_gse_files(self) -> dict[str, dict]:
         return {gse.geo_id: {
-            "gse_level": os.path.basename(gse.files), 
-            "gsm_level": {gsm.geo_id: os.path.basename(gsm.files) for gsm in gse.samples}
+            "gse_level": [os.path.basename(x) for x in gse.files], 
+            "gsm_level": {gsm.geo_id: [os.path.basename(x) for x in gsm.files] for gsm in gse.samples}
             } 
             for gse in self.gse_files
         }
     
-    def download_all_gse_files(self, cache_dir: str) -> None:
-        for gse in tqdm(self.gse_files, desc="Downloading GSE files"):
+    def _download_tasks(self, cache_dir: str) -> list[DownloadTask]:
+        tasks = []
+        for gse in self.gse_files:
             gse_dir = os.path.join(cache_dir, gse.geo_id)
-            os.makedirs(gse_dir, exist_ok=True)
             
             if gse.files:
                 gse_supp_dir = os.path.join(gse_dir, "Supp")
                 for file in gse.files:
-                    wget_ftp_url(ftp_url=file, data_dir=gse_supp_dir, log_dir=cache_dir)
+                    tasks.append(DownloadTask(file, gse_supp_dir, gse.geo_id, series=gse.geo_id))
             
             if gse.samples:
                 for gsm in gse.samples:
                     if gsm.files:
                         gsm_level_dir = os.path.join(gse_dir, gsm.geo_id)
                         for file in gsm.files:
-                            wget_ftp_url(ftp_url=file, data_dir=gsm_level_dir, log_dir=cache_dir) 
+                            tasks.append(DownloadTask(file, gsm_level_dir, gsm.geo_id, series=gse.geo_id))
+        return tasks
+
+    def plan_downloads(
+        self,
+        cache_dir: str,
+        file_types: list[str] = None,
+        max_file_size: int | str = None,
+        budget: int | str = None,
+        max_per_host: int = DEFAULT_MAX_PER_HOST,
+        file_filter: DownloadFilter = None,
+    ) -> DownloadPlan:
+        """
+        Select the files of all series to download, see `plan_downloads`. Sizes already
+        recorded in the store are reused, the others are queried and recorded.
+        """
+        known_sizes = self.files.dropna(subset=["size"]).set_index("url")["size"].to_dict()
+        tasks = self._download_tasks(cache_dir)
+        for task in tasks:
+            task.size = known_sizes.get(task.url)
+        plan = plan_downloads(
+            tasks,
+            file_types=file_types,
+            max_file_size=max_file_size,
+            budget=budget,
+            file_filter=file_filter,
+            max_per_host=max_per_host,
+        )
+        if self.store is not None:
+            self.store.set_file_sizes({task.url: task.size for task in tasks if task.url not in known_sizes})
+            # the file table is rebuilt with the new sizes on next use
+            self.__dict__.pop("files", None)
+        return plan
+
+    def download_all_gse_files(
+        self,
+        cache_dir: str,
+        parallel: int = 1,
+        max_per_host: int = DEFAULT_MAX_PER_HOST,
+        plan: DownloadPlan = None,
+        file_filter: DownloadFilter = None,
+    ) -> list[DownloadResult]:
+        """
+        :param plan: download only the files selected by `plan_downloads`, all files by default
+        :param file_filter: include / exclude rules applied by the downloader, e.g. `COUNT_MATRIX_FILTER`
+        """
+        tasks = plan.tasks if plan is not None else self._download_tasks(cache_dir)
+        for gse_dir in {os.path.dirname(task.data_dir) for task in tasks}:
+            os.makedirs(gse_dir, exist_ok=True)
+
+        downloader = ParallelDownloader(
+            max_workers=parallel, max_per_host=max_per_host, log_dir=cache_dir, cache=get_geo_cache(), file_filter=file_filter
+        )
+        return downloader.download(tasks)
             
 if __name__ == "__main__":
-    sfa = SuppFileHelper("/Users/panrong/Downloads/immunity10/metadata.csv")
+    sfa = SuppFileHelper("/Users/panrong/Downloads/immunity10/metadata.db")
     print(sfa.download_all_gse_files("/Users/panrong/Downloads/immunity10/"))
@@ -0,0 +1,227 @@
+import json
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+from geoagent.utils.logger import geoagent_logger as logger
+
+METADATA_DB_FILE = "metadata.db"
+
+
+class MetadataStore:
+    """
+    SQLite store of the metadata extracted by `get_metadata`, normalized into
+    series, samples and supplementary files.
+
+    Metadata dicts are kept as JSON text and only decoded on request, so file
+    level analyses can run on the `files` table without touching them.
+
+    Examples:
+    ```python
+    >>> store = MetadataStore("/data/immunity/metadata.db")
+    >>> store.write_records(get_metadata_batch(geo_ids, parse_subsamples=True))
+    >>> store.load_metadata("GSE123")
+    ```
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS series (
+                    accession TEXT PRIMARY KEY,
+                    n_samples INTEGER NOT NULL,
+                    metadata TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS samples (
+                    accession TEXT PRIMARY KEY,
+                    series TEXT,
+                    metadata TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS files (
+                    url TEXT NOT NULL,
+                    series TEXT,
+                    sample TEXT,
+                    level TEXT NOT NULL,
+                    size INTEGER
+                );
+                CREATE TABLE IF NOT EXISTS manifest (
+                    accession TEXT PRIMARY KEY,
+                    last_update_date TEXT,
+                    soft_sha256 TEXT,
+                    remote_size INTEGER,
+                    remote_mtime TEXT,
+                    refreshed_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS samples_series ON samples (series);
+                CREATE INDEX IF NOT EXISTS files_series ON files (series);
+                CREATE INDEX IF NOT EXISTS files_url ON files (url);
+                """
+            )
+            if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'files_key'").fetchone() is None:
+                # stores written before files were upserted may list a file twice
+                conn.executescript(
+                    """
+                    DELETE FROM files WHERE rowid NOT IN (
+                        SELECT MIN(rowid) FROM files GROUP BY url, IFNULL(series, ''), IFNULL(sample, '')
+                    );
+                    CREATE UNIQUE INDEX files_key ON files (url, IFNULL(series, ''), IFNULL(sample, ''));
+                    """
+                )
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _gsm_supp_files(meta: dict) -> list[str]:
+        supp_files = [v for k, v in meta.items() if k.startswith("supplementary_file")]
+        return [f for sublist in supp_files for f in sublist if f != "NONE"]
+
+    def _delete_record(self, conn: sqlite3.Connection, accession: str) -> None:
+        # files are upserted by `_write_files`, so their recorded sizes survive a refresh
+        conn.execute("DELETE FROM samples WHERE series = ? OR accession = ?", (accession, accession))
+        conn.execute("DELETE FROM series WHERE accession = ?", (accession,))
+
+    @staticmethod
+    def _write_files(conn: sqlite3.Connection, accession: str, rows: list[tuple[str, str | None, str | None, str]]) -> None:
+        """
+        Upsert the `(url, series, sample, level)` files of a record, keeping the sizes already recorded,
+        and drop the files the record no longer lists.
+        """
+        conn.executemany(
+            """INSERT INTO files (url, series, sample, level) VALUES (?, ?, ?, ?)
+            ON CONFLICT (url, IFNULL(series, ''), IFNULL(sample, '')) DO UPDATE SET
+                level = excluded.level,
+                size = COALESCE(excluded.size, files.size)""",
+            rows,
+        )
+        keys = {(url, series, sample) for url, series, sample, _ in rows}
+        stale = [
+            (rowid,)
+            for rowid, *key in conn.execute(
+                "SELECT rowid, url, series, sample FROM files WHERE series = ? OR (series IS NULL AND sample = ?)",
+                (accession, accession),
+            ).fetchall()
+            if tuple(key) not in keys
+        ]
+        conn.executemany("DELETE FROM files WHERE rowid = ?", stale)
+
+    def write_records(self, meta_infos: dict[str, dict]) -> None:
+        """
+        Insert or replace records given as `{accession: get_metadata(accession)}`,
+        the sizes recorded for their supplementary files are kept.
+        """
+        with self._connect() as conn:
+            for accession, info in meta_infos.items():
+                meta = info.get("metadata")
+                if not meta:
+                    logger.error(f"No metadata for {accession}, skipping")
+                    continue
+                self._delete_record(conn, accession)
+
+                if accession.startswith("GSE"):
+                    sub_metadata = info.get("sub_metadata") or {}
+                    conn.execute(
+                        "INSERT INTO series VALUES (?, ?, ?)",
+                        (accession, info.get("sub_samples") or len(sub_metadata), json.dumps(meta)),
+                    )
+                    files = [(url, accession, None, "gse") for url in meta.get("supplementary_file", []) if url != "NONE"]
+                    for gsm_id, gsm_meta in sub_metadata.items():
+                        conn.execute("INSERT OR REPLACE INTO samples VALUES (?, ?, ?)", (gsm_id, accession, json.dumps(gsm_meta)))
+                        files += [(url, accession, gsm_id, "gsm") for url in self._gsm_supp_files(gsm_meta)]
+                    self._write_files(conn, accession, files)
+                elif accession.startswith("GSM"):
+                    conn.execute("INSERT OR REPLACE INTO samples VALUES (?, NULL, ?)", (accession, json.dumps(meta)))
+                    self._write_files(conn, accession, [(url, None, accession, "gsm") for url in self._gsm_supp_files(meta)])
+                else:
+                    logger.error(f"Unsupported accession: {accession}, skipping")
+
+    def get_manifest(self, accession: str) -> dict | None:
+        """
+        Return the last update date, SOFT file hash and remote SOFT size / mtime recorded for a record.
+        """
+        with self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            row = conn.execute("SELECT * FROM manifest WHERE accession = ?", (accession,)).fetchone()
+        return dict(row) if row else None
+
+    def update_manifest(
+        self,
+        accession: str,
+        last_update_date: str = None,
+        soft_sha256: str = None,
+        remote_size: int = None,
+        remote_mtime: str = None,
+    ) -> None:
+        """
+        Record the state of a record, fields left to None keep their previous value.
+        """
+        with self._connect() as conn:
+            conn.execute(
+                """INSERT INTO manifest VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (accession) DO UPDATE SET
+                    last_update_date = COALESCE(excluded.last_update_date, last_update_date),
+                    soft_sha256 = COALESCE(excluded.soft_sha256, soft_sha256),
+                    remote_size = COALESCE(excluded.remote_size, remote_size),
+                    remote_mtime = COALESCE(excluded.remote_mtime, remote_mtime),
+                    refreshed_at = excluded.refreshed_at""",
+                (accession, last_update_date, soft_sha256, remote_size, remote_mtime, time.time()),
+            )
+
+    def accessions(self) -> list[str]:
+        with self._connect() as conn:
+            series = [row[0] for row in conn.execute("SELECT accession FROM series ORDER BY accession")]
+            samples = [row[0] for row in conn.execute("SELECT accession FROM samples WHERE series IS NULL ORDER BY accession")]
+        return series + samples
+
+    def load_metadata(self, accession: str) -> dict | None:
+        with self._connect() as conn:
+            row = conn.execute("SELECT metadata FROM series WHERE accession = ?", (accession,)).fetchone()
+            if row is None:
+                row = conn.execute("SELECT metadata FROM samples WHERE accession = ?", (accession,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def iter_sample_metadata(self, series: str) -> Iterator[tuple[str, dict]]:
+        with self._connect() as conn:
+            for accession, meta in conn.execute(
+                "SELECT accession, metadata FROM samples WHERE series = ? ORDER BY accession", (series,)
+            ):
+                yield accession, json.loads(meta)
+
+    def series_samples(self) -> dict[str, list[str]]:
+        """
+        Map every series to its sample accessions, without decoding any metadata.
+        """
+        with self._connect() as conn:
+            res = {row[0]: [] for row in conn.execute("SELECT accession FROM series ORDER BY accession")}
+            for accession, series in conn.execute(
+                "SELECT accession, series FROM samples WHERE series IS NOT NULL ORDER BY accession"
+            ):
+                res.setdefault(series, []).append(accession)
+        return res
+
+    def set_file_sizes(self, sizes: dict[str, int | None]) -> None:
+        """
+        Record the remote size of supplementary files, unknown sizes are left untouched.
+        """
+        with self._connect() as conn:
+            conn.executemany(
+                "UPDATE files SET size = ? WHERE url = ?", [(size, url) for url, size in sizes.items() if size is not None]
+            )
+
+    def iter_files(self) -> Iterator[tuple[str, str, str, str, int | None]]:
+        """
+        Yield `(url, series, sample, level, size)` for every supplementary file.
+        """
+        with self._connect() as conn:
+            yield from conn.execute("SELECT url, series, sample, level, size FROM files ORDER BY series, sample, url")
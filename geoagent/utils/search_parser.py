@@ -0,0 +1,177 @@
+import sys
+import time
+
+from lxml import etree
+from lxml import html as lxml_html
+
+from geoagent.utils.logger import geoagent_logger as logger
+
+GEO_BASE_URL = "https://www.ncbi.nlm.nih.gov"
+
+# compiled once, reused for every result page
+_HTML_PARSER = lxml_html.HTMLParser(encoding="utf-8")
+_RPRT_XPATH = etree.XPath('//div[contains(concat(" ", normalize-space(@class), " "), " rprt ")]')
+
+
+def _format_key(string):
+    return string.lower().replace(" ", "_")
+
+
+def _parse_rprt(rprt) -> dict:
+    title = rprt.find("p", attrs={"class": "title"}).text.strip()
+    article_info = {"title": title}
+
+    supp = rprt.find("div", attrs={"class": "supp"})
+    if supp:
+        try:
+            summary = (
+                supp.text.replace("more...", "")
+                .replace("(Submitter supplied) ", "")
+                .split("Organism")[0]
+                .strip()
+            )
+            article_info["summary"] = summary
+        except Exception as summary_e:
+            logger.error(f"Failed to get summary: {summary_e}")
+
+        details = supp.find_all("dl", attrs={"class": "details"})
+        if details:
+            for detail in details:
+                try:
+                    dt = detail.find("dt").text.replace(":", "").strip()
+                    dd = detail.find("dd").text.strip()
+                    article_info[_format_key(dt)] = dd
+                except Exception as detail_e:
+                    logger.error(f"Failed to get detail: {detail_e}")
+                    continue
+
+    aux = rprt.find("div", attrs={"class": "aux"})
+    if aux:
+        rprtids = aux.find_all("dl", attrs={"class": "rprtid"})
+        if rprtids:
+            for rprtid in rprtids:
+                try:
+                    dt = rprtid.find("dt").text.replace(":", "").strip()
+                    dd = rprtid.find("dd").text.strip()
+                    article_info[_format_key(dt)] = dd
+                except Exception as rprtid_e:
+                    logger.error(f"Failed to get rprtid: {rprtid_e}")
+                    continue
+        try:
+            links = aux.find("p", attrs={"class": "links"})
+            a_tags = links.find_all("a")
+            if a_tags:
+                for a_tag in a_tags:
+                    article_info[_format_key(a_tag.text)] = (
+                        GEO_BASE_URL + a_tag.attrs.get("href")
+                    )
+        except Exception as links_e:
+            logger.error(f"Failed to get links: {links_e}")
+    article_info["url"] = (
+        f"{GEO_BASE_URL}/geo/query/acc.cgi?acc={article_info['accession']}"
+    )
+    return article_info
+
+
+def _clean_summary(text: str) -> str:
+    return (
+        text.replace("more...", "")
+        .replace("(Submitter supplied) ", "")
+        .split("Organism")[0]
+        .strip()
+    )
+
+
+def _parse_rprt_element(rprt) -> dict:
+    """
+    Extract title, summary, details, rprtid and links of a record in one walk over its elements.
+    """
+    article_info = {}
+    links = {}
+    for el in rprt.iter("p", "div", "dl"):
+        classes = el.get("class", "").split()
+        if not classes:
+            continue
+        if el.tag == "p" and "title" in classes and "title" not in article_info:
+            article_info["title"] = el.text_content().strip()
+        elif el.tag == "p" and "links" in classes:
+            for a_tag in el.iter("a"):
+                href = a_tag.get("href")
+                if href:
+                    links[_format_key(a_tag.text_content())] = GEO_BASE_URL + href
+        elif el.tag == "div" and "supp" in classes:
+            article_info["summary"] = _clean_summary(el.text_content())
+        elif el.tag == "dl" and ("details" in classes or "rprtid" in classes):
+            dt, dd = el.find("dt"), el.find("dd")
+            if dt is not None and dd is not None:
+                article_info[_format_key(dt.text_content().replace(":", "").strip())] = dd.text_content().strip()
+    # links come after the ids, same column order as the BeautifulSoup parser
+    article_info.update(links)
+    return article_info
+
+
+def parse_search_page(html: bytes | str) -> list[dict]:
+    """
+    Parse the records of a GEO DataSets result page
+    :param html: the raw page
+    :return: a list of dictionaries containing the search results
+    """
+    if isinstance(html, str):
+        html = html.encode("utf-8")
+    tree = lxml_html.document_fromstring(html, parser=_HTML_PARSER)
+
+    result = []
+    for rprt in _RPRT_XPATH(tree):
+        article_info = _parse_rprt_element(rprt)
+        if "accession" not in article_info:
+            logger.error(f"Failed to get accession of record: {article_info.get('title')}")
+            continue
+        article_info["url"] = f"{GEO_BASE_URL}/geo/query/acc.cgi?acc={article_info['accession']}"
+        result.append(article_info)
+    return result
+
+
+def parse_search_page_bs4(html: bytes | str) -> list[dict]:
+    """
+    The former BeautifulSoup implementation, kept as a reference for `benchmark`
+    """
+    from bs4 import BeautifulSoup
+
+    if isinstance(html, bytes):
+        html = html.decode("utf-8")
+    bs = BeautifulSoup(html, "lxml")
+    return [_parse_rprt(rprt) for rprt in bs.find_all("div", attrs={"class": "rprt"})]
+
+
+def benchmark(page_paths: list[str], repeat: int = 5) -> dict:
+    """
+    Compare the throughput of the lxml and BeautifulSoup parsers on result pages saved from GEO,
+    and check that both give the same records on every page.
+    """
+    if not page_paths:
+        raise ValueError("No result pages to benchmark, save some from https://www.ncbi.nlm.nih.gov/gds first")
+    pages = {}
+    for path in page_paths:
+        with open(path, "rb") as f:
+            pages[path] = f.read()
+
+    res = {}
+    for name, parse_func in (("lxml", parse_search_page), ("bs4", parse_search_page_bs4)):
+        records = 0
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for page in pages.values():
+                records += len(parse_func(page))
+        elapsed = time.perf_counter() - start
+        res[name] = {"seconds": round(elapsed, 4), "records_per_second": round(records / elapsed, 1)}
+    res["speedup"] = round(res["bs4"]["seconds"] / res["lxml"]["seconds"], 2)
+    mismatched = [path for path, page in pages.items() if parse_search_page(page) != parse_search_page_bs4(page)]
+    res["identical"] = not mismatched
+    res["mismatched_pages"] = mismatched
+    return res
+
+
+if __name__ == "__main__":
+    # usage: python -m geoagent.utils.search_parser page1.html [page2.html ...]
+    # a page can be saved from the browser or with `curl -d "term=..." https://www.ncbi.nlm.nih.gov/gds`
+    print(benchmark(sys.argv[1:]))
@@ -0,0 +1,107 @@
+import gzip
+import re
+from dataclasses import dataclass, field
+from typing import Iterator
+
+_ENTITY_TYPES = {"SERIES": "GSE", "SAMPLE": "GSM", "PLATFORM": "GPL", "DATABASE": "DATABASE"}
+# same key normalization as GEOparse, e.g. `!Sample_title` -> `title`
+_KEY_PREFIX = re.compile(r"!\w*?_")
+
+
+class NoMetadataException(Exception):
+    pass
+
+
+@dataclass
+class SoftEntity:
+    """
+    Metadata of one `^SERIES`, `^SAMPLE` or `^PLATFORM` entry of a SOFT file.
+    Mirrors the metadata API of the GEOparse objects without their data tables.
+    """
+    geotype: str
+    name: str
+    metadata: dict[str, list[str]] = field(default_factory=dict)
+
+    def get_accession(self) -> str:
+        return self.metadata["geo_accession"][0]
+
+    def get_metadata_attribute(self, metaname: str) -> str | list[str]:
+        value = self.metadata.get(metaname)
+        if value is None:
+            raise NoMetadataException(f"No {metaname} in attributes")
+        return value[0] if len(value) == 1 else value
+
+
+@dataclass
+class SoftSeries(SoftEntity):
+    gsms: dict[str, SoftEntity] = field(default_factory=dict)
+    gpls: dict[str, SoftEntity] = field(default_factory=dict)
+
+
+def _open_soft(filepath: str):
+    if filepath.endswith(".gz"):
+        return gzip.open(filepath, "rt", encoding="utf-8", errors="replace")
+    return open(filepath, "rt", encoding="utf-8", errors="replace")
+
+
+def _parse_entry(line: str) -> tuple[str, str]:
+    if line.startswith("!"):
+        line = _KEY_PREFIX.sub("", line)
+    else:
+        line = line.strip()[1:]
+    key, _, value = line.partition("=")
+    return key.strip(), value.strip()
+
+
+def iter_soft_entities(filepath: str) -> Iterator[SoftEntity]:
+    """
+    Stream the entities of a (gzipped) SOFT file, one metadata dict at a time.
+    Data tables between `!..._table_begin` and `!..._table_end` are skipped without being parsed.
+    """
+    entity = None
+    in_table = False
+    with _open_soft(filepath) as f:
+        for line in f:
+            if in_table:
+                if line.startswith("!") and "_table_end" in line:
+                    in_table = False
+                continue
+            if line.startswith("^"):
+                if entity is not None:
+                    yield entity
+                entry_type, entry_name = _parse_entry(line)
+                entity = SoftEntity(_ENTITY_TYPES.get(entry_type.upper(), entry_type), entry_name)
+            elif line.startswith("!"):
+                if "_table_begin" in line:
+                    in_table = True
+                    continue
+                if entity is None:
+                    continue
+                key, value = _parse_entry(line.rstrip())
+                entity.metadata.setdefault(key, []).append(value)
+            # `#` column descriptions and bare data lines are not metadata
+    if entity is not None:
+        yield entity
+
+
+def read_soft_metadata(filepath: str) -> SoftEntity:
+    """
+    Read the metadata of a SOFT file without materializing its data tables.
+    :return: a `SoftSeries` holding its samples and platforms for a family file,
+        otherwise the first sample or platform entry
+    """
+    series = None
+    gsms, gpls = {}, {}
+    for entity in iter_soft_entities(filepath):
+        if entity.geotype == "GSE" and series is None:
+            series = SoftSeries(entity.geotype, entity.name, entity.metadata)
+        elif entity.geotype == "GSM":
+            gsms[entity.name] = entity
+        elif entity.geotype == "GPL":
+            gpls[entity.name] = entity
+    if series is not None:
+        series.gsms, series.gpls = gsms, gpls
+        return series
+    if gsms or gpls:
+        return next(iter(gsms.values() or gpls.values()))
+    raise ValueError(f"No GEO entity found in {filepath}")
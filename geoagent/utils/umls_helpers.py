@@ -0,0 +1,181 @@
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from scispacy.candidate_generation import CandidateGenerator
+
+from geoagent.utils.geo_cache import GEO_CACHE_DIR
+from geoagent.utils.logger import geoagent_logger as logger
+
+# persistent term -> concept memo shared by all runs, disabled if set to an empty string
+UMLS_MEMO_PATH = os.getenv("GEO_UMLS_MEMO", os.path.join(GEO_CACHE_DIR, "umls_memo.db"))
+# directory written by `python -m geoagent.utils.umls_kb export`, shared read-only by all workers
+UMLS_KB_DIR = os.getenv("GEO_UMLS_KB_DIR")
+
+_candidate_generator = None
+_candidate_generator_lock = threading.Lock()
+
+
+def get_candidate_generator() -> CandidateGenerator:
+    """
+    Return the process-wide UMLS candidate generator, the ANN index and KB are loaded on first use.
+    """
+    global _candidate_generator
+    with _candidate_generator_lock:
+        if _candidate_generator is None:
+            if UMLS_KB_DIR:
+                from geoagent.utils.umls_kb import load_compact_candidate_generator
+
+                logger.info(f"Loading the UMLS candidate generator with the compact KB in {UMLS_KB_DIR}")
+                _candidate_generator = load_compact_candidate_generator(UMLS_KB_DIR)
+            else:
+                logger.info("Loading the UMLS candidate generator")
+                _candidate_generator = CandidateGenerator(name="umls")
+        return _candidate_generator
+
+
+def _normalize_term(term: str) -> str:
+    # the TF-IDF char n-grams of the candidate generator are case insensitive
+    return term.strip().lower()
+
+
+class UMLSMapper:
+    """
+    Map free-text terms (e.g. disease fields of GEO samples) to UMLS concepts.
+
+    Terms are deduplicated and sent to the candidate generator in batches, and
+    results are memoized in an in-memory LRU and a persistent SQLite memo, so
+    repeated strings never hit the ANN index twice.
+
+    Examples:
+    ```python
+    >>> mapper = UMLSMapper(threshold=0.8)
+    >>> mapper("breast cancer")
+    >>> mapper.map_many(["Breast cancer", "healthy", None])
+    ```
+    """
+
+    def __init__(
+        self,
+        threshold: float,
+        k: int = 30,
+        batch_size: int = 256,
+        memo_size: int = 100_000,
+        memo_path: str = UMLS_MEMO_PATH,
+    ):
+        self.threshold = threshold
+        self.k = k
+        self.batch_size = batch_size
+        self.memo_size = memo_size
+        self.memo_path = memo_path
+        self._memo: OrderedDict[str, str | None] = OrderedDict()
+        self._lock = threading.Lock()
+        if self.memo_path:
+            os.makedirs(os.path.dirname(os.path.abspath(self.memo_path)), exist_ok=True)
+            with self._connect() as conn:
+                conn.execute(
+                    """CREATE TABLE IF NOT EXISTS umls_memo (
+                        term TEXT NOT NULL,
+                        threshold REAL NOT NULL,
+                        k INTEGER NOT NULL,
+                        concept TEXT,
+                        PRIMARY KEY (term, threshold, k)
+                    )"""
+                )
+
+    @property
+    def candidate_generator(self) -> CandidateGenerator:
+        return get_candidate_generator()
+
+    @property
+    def kb(self):
+        return self.candidate_generator.kb
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.memo_path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _remember(self, results: dict[str, str | None]) -> None:
+        with self._lock:
+            for term, concept in results.items():
+                self._memo[term] = concept
+                self._memo.move_to_end(term)
+            while len(self._memo) > self.memo_size:
+                self._memo.popitem(last=False)
+
+    def _lookup_memo(self, terms: list[str]) -> dict[str, str | None]:
+        found = {}
+        with self._lock:
+            for term in terms:
+                if term in self._memo:
+                    self._memo.move_to_end(term)
+                    found[term] = self._memo[term]
+        missing = [term for term in terms if term not in found]
+        if missing and self.memo_path:
+            with self._connect() as conn:
+                for i in range(0, len(missing), 500):
+                    chunk = missing[i:i + 500]
+                    rows = conn.execute(
+                        f"SELECT term, concept FROM umls_memo WHERE threshold = ? AND k = ? "
+                        f"AND term IN ({', '.join('?' * len(chunk))})",
+                        (self.threshold, self.k, *chunk),
+                    ).fetchall()
+                    found.update(rows)
+            self._remember({term: found[term] for term in missing if term in found})
+        return found
+
+    def _select_concept(self, candidates) -> str | None:
+        predicted = []
+        for cand in candidates:
+            score = max(cand.similarities)
+            if (
+                score < self.threshold
+                or self.kb.cui_to_entity[cand.concept_id].definition is None
+            ):
+                continue
+            if score > self.threshold:
+                predicted.append((cand.concept_id, score))
+
+        if len(predicted) > 0:
+            sorted_predicted = sorted(predicted, reverse=True, key=lambda x: x[1])[0]
+            entity = self.kb.cui_to_entity[sorted_predicted[0]]
+            return f"{entity.canonical_name} [{entity.concept_id}]"
+        return None
+
+    def map_many(self, diseases: list[str | None]) -> list[str | None]:
+        """
+        Map many terms at once, unmatched terms are returned unchanged.
+        """
+        terms = list(dict.fromkeys(_normalize_term(x) for x in diseases if x is not None))
+        concepts = self._lookup_memo(terms)
+        missing = [term for term in terms if term not in concepts]
+
+        for i in range(0, len(missing), self.batch_size):
+            batch = missing[i:i + self.batch_size]
+            batch_candidates = self.candidate_generator(batch, self.k)
+            results = {term: self._select_concept(candidates) for term, candidates in zip(batch, batch_candidates)}
+            self._remember(results)
+            if self.memo_path:
+                with self._connect() as conn:
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO umls_memo VALUES (?, ?, ?, ?)",
+                        [(term, self.threshold, self.k, concept) for term, concept in results.items()],
+                    )
+            concepts.update(results)
+
+        return [
+            None if disease is None else (concepts[_normalize_term(disease)] or disease)
+            for disease in diseases
+        ]
+
+    def __call__(self, disease):
+        if disease is None:
+            return None
+        return self.map_many([disease])[0]
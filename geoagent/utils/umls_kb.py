@@ -0,0 +1,195 @@
+import mmap
+import os
+import sqlite3
+import subprocess
+import sys
+import threading
+from collections.abc import Sequence
+from typing import NamedTuple
+
+import joblib
+import numpy as np
+from scispacy.candidate_generation import DEFAULT_PATHS, CandidateGenerator, load_approximate_nearest_neighbours_index
+from scispacy.file_cache import cached_path
+
+from geoagent.utils.logger import geoagent_logger as logger
+
+_KB_DB_FILE = "umls_kb.db"
+_ALIASES_FILE = "aliases.bin"
+_ALIAS_OFFSETS_FILE = "alias_offsets.npy"
+
+
+class CompactEntity(NamedTuple):
+    concept_id: str
+    canonical_name: str
+    definition: str | None
+
+
+class MmapStringList(Sequence):
+    """
+    Read-only list of strings backed by a memory-mapped UTF-8 blob and offset array,
+    the pages are shared by every process that opens the same files.
+    """
+
+    def __init__(self, blob_path: str, offsets_path: str):
+        self._offsets = np.load(offsets_path, mmap_mode="r")
+        with open(blob_path, "rb") as f:
+            self._blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        return self._blob[int(self._offsets[i]):int(self._offsets[i + 1])].decode("utf-8")
+
+
+class _SqliteLookup:
+    """
+    Dict-like read-only lookup over one SQLite query, one connection per thread.
+    """
+
+    def __init__(self, db_path: str, query: str, convert):
+        self.db_path = db_path
+        self.query = query
+        self.convert = convert
+        self._local = threading.local()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # immutable: no locking, the database file is only read through the OS page cache
+            conn = sqlite3.connect(f"file:{self.db_path}?mode=ro&immutable=1", uri=True)
+            conn.execute("PRAGMA mmap_size = 8589934592")
+            self._local.conn = conn
+        return conn
+
+    def __getitem__(self, key: str):
+        rows = self._conn().execute(self.query, (key,)).fetchall()
+        if not rows:
+            raise KeyError(key)
+        return self.convert(key, rows)
+
+    def get(self, key: str, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key) is not None
+
+
+class CompactKnowledgeBase:
+    """
+    Drop-in for the scispaCy `KnowledgeBase` attributes used by the candidate
+    generator and `UMLSMapper` (`cui_to_entity`, `alias_to_cuis`), served from
+    an on-disk SQLite file instead of multi-GB Python dicts.
+    """
+
+    def __init__(self, kb_dir: str):
+        db_path = os.path.join(kb_dir, _KB_DB_FILE)
+        self.cui_to_entity = _SqliteLookup(
+            db_path,
+            "SELECT canonical_name, definition FROM entities WHERE cui = ?",
+            lambda cui, rows: CompactEntity(cui, rows[0][0], rows[0][1]),
+        )
+        self.alias_to_cuis = _SqliteLookup(
+            db_path,
+            "SELECT cui FROM aliases WHERE alias = ?",
+            lambda alias, rows: {row[0] for row in rows},
+        )
+
+
+def export_compact_kb(kb_dir: str, candidate_generator: CandidateGenerator = None) -> None:
+    """
+    Write the UMLS KB and the ANN alias list of a loaded candidate generator to `kb_dir`.
+    This is done once per node, workers then open the files with `load_compact_candidate_generator`.
+    """
+    candidate_generator = candidate_generator or CandidateGenerator(name="umls")
+    os.makedirs(kb_dir, exist_ok=True)
+
+    db_path = os.path.join(kb_dir, _KB_DB_FILE)
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    conn = sqlite3.connect(db_path)
+    with conn:
+        conn.execute("CREATE TABLE entities (cui TEXT PRIMARY KEY, canonical_name TEXT, definition TEXT) WITHOUT ROWID")
+        conn.execute("CREATE TABLE aliases (alias TEXT NOT NULL, cui TEXT NOT NULL)")
+        conn.executemany(
+            "INSERT INTO entities VALUES (?, ?, ?)",
+            ((cui, e.canonical_name, e.definition) for cui, e in candidate_generator.kb.cui_to_entity.items()),
+        )
+        conn.executemany(
+            "INSERT INTO aliases VALUES (?, ?)",
+            ((alias, cui) for alias, cuis in candidate_generator.kb.alias_to_cuis.items() for cui in cuis),
+        )
+        conn.execute("CREATE INDEX aliases_alias ON aliases (alias)")
+    conn.execute("VACUUM")
+    conn.close()
+
+    offsets = [0]
+    with open(os.path.join(kb_dir, _ALIASES_FILE), "wb") as f:
+        for alias in candidate_generator.ann_concept_aliases_list:
+            encoded = alias.encode("utf-8")
+            f.write(encoded)
+            offsets.append(offsets[-1] + len(encoded))
+    np.save(os.path.join(kb_dir, _ALIAS_OFFSETS_FILE), np.asarray(offsets, dtype=np.uint64))
+    logger.info(f"Exported the compact UMLS knowledge base to {kb_dir}")
+
+
+def load_compact_candidate_generator(kb_dir: str, ef_search: int = 200) -> CandidateGenerator:
+    """
+    Build a candidate generator whose KB and alias list are read from the shared files
+    in `kb_dir`. The vectorizer arrays are mmapped when the pickle is uncompressed, the
+    nmslib ANN index has no mmap support and is still loaded per process.
+    """
+    linker_paths = DEFAULT_PATHS["umls"]
+    return CandidateGenerator(
+        ann_index=load_approximate_nearest_neighbours_index(linker_paths=linker_paths, ef_search=ef_search),
+        tfidf_vectorizer=joblib.load(cached_path(linker_paths.tfidf_vectorizer), mmap_mode="r"),
+        ann_concept_aliases_list=MmapStringList(
+            os.path.join(kb_dir, _ALIASES_FILE), os.path.join(kb_dir, _ALIAS_OFFSETS_FILE)
+        ),
+        kb=CompactKnowledgeBase(kb_dir),
+    )
+
+
+def _current_rss_mb() -> float:
+    with open("/proc/self/statm") as f:
+        resident_pages = int(f.read().split()[1])
+    return round(resident_pages * os.sysconf("SC_PAGE_SIZE") / 1024**2, 1)
+
+
+def _measure_loader(loader: str, kb_dir: str) -> float:
+    # run in a fresh interpreter so both loaders start from the same baseline
+    code = (
+        "from geoagent.utils import umls_kb as m;"
+        "before = m._current_rss_mb();"
+        f"g = m.CandidateGenerator(name='umls') if {loader!r} == 'default' else m.load_compact_candidate_generator({kb_dir!r});"
+        "g(['breast cancer'], 30);"
+        "print(m._current_rss_mb() - before)"
+    )
+    out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+    return float(out.stdout.strip().splitlines()[-1])
+
+
+def measure_rss(kb_dir: str) -> dict:
+    """
+    RSS (MB) added by loading the default scispaCy generator vs the compact one.
+    """
+    return {loader: _measure_loader(loader, kb_dir) for loader in ("default", "compact")}
+
+
+if __name__ == "__main__":
+    # usage: python -m geoagent.utils.umls_kb export|measure <kb_dir>
+    command, kb_dir = sys.argv[1], sys.argv[2]
+    if command == "export":
+        export_compact_kb(kb_dir)
+    elif command == "measure":
+        print(measure_rss(kb_dir))
+    else:
+        raise ValueError(f"Unknown command: {command}")
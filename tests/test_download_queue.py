@@ -0,0 +1,37 @@
+import sqlite3
+
+from geoagent.utils import download_queue
+from geoagent.utils.download_queue import DownloadQueue
+
+
+def _jobs(queue: DownloadQueue) -> list[tuple]:
+    with sqlite3.connect(queue.db_path) as conn:
+        return conn.execute("SELECT accession, status, attempts, error FROM jobs").fetchall()
+
+
+def test_job_failing_to_list_is_retried_then_failed(tmp_path, monkeypatch):
+    def unavailable(geo_id, cache_path=None, raise_errors=False):
+        raise OSError(f"{geo_id} not found")
+
+    monkeypatch.setattr(download_queue, "get_supp_file_tasks", unavailable)
+    queue = DownloadQueue(str(tmp_path))
+    queue.submit(["GSE0"])
+    progress = queue.run(max_attempts=2, show_progress=False)
+    assert _jobs(queue) == [("GSE0", "failed", 2, "GSE0 not found")]
+    assert progress["jobs"] == {"failed": 1}
+
+
+def test_job_listed_on_a_later_attempt(tmp_path, monkeypatch):
+    calls = []
+
+    def flaky(geo_id, cache_path=None, raise_errors=False):
+        calls.append(geo_id)
+        if len(calls) == 1:
+            raise OSError("timed out")
+        return []
+
+    monkeypatch.setattr(download_queue, "get_supp_file_tasks", flaky)
+    queue = DownloadQueue(str(tmp_path))
+    queue.submit(["GSE0"])
+    queue.run(max_attempts=3, show_progress=False)
+    assert _jobs(queue) == [("GSE0", "done", 1, None)]
@@ -0,0 +1,43 @@
+import os
+
+from geoagent.utils.file_inventory import FileInventory
+
+
+def _touch(path: str, content: bytes = b"x") -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(content)
+
+
+def test_download_artifacts_are_not_listed(tmp_path):
+    root = str(tmp_path)
+    for name in [
+        "GSM1/a.mtx.gz",
+        "GSM1/b.tsv.gz.part",
+        "GSM1/b.tsv.gz.part.json",
+        "GSM1/download_failures.log",
+        "GSM1/download.logs",
+        "Supp/.GSE1_RAW.tar.members.json",
+        "Supp/GSE1_RAW.tar",
+    ]:
+        _touch(os.path.join(root, "GSE1", name))
+
+    inventory = FileInventory(root)
+    inventory.refresh()
+    assert inventory.list_records() == {"GSE1": ["GSM1/a.mtx.gz", "Supp/GSE1_RAW.tar"]}
+
+    # files added on download completion go through the same rule
+    inventory.add_file(os.path.join(root, "GSE1", "GSM1", "b.tsv.gz.part.json"))
+    assert inventory.list_files("GSE1") == ["GSM1/a.mtx.gz", "Supp/GSE1_RAW.tar"]
+
+
+def test_refresh_picks_up_files_rewritten_in_place(tmp_path):
+    root = str(tmp_path)
+    path = os.path.join(root, "GSE1", "GSM1", "a.tsv")
+    _touch(path)
+    inventory = FileInventory(root)
+    inventory.refresh()
+    _touch(path, b"rewritten")
+    os.utime(path, (1, 1))
+    inventory.refresh()
+    assert [row["size"] for row in inventory.query("GSE1")] == [len(b"rewritten")]
@@ -0,0 +1,23 @@
+import glob
+import os
+
+import pytest
+
+from geoagent.utils.search_parser import benchmark, parse_search_page, parse_search_page_bs4
+
+# synthetic pages following the GEO DataSets result markup, for parser parity only, not for timings
+PAGES = sorted(glob.glob(os.path.join(os.path.dirname(__file__), "data", "gds_synthetic_page*.html")))
+
+
+@pytest.mark.parametrize("path", PAGES)
+def test_lxml_parser_matches_bs4(path):
+    with open(path, "rb") as f:
+        page = f.read()
+    records = parse_search_page(page)
+    assert len(records) == 20
+    assert records == parse_search_page_bs4(page)
+
+
+def test_benchmark_needs_pages():
+    with pytest.raises(ValueError):
+        benchmark([])